@@ -51,3 +51,22 @@ export async function doorCmd(id: string, action: "open" | "close" | "toggle") {
   if (!r.ok) alert(`Door ${action} KO (${r.status})`);
 }
 
+
+export type PlanPatchOp = {
+  op: "add" | "replace" | "remove";
+  /** ex: "/walls/<id>", "/nodes/<id>/x", "/name" */
+  path: string;
+  value?: unknown;
+};
+
+/** Envoie uniquement les modifications ; 409 si le plan a changé depuis `version`. */
+export async function patchPlan(floorId: string, version: number | undefined, ops: PlanPatchOp[]) {
+  const r = await fetch(`${ORCH_URL}/plans/${floorId}`, {
+    method: "PATCH",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ version, ops }),
+  });
+  if (r.status === 409) throw new Error("plan modifié entre-temps (version obsolète)");
+  if (!r.ok) throw new Error(`patch plan KO (${r.status})`);
+  return (await r.json()) as { ok: boolean; version: number };
+}
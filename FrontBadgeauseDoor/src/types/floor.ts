@@ -50,6 +50,8 @@ export type Floor = {
   nodes: DeviceNode[];
   simPersons?: SimPerson[];
   zones?: ZoneShape[];
+  /** Incrémentée par le serveur à chaque sauvegarde (POST ou PATCH) */
+  version?: number;
 };
 
 export interface BadgeEventPayload {
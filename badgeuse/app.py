@@ -1,15 +1,27 @@
-import os, json
+import os, json, pathlib, threading, time
+from collections import OrderedDict, deque
+from itertools import islice
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
 import uvicorn
 import logging
+import sys
+# modules partagés (common/) : copiés à côté du code dans l'image Docker, lus dans le dépôt en local
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from logging_setup import logging_stats, setup_logging
+from profiling import install_debug_routes, timed
+from offline_buffer import OfflineBuffer
+from reconnect import ReconnectStats, install_jittered_reconnect
 
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("badgeuse")
+log = setup_logging("badgeuse")
+log_mqtt = logging.getLogger("badgeuse.mqtt")     # une ligne par message : échantillonnable (LOG_SAMPLE)
 
 # --- Config MQTT / Device ------------------------------------------------
 MQTT_HOST = os.getenv("MQTT_HOST", "mosquitto")   # mets host.docker.internal si broker hors-compose
@@ -18,6 +30,23 @@ MQTT_USER = os.getenv("MQTT_USER", "")
 MQTT_PASS = os.getenv("MQTT_PASS", "")
 DEVICE_ID = os.getenv("DEVICE_ID", "badgeuse-001")
 DOOR_ID   = os.getenv("DOOR_ID", "")              # <— injecté par l’orchestrateur (optionnel)
+# Identité attribuée à chaud par l'orchestrateur (warm pool) : survit aux redémarrages du container
+WARM_POOL = os.getenv("WARM_POOL", "") == "1"
+APP_DIR = pathlib.Path(__file__).resolve().parent   # fichiers d'état à côté du code (WORKDIR de l'image), pas dans le cwd
+RUNTIME_CONFIG_FILE = pathlib.Path(os.getenv("RUNTIME_CONFIG_FILE") or APP_DIR / "runtime_config.json")
+
+def _load_runtime_config() -> dict:
+    if RUNTIME_CONFIG_FILE.exists():
+        try:
+            return json.loads(RUNTIME_CONFIG_FILE.read_text(encoding="utf-8"))
+        except Exception:
+            log.exception(f"[BOOT] Unable to read {RUNTIME_CONFIG_FILE}")
+    return {}
+
+_runtime = _load_runtime_config()
+DEVICE_ID = _runtime.get("device_id") or DEVICE_ID
+DOOR_ID   = _runtime.get("door_id", DOOR_ID) or ""
+configured = bool(_runtime) or not WARM_POOL
 
 def _topic_events(device_id: str) -> str:
     return f"iot/badgeuse/{device_id}/events"
@@ -25,12 +54,98 @@ def _topic_events(device_id: str) -> str:
 def _topic_commands(device_id: str) -> str:
     return f"iot/badgeuse/{device_id}/commands"
 
+def _topic_status(device_id: str) -> str:
+    return f"iot/badgeuse/{device_id}/status"
+
 TOPIC_EVENTS = _topic_events(DEVICE_ID)
 TOPIC_CMDS   = _topic_commands(DEVICE_ID)
+TOPIC_STATUS = _topic_status(DEVICE_ID)   # présence retenue : online / offline (LWT)
 TOPIC_CMDS_FILTER = "iot/badgeuse/+/commands"
 
+# --- Buffer hors-ligne ---------------------------------------------------
+# Badgeages faits sans broker : stockés sur disque avec leur horodatage d'origine,
+# renvoyés par lots après reconnexion.
+OFFLINE_BUFFER_FILE     = pathlib.Path(os.getenv("OFFLINE_BUFFER_FILE") or APP_DIR / "offline_buffer.bin")
+OFFLINE_BUFFER_SLOTS    = int(os.getenv("OFFLINE_BUFFER_SLOTS", "10000"))
+OFFLINE_DRAIN_BATCH     = int(os.getenv("OFFLINE_DRAIN_BATCH", "50"))
+OFFLINE_DRAIN_INTERVAL  = float(os.getenv("OFFLINE_DRAIN_INTERVAL", "0.2"))   # pause entre deux lots
+offline = OfflineBuffer(OFFLINE_BUFFER_FILE, slots=OFFLINE_BUFFER_SLOTS)
+_drain_wakeup = threading.Event()
+
+# --- Débit de publication -------------------------------------------------
+# Fenêtre QoS1 en vol et file d'attente paho (0 = illimitée) ; au-delà, publish() refuse.
+MQTT_MAX_INFLIGHT = int(os.getenv("MQTT_MAX_INFLIGHT", "20"))
+MQTT_MAX_QUEUED   = int(os.getenv("MQTT_MAX_QUEUED", "0"))
+BATCH_MAX         = int(os.getenv("BATCH_MAX", "10000"))     # badgeages max par lot
+BATCH_WAIT_MAX_S  = 60.0                                     # attente max des PUBACK d'un lot (MQTT et HTTP)
+EARLY_ACK_TTL_S   = 5.0    # PUBACK arrivé avant l'enregistrement de son mid : gardé au plus ce délai
+EARLY_ACK_MAX     = 1024   # … et au plus ce nombre
+
+class PublishStats:
+    """Compteurs et latences PUBACK (publish -> on_publish) des événements QoS1.
+
+    Seuls les mids enregistrés par sent() sont comptés : les PUBACK de la présence et du vidage
+    hors-ligne passent aussi par on_publish, ils expirent de `_early` sans fausser les compteurs.
+    """
+
+    def __init__(self, window: int = 2000):
+        self._lock = threading.Lock()
+        self._sent = {}                # mid -> monotonic au publish
+        self._early = OrderedDict()    # mid -> (monotonic, ok) du PUBACK reçu avant l'enregistrement du mid
+        self._latencies = deque(maxlen=window)
+        self.published = self.acked = self.failed = self.rejected = 0
+
+    def sent(self, info, t0: float):
+        with self._lock:
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self.rejected += 1
+                return
+            self.published += 1
+            early = self._early.pop(info.mid, None)
+            if early is None:
+                self._sent[info.mid] = t0
+            else:
+                self._count(early[1], early[0] - t0)
+
+    def _count(self, ok: bool, latency: float):
+        if ok:
+            self.acked += 1
+            self._latencies.append(latency)
+        else:
+            self.failed += 1
+
+    def acked_mid(self, mid: int, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            t0 = self._sent.pop(mid, None)
+            if t0 is not None:
+                self._count(ok, now - t0)
+                return
+            # PUBACK plus rapide que sent(), ou publication non suivie : expire au bout de EARLY_ACK_TTL_S
+            self._early[mid] = (now, ok)
+            self._early.move_to_end(mid)
+            while len(self._early) > EARLY_ACK_MAX or now - next(iter(self._early.values()))[0] > EARLY_ACK_TTL_S:
+                self._early.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lat = sorted(self._latencies)
+            pending = len(self._sent)
+            counts = {"published": self.published, "acked": self.acked, "failed": self.failed, "rejected": self.rejected}
+        pct = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))] * 1000, 2) if lat else None
+        return {
+            **counts,
+            "pending": pending,
+            "max_inflight": MQTT_MAX_INFLIGHT,
+            "max_queued": MQTT_MAX_QUEUED,
+            "puback_ms": {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99), "samples": len(lat)},
+        }
+
+publish_stats = PublishStats()
+
 # --- MQTT client (API v2) ------------------------------------------------
 connected = False
+_identity_lock = threading.Lock()
 
 def _reason_success(reason_code) -> bool:
     if reason_code is None:
@@ -48,7 +163,25 @@ def _normalize_badge_payload(payload: dict) -> Tuple[str, Optional[str]]:
     door_id = str(raw_door) if raw_door not in (None, "") else (DOOR_ID or None)
     return badge_id, door_id
 
-def _publish_badge_event(device_id: str, badge_id: str, door_id: Optional[str], origin: str):
+def _presence_payload(status: str) -> str:
+    return json.dumps({
+        "device_id": DEVICE_ID,
+        "kind": "badgeuse",
+        "status": status,
+        "door_id": DOOR_ID or None,
+        "ts": datetime.now(timezone.utc).isoformat(),
+    })
+
+def _set_will():
+    # le broker publie "offline" (retenu) si la session tombe sans disconnect propre
+    if configured:
+        client.will_set(TOPIC_STATUS, _presence_payload("offline"), qos=1, retain=True)
+
+def publish_offline(timeout: float = 2.0):
+    if configured and connected:
+        client.publish(TOPIC_STATUS, _presence_payload("offline"), qos=1, retain=True).wait_for_publish(timeout)
+
+def _publish_badge_event(device_id: str, badge_id: str, door_id: Optional[str], origin: str, verbose: bool = True):
     now = datetime.now(timezone.utc).isoformat()
     message = {
         "badgeID": badge_id,
@@ -56,45 +189,171 @@ def _publish_badge_event(device_id: str, badge_id: str, door_id: Optional[str],
         "timestamp": now,
     }
     topic = _topic_events(device_id)
+    if not connected or len(offline):
+        # hors-ligne (ou buffer pas encore vidé : on garde l'ordre) -> disque, pas la file mémoire de paho
+        if not offline.append(topic, json.dumps(message).encode("utf-8")):
+            log.error("[OFFLINE] badge_event too large for buffer slot, dropped (%s)", topic)
+            return message, None, topic
+        if verbose:
+            log_mqtt.info("[OFFLINE] badge_event (%s) buffered depth=%d badge=%s door=%s", origin, len(offline), badge_id, door_id or "-")
+        _drain_wakeup.set()
+        return message, None, topic
+    t0 = time.monotonic()
     info = client.publish(topic, json.dumps(message), qos=1, retain=False)
-    log.info(f"[MQTT] badge_event ({origin}) -> {topic} badge={badge_id} door={door_id or '-'} device={device_id}")
+    publish_stats.sent(info, t0)
+    if verbose:
+        log_mqtt.info("[MQTT] badge_event (%s) -> %s badge=%s door=%s device=%s", origin, topic, badge_id, door_id or "-", device_id)
     return message, info, topic
 
+def _run_batch(device_id: str, swipes: List[Tuple[str, Optional[str]]], origin: str, wait_s: float) -> dict:
+    """Publie un lot de badgeages d'un coup puis attend les PUBACK (au plus wait_s)."""
+    t0 = time.monotonic()
+    infos, buffered, rejected = [], 0, 0
+    for badge_id, door_id in swipes:
+        _, info, _ = _publish_badge_event(device_id, badge_id, door_id, origin=origin, verbose=False)
+        if info is None:
+            buffered += 1
+        elif info.rc != mqtt.MQTT_ERR_SUCCESS:
+            rejected += 1      # file paho pleine (MQTT_MAX_QUEUED)
+        else:
+            infos.append(info)
+    sent_s = time.monotonic() - t0
+    deadline = t0 + wait_s
+    for info in infos:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            info.wait_for_publish(remaining)
+        except (RuntimeError, ValueError):
+            break
+    acked = sum(1 for info in infos if info.is_published())
+    elapsed = time.monotonic() - t0
+    result = {
+        "requested": len(swipes),
+        "published": len(infos),
+        "acked": acked,
+        "buffered": buffered,
+        "rejected": rejected,
+        "publish_s": round(sent_s, 4),
+        "elapsed_s": round(elapsed, 4),
+        "acked_per_s": round(acked / elapsed, 1) if elapsed > 0 else None,
+    }
+    log.info("[BATCH] (%s) device=%s %s", origin, device_id, result)
+    return result
+
+_batch_slot = threading.Lock()     # un lot à la fois (HTTP ou MQTT) : pas de threads sans borne
+
+def _batch_swipes(data: dict) -> List[Tuple[str, Optional[str]]]:
+    """Badgeages d'un lot : liste explicite `badges`, ou `count` badges générés (préfixe `badgePrefix`).
+
+    Borné à BATCH_MAX avant construction ; ValueError si `badges` ou `count` est invalide.
+    """
+    default_door = str(data.get("doorID") or data.get("door_id") or "") or DOOR_ID or None
+    badges = data.get("badges") or []
+    if not isinstance(badges, list):
+        raise ValueError("badges must be a list")
+    if badges:
+        swipes = []
+        for item in islice(badges, BATCH_MAX):
+            if isinstance(item, dict):
+                swipes.append(_normalize_badge_payload({"doorID": default_door, **item}))
+            else:
+                swipes.append((str(item), default_door))
+        return swipes
+    try:
+        count = int(data.get("count") or 0)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"invalid count: {data.get('count')!r}")
+    prefix = str(data.get("badgePrefix") or "BADGE-")
+    return [(f"{prefix}{i:05d}", default_door) for i in range(max(0, min(count, BATCH_MAX)))]
+
+def _run_batch_thread(device_id: str, swipes: List[Tuple[str, Optional[str]]], wait_s: float):
+    try:
+        _run_batch(device_id, swipes, "mqtt-batch", wait_s)
+    finally:
+        _batch_slot.release()
+
+def _drain_offline():
+    """Vide le buffer disque par lots limités tant que la connexion tient."""
+    while True:
+        _drain_wakeup.wait(1.0)
+        _drain_wakeup.clear()
+        while connected and len(offline):
+            t0 = time.monotonic()
+            first, batch = offline.peek(OFFLINE_DRAIN_BATCH)
+            infos = [client.publish(topic, payload, qos=1, retain=False) for topic, payload in batch]
+            try:
+                for info in infos:
+                    info.wait_for_publish(5)
+            except (RuntimeError, ValueError):
+                break  # connexion perdue pendant le lot : on le renverra entier
+            if not all(info.is_published() for info in infos):
+                break
+            offline.commit(first, len(batch), time.monotonic() - t0)
+            log.info("[OFFLINE] drained %d event(s), depth=%d rate=%.0f/s", len(batch), len(offline), offline.drain_rate)
+            time.sleep(OFFLINE_DRAIN_INTERVAL)
+
 def on_connect(client, userdata, flags, reason_code, properties=None):
     global connected
     connected = _reason_success(reason_code)
     if connected:
         log.info(f"[MQTT] Connected to {MQTT_HOST}:{MQTT_PORT} (reason_code={reason_code})")
-        client.subscribe(TOPIC_CMDS, qos=1)
+        with _identity_lock:
+            client.subscribe(TOPIC_CMDS, qos=1)
+            if configured:
+                client.publish(TOPIC_STATUS, _presence_payload("online"), qos=1, retain=True)
         client.subscribe(TOPIC_CMDS_FILTER, qos=1)
         log.info(f"[MQTT] Subscribed to {TOPIC_CMDS} and {TOPIC_CMDS_FILTER}")
+        if len(offline):
+            _drain_wakeup.set()
     else:
         log.error(f"[MQTT] Connect failed (reason_code={reason_code})")
 
-def on_disconnect(client, userdata, reason_code, properties=None):
+def on_disconnect(client, userdata, flags, reason_code, properties=None):
     global connected
     connected = False
     log.warning(f"[MQTT] Disconnected (reason_code={reason_code})")
 
+@timed("badgeuse.on_message")
 def on_message(client, userdata, msg):
+    if not configured:
+        return
     raw_payload = msg.payload.decode("utf-8", errors="ignore")
     topic_parts = msg.topic.split("/")
     target_device = topic_parts[2] if len(topic_parts) >= 3 else DEVICE_ID
-    log.info(f"[MQTT] cmd topic={msg.topic} device={target_device} payload={raw_payload}")
+    log_mqtt.debug("[MQTT] cmd topic=%s device=%s payload=%s", msg.topic, target_device, raw_payload)
     try:
         payload = json.loads(raw_payload)
     except Exception:
-        log.warning(f"[MQTT] Non JSON payload on {msg.topic}")
+        log.warning("[MQTT] Non JSON payload on %s", msg.topic)
         return
 
     action = str(payload.get("action") or payload.get("type") or "").lower()
+    if action == "badge_batch":
+        if target_device != DEVICE_ID:
+            # abonnement joker : chaque badgeuse reçoit les lots de toutes les autres, un seul doit l'exécuter
+            log_mqtt.debug("[BATCH] badge_batch for %s ignored (not this device)", target_device)
+            return
+        # hors du thread réseau paho : l'attente des PUBACK y bloquerait la boucle
+        try:
+            swipes = _batch_swipes(payload.get("data") or payload)
+            wait_s = max(0.0, min(float(payload.get("wait_s") or 10), BATCH_WAIT_MAX_S))
+        except (TypeError, ValueError) as e:
+            log.warning("[BATCH] Invalid badge_batch command on %s: %s", msg.topic, e)
+            return
+        if not _batch_slot.acquire(blocking=False):
+            log.warning("[BATCH] badge_batch ignored on %s: a batch is already running", msg.topic)
+            return
+        threading.Thread(target=_run_batch_thread, args=(target_device, swipes, wait_s), name="badge-batch", daemon=True).start()
+        return
     if action not in {"badge", "simulate_badge", "badge_event"}:
-        log.debug(f"[MQTT] Ignored action '{action}' on {msg.topic}")
+        log_mqtt.debug("[MQTT] Ignored action '%s' on %s", action, msg.topic)
         return
 
     badge_id, door_id = _normalize_badge_payload(payload.get("data") or payload)
     if not door_id:
-        log.debug("[MQTT] Command without door_id, fallback to env/default")
+        log_mqtt.debug("[MQTT] Command without door_id, fallback to env/default")
 
     try:
         _publish_badge_event(target_device, badge_id, door_id, origin="mqtt-command")
@@ -102,10 +361,12 @@ def on_message(client, userdata, msg):
         log.exception("[MQTT] Unable to publish badge event from command")
 
 def on_publish(client, userdata, mid, reason_code=mqtt.MQTT_ERR_SUCCESS, properties=None):
-    if reason_code == mqtt.MQTT_ERR_SUCCESS:
-        log.info(f"[MQTT] Published mid={mid}")
+    ok = reason_code == mqtt.MQTT_ERR_SUCCESS
+    publish_stats.acked_mid(mid, ok)
+    if ok:
+        log_mqtt.debug("[MQTT] Published mid=%s", mid)
     else:
-        log.warning(f"[MQTT] Publish mid={mid} failed (reason={reason_code})")
+        log.warning("[MQTT] Publish mid=%s failed (reason=%s)", mid, reason_code)
 
 client = mqtt.Client(
     callback_api_version=CallbackAPIVersion.VERSION2,
@@ -119,15 +380,71 @@ client.on_connect = on_connect
 client.on_disconnect = on_disconnect
 client.on_message = on_message
 client.on_publish = on_publish
-client.reconnect_delay_set(min_delay=1, max_delay=5)
+# backoff à gigue complète : la flotte de badgeuses ne revient pas d'un bloc après un redémarrage du broker
+reconnect_stats = ReconnectStats()
+install_jittered_reconnect(client, reconnect_stats)
+client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+client.max_queued_messages_set(MQTT_MAX_QUEUED)
+_set_will()
 
-log.info(f"[MQTT] Connecting to {MQTT_HOST}:{MQTT_PORT} …")
 log.info(f"[BOOT] DEVICE_ID={DEVICE_ID} DOOR_ID={DOOR_ID or '-'} CMD_TOPIC={TOPIC_CMDS} CMD_FILTER={TOPIC_CMDS_FILTER}")
-client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-client.loop_start()
+
+_session_lock = threading.Lock()
+
+def _restart_session():
+    """DISCONNECT propre (pas de LWT), puis reconnexion faite par le thread réseau de paho.
+
+    Hors de _identity_lock : loop_stop() attend la fin du thread réseau, dont on_connect prend ce verrou.
+    """
+    with _session_lock:
+        client.disconnect()
+        client.loop_stop()
+        client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+        client.loop_start()
+
+def apply_identity(device_id: str, door_id: str):
+    """Change l'identité du device sans redémarrer (topics + persistance locale)."""
+    global DEVICE_ID, DOOR_ID, TOPIC_EVENTS, TOPIC_CMDS, TOPIC_STATUS, configured
+    restart = False
+    with _identity_lock:
+        old_status, was_configured = TOPIC_STATUS, configured
+        DEVICE_ID, DOOR_ID = device_id, door_id
+        configured = True
+        TOPIC_EVENTS = _topic_events(device_id)
+        TOPIC_CMDS = _topic_commands(device_id)
+        TOPIC_STATUS = _topic_status(device_id)
+        if old_status != TOPIC_STATUS or not was_configured:
+            if was_configured and connected:
+                # efface la présence retenue de l'ancienne identité
+                client.publish(old_status, b"", qos=1, retain=True).wait_for_publish(2)
+            _set_will()
+            restart = connected
+        elif connected:
+            client.publish(TOPIC_STATUS, _presence_payload("online"), qos=1, retain=True)
+        RUNTIME_CONFIG_FILE.write_text(json.dumps({"device_id": DEVICE_ID, "door_id": DOOR_ID}), encoding="utf-8")
+    if restart:
+        # nouvelle session : LWT à jour, abonnements et "online" refaits dans on_connect
+        _restart_session()
+    log.info(f"[CONFIG] DEVICE_ID={DEVICE_ID} DOOR_ID={DOOR_ID or '-'} CMD_TOPIC={TOPIC_CMDS}")
 
 # --- FastAPI --------------------------------------------------------------
-app = FastAPI(title=f"Badgeuse {DEVICE_ID}")
+_boot_ts = time.monotonic()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # HTTP disponible tout de suite : connexion MQTT (et reconnexions) dans le thread réseau de paho,
+    # les badgeages faits d'ici là partent dans le buffer hors-ligne
+    log.info(f"[MQTT] Connecting to {MQTT_HOST}:{MQTT_PORT} …")
+    client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+    client.loop_start()
+    threading.Thread(target=_drain_offline, name="offline-drain", daemon=True).start()
+    yield
+    publish_offline()
+    client.disconnect()
+    client.loop_stop()
+
+app = FastAPI(title=f"Badgeuse {DEVICE_ID}", lifespan=lifespan)
+install_debug_routes(app)
 
 # CORS pour le front
 app.add_middleware(
@@ -138,14 +455,76 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class RuntimeConfig(BaseModel):
+    device_id: Optional[str] = None
+    door_id: Optional[str] = None   # "" pour délier la badgeuse
+
+@app.get("/config")
+def get_config():
+    return {"device_id": DEVICE_ID, "door_id": DOOR_ID or None, "configured": configured}
+
+@app.post("/config")
+def set_config(cfg: RuntimeConfig):
+    door_id = DOOR_ID if cfg.door_id is None else cfg.door_id
+    apply_identity(cfg.device_id or DEVICE_ID, door_id)
+    return {"ok": True, **get_config()}
+
+class BadgeSwipe(BaseModel):
+    badgeID: str
+    doorID: Optional[str] = None
+
+@app.post("/badge")
+def badge(swipe: BadgeSwipe):
+    """Badgeage local : publié tout de suite, ou mis en buffer disque si le broker est absent."""
+    message, info, topic = _publish_badge_event(DEVICE_ID, swipe.badgeID, swipe.doorID or DOOR_ID or None, origin="http")
+    return {"ok": True, "buffered": info is None, "topic": topic, "event": message}
+
+class BadgeBatch(BaseModel):
+    badges: List[str] = []          # badges explicites, sinon `count` badges générés
+    count: int = 0
+    badgePrefix: str = "BADGE-"
+    doorID: Optional[str] = None
+    wait_s: float = 10.0            # attente max des PUBACK avant de répondre (bornée à BATCH_WAIT_MAX_S)
+
+@app.post("/badge/batch")
+def badge_batch(batch: BadgeBatch):
+    """Injecte un lot de badgeages : mesure le plafond de débit réel du device."""
+    swipes = _batch_swipes({"badges": batch.badges, "count": batch.count, "badgePrefix": batch.badgePrefix, "doorID": batch.doorID})
+    if not _batch_slot.acquire(blocking=False):
+        return JSONResponse(status_code=409, content={"ok": False, "error": "a batch is already running"})
+    try:
+        wait_s = max(0.0, min(batch.wait_s, BATCH_WAIT_MAX_S))
+        return {"ok": True, "topic": _topic_events(DEVICE_ID), **_run_batch(DEVICE_ID, swipes, "http-batch", wait_s)}
+    finally:
+        _batch_slot.release()
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "mqtt_connected": connected,
+        "offline_buffer": offline.stats(),
+        "publish": publish_stats.snapshot(),
+        "reconnect": reconnect_stats.snapshot(),
+        "logging": logging_stats(),
+    }
+
 @app.get("/health")
 def health():
+    """Liveness : le process répond ; l'état MQTT est informatif (voir /ready)."""
     return {
         "status": "ok",
         "device_id": DEVICE_ID,
         "door_id": DOOR_ID or None,
-        "mqtt_connected": connected
+        "mqtt_connected": connected,
+        "offline_depth": len(offline),
+        "uptime_s": round(time.monotonic() - _boot_ts, 1),
     }
 
+@app.get("/ready")
+def ready():
+    """Readiness : 503 tant que la session MQTT n'est pas établie (badgeages bufferisés)."""
+    return JSONResponse(status_code=200 if connected else 503,
+                        content={"ready": connected, "device_id": DEVICE_ID, "mqtt_connected": connected})
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT","8000")))
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT","8000")), log_config=None)
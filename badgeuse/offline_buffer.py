@@ -0,0 +1,105 @@
+"""Ring buffer sur disque (fichier mappé en mémoire) pour les badgeages faits hors connexion.
+
+Slots de taille fixe : [u16 longueur topic][u16 longueur payload][topic][payload].
+L'en-tête porte deux compteurs monotones (head = plus ancien non envoyé, tail = prochain
+à écrire) : profondeur = tail - head, slot = seq % slots. Buffer plein -> le plus ancien
+est écrasé et compté dans `dropped`.
+"""
+import mmap
+import pathlib
+import struct
+import threading
+import time
+from typing import List, Tuple
+
+_MAGIC = b"BADGBUF1"
+_HEADER = struct.Struct("<8sIIQQQ")      # magic, slot_size, slots, head, tail, dropped
+_RECORD = struct.Struct("<HH")
+
+
+class OfflineBuffer:
+    def __init__(self, path: pathlib.Path, slots: int = 10000, slot_size: int = 512):
+        self.path = path
+        self._lock = threading.Lock()
+        size = _HEADER.size + slots * slot_size
+        fresh = not path.exists() or path.stat().st_size != size
+        with open(path, "a+b") as fh:
+            fh.truncate(size)
+        self._fh = open(path, "r+b")
+        self._mm = mmap.mmap(self._fh.fileno(), size)
+        magic, cur_slot, cur_slots, head, tail, dropped = _HEADER.unpack_from(self._mm, 0)
+        if fresh or magic != _MAGIC or (cur_slot, cur_slots) != (slot_size, slots):
+            # nouvelle géométrie : on repart d'un buffer vide
+            head = tail = dropped = 0
+        self.slot_size, self.slots = slot_size, slots
+        self.head, self.tail, self.dropped = head, tail, dropped
+        self._write_header()
+        # métriques de vidage
+        self.drained = 0
+        self.drain_rate = 0.0      # messages/s sur le dernier lot
+        self.last_drain_ts = None
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mm, 0, _MAGIC, self.slot_size, self.slots, self.head, self.tail, self.dropped)
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def append(self, topic: str, payload: bytes) -> bool:
+        t = topic.encode("utf-8")
+        if _RECORD.size + len(t) + len(payload) > self.slot_size:
+            return False
+        with self._lock:
+            if self.tail - self.head >= self.slots:
+                self.head += 1
+                self.dropped += 1
+            off = _HEADER.size + (self.tail % self.slots) * self.slot_size
+            _RECORD.pack_into(self._mm, off, len(t), len(payload))
+            start = off + _RECORD.size
+            self._mm[start:start + len(t)] = t
+            self._mm[start + len(t):start + len(t) + len(payload)] = payload
+            self.tail += 1
+            self._write_header()
+            self._mm.flush()
+        return True
+
+    def peek(self, n: int) -> Tuple[int, List[Tuple[str, bytes]]]:
+        """(seq du premier, [(topic, payload)…]) des n plus anciens, sans les retirer."""
+        out: List[Tuple[str, bytes]] = []
+        with self._lock:
+            first = self.head
+            for seq in range(self.head, min(self.tail, self.head + n)):
+                off = _HEADER.size + (seq % self.slots) * self.slot_size
+                tlen, plen = _RECORD.unpack_from(self._mm, off)
+                start = off + _RECORD.size
+                out.append((bytes(self._mm[start:start + tlen]).decode("utf-8"),
+                            bytes(self._mm[start + tlen:start + tlen + plen])))
+        return first, out
+
+    def commit(self, first: int, n: int, elapsed: float):
+        """Marque comme envoyés (après PUBACK) les n messages lus à partir de `first`."""
+        with self._lock:
+            # si des écrasements ont eu lieu pendant l'envoi, head a déjà avancé
+            self.head = min(self.tail, max(self.head, first + n))
+            self._write_header()
+            self._mm.flush()
+            self.drained += n
+            self.drain_rate = n / elapsed if elapsed > 0 else float(n)
+            self.last_drain_ts = time.time()
+
+    def stats(self) -> dict:
+        return {
+            "file": str(self.path),
+            "depth": len(self),
+            "capacity": self.slots,
+            "dropped": self.dropped,
+            "drained": self.drained,
+            "drain_rate": round(self.drain_rate, 1),
+            "last_drain_ts": self.last_drain_ts,
+        }
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        self._fh.close()
+
@@ -0,0 +1,187 @@
+"""Doublures pour faire tourner les services sans broker ni démon Docker.
+
+- FakeMQTT : remplace les méthodes réseau de paho.mqtt.client.Client ; connect() appelle
+  directement on_connect, publish() compte les messages et renvoie un MQTTMessageInfo déjà acquitté.
+- FakeDocker : client docker en mémoire ; chaque appel d'API coûte `latency_s` (aller-retour socket).
+"""
+import importlib.util
+import itertools
+import pathlib
+import socket
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from typing import Dict, List, Optional
+
+import docker
+import paho.mqtt.client as mqtt
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+def load_service_module(service: str, module: str = "app", alias: Optional[str] = None):
+    """Importe <service>/<module>.py sous un nom unique (tous les services ont un app.py)."""
+    service_dir = str(ROOT / service)
+    sys.path.insert(0, service_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(alias or f"{service}_{module}", ROOT / service / f"{module}.py")
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = mod
+        spec.loader.exec_module(mod)
+        return mod
+    finally:
+        sys.path.remove(service_dir)
+
+
+class FakeMQTT:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mid = itertools.count(1)
+        self.published: Counter = Counter()
+
+    def install(self) -> "FakeMQTT":
+        fake = self
+
+        def connect(client, host, port=1883, keepalive=60, *args, **kwargs):
+            if client.on_connect:
+                client.on_connect(client, None, {}, 0, None)
+            return mqtt.MQTT_ERR_SUCCESS
+
+        def publish(client, topic, payload=None, qos=0, retain=False, properties=None):
+            info = mqtt.MQTTMessageInfo(next(fake._mid))
+            info.rc = mqtt.MQTT_ERR_SUCCESS
+            info._set_as_published()
+            with fake._lock:
+                fake.published[topic.split("/")[-1]] += 1
+            return info
+
+        mqtt.Client.connect = connect
+        mqtt.Client.connect_async = lambda client, *a, **k: None
+        mqtt.Client.reconnect = lambda client: mqtt.MQTT_ERR_SUCCESS
+        mqtt.Client.loop_start = lambda client: mqtt.MQTT_ERR_SUCCESS
+        # boucle externe des workers du simulateur : socket jamais lisible (une seule pour tous les
+        # clients) ; seul un DISCONNECT est « à écrire », comme chez paho qui le met en file
+        idle, fake._peer = socket.socketpair()
+        disconnecting = set()
+
+        def disconnect(client, *args, **kwargs):
+            disconnecting.add(client)
+            return mqtt.MQTT_ERR_SUCCESS
+
+        def loop_write(client):
+            disconnecting.discard(client)
+            return mqtt.MQTT_ERR_SUCCESS
+
+        mqtt.Client.socket = lambda client: idle
+        mqtt.Client.want_write = lambda client: client in disconnecting
+        mqtt.Client.loop_read = lambda client, *a: mqtt.MQTT_ERR_SUCCESS
+        mqtt.Client.loop_write = loop_write
+        mqtt.Client.loop_misc = lambda client: mqtt.MQTT_ERR_SUCCESS
+        mqtt.Client.loop_stop = lambda client, *a, **k: mqtt.MQTT_ERR_SUCCESS
+        mqtt.Client.disconnect = disconnect
+        mqtt.Client.subscribe = lambda client, *a, **k: (mqtt.MQTT_ERR_SUCCESS, 1)
+        mqtt.Client.publish = publish
+        mqtt.Client.is_connected = lambda client: True
+        return self
+
+
+class FakeContainer:
+    def __init__(self, api: "FakeDocker", name: str, labels: Dict[str, str], env: Dict[str, str], image: str):
+        self._api = api
+        self.id = f"{abs(hash(name)):064x}"[:64]
+        self.name = name
+        self.labels = labels
+        self.status = "running"
+        self.attrs = {"Config": {"Env": [f"{k}={v}" for k, v in env.items()]}, "State": {"Health": {"Status": "healthy"}}}
+        self.image = types.SimpleNamespace(id=f"sha256:{image}", tags=[image])
+
+    def reload(self):
+        self._api.call()
+
+    def start(self):
+        self._api.call()
+        self.status = "running"
+
+    def stop(self, timeout=None):
+        self._api.call()
+        self.status = "exited"
+
+    def remove(self, force=False):
+        self._api.call()
+        self._api.containers._by_name.pop(self.name, None)
+
+    def stats(self, stream=True, decode=True, interval_s: float = 1.0):
+        """Flux `docker stats` synthétique : un échantillon par seconde tant que le container tourne."""
+        cpu = system = rx = 0
+        while self.status == "running" and self.name in self._api.containers._by_name:
+            previous = {"cpu_usage": {"total_usage": cpu}, "system_cpu_usage": system}
+            cpu, system, rx = cpu + 20_000_000, system + 1_000_000_000, rx + 2048
+            yield {
+                "cpu_stats": {"cpu_usage": {"total_usage": cpu}, "system_cpu_usage": system, "online_cpus": 2},
+                "precpu_stats": previous,
+                "memory_stats": {"usage": 48 << 20, "limit": 2 << 30, "stats": {"inactive_file": 8 << 20}},
+                "networks": {"eth0": {"rx_bytes": rx, "tx_bytes": rx // 2}},
+            }
+            time.sleep(interval_s)
+
+    def rename(self, new_name):
+        self._api.call()
+        by_name = self._api.containers._by_name
+        by_name.pop(self.name, None)
+        self.name = new_name
+        by_name[new_name] = self
+
+
+class _Containers:
+    def __init__(self, api: "FakeDocker"):
+        self._api = api
+        self._by_name: Dict[str, FakeContainer] = {}
+
+    def get(self, key: str) -> FakeContainer:
+        self._api.call()
+        found = self._by_name.get(key) or next((c for c in self._by_name.values() if c.id == key), None)
+        if found is None:
+            raise docker.errors.NotFound(f"No such container: {key}")
+        return found
+
+    def run(self, image, name=None, environment=None, labels=None, **kwargs) -> FakeContainer:
+        self._api.call()
+        container = FakeContainer(self._api, name, dict(labels or {}), dict(environment or {}), image)
+        self._by_name[name] = container
+        return container
+
+    def list(self, all=False, filters=None) -> List[FakeContainer]:
+        self._api.call()
+        include_stopped = all
+        wanted = [label.partition("=") for label in (filters or {}).get("label", [])]
+        out = []
+        for c in list(self._by_name.values()):
+            if (include_stopped or c.status == "running") and not any(c.labels.get(k) != v for k, _, v in wanted):
+                out.append(c)
+        return out
+
+
+class FakeDocker:
+    def __init__(self, latency_s: float = 0.0):
+        self.latency_s = latency_s
+        self.calls = 0
+        self.containers = _Containers(self)
+        self.images = types.SimpleNamespace(remove=lambda **kwargs: self.call())
+
+    def call(self):
+        self.calls += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def ping(self):
+        self.call()
+        return True
+
+    def events(self, **kwargs):
+        return iter(())
+
+    def install(self) -> "FakeDocker":
+        docker.from_env = lambda *a, **k: self
+        return self
@@ -0,0 +1,292 @@
+"""Suite de benchmarks hors-ligne (ni broker ni démon Docker : voir fakes.py).
+
+  python benchmarks/run.py                         # tout, résultats dans benchmarks/results/
+  python benchmarks/run.py --quick --only bridge   # tailles réduites, un seul benchmark
+  python benchmarks/run.py --compare benchmarks/results/<ancien>.json
+
+Chaque exécution écrit un JSON (métadonnées + mesures) nommé <date>-<commit>.json ;
+--compare affiche l'écart relatif de chaque mesure avec un résultat précédent.
+"""
+import argparse
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+# avant tout import de service : niveau de log, répertoires de données jetables
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+_TMP = pathlib.Path(tempfile.mkdtemp(prefix="iot-bench-"))
+os.environ["SIMULATOR_DATA_DIR"] = str(_TMP / "simulator")
+os.environ["ORCHESTRATOR_DATA_DIR"] = str(_TMP / "orchestrator")
+os.environ["MQTT_HOST"] = "127.0.0.1"
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+from fakes import ROOT, FakeDocker, FakeMQTT, load_service_module  # noqa: E402
+
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+
+
+def _lat(samples_s: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples_s)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e6, 2)
+    return {"p50_us": pick(0.50), "p95_us": pick(0.95), "p99_us": pick(0.99), "max_us": round(ordered[-1] * 1e6, 2)}
+
+
+def _timed(fn: Callable, *args) -> float:
+    t0 = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t0
+
+
+# --------- bridge ----------
+def bench_bridge(quick: bool, fake_mqtt: FakeMQTT, **_) -> dict:
+    bridge = load_service_module("bridge")
+    msg_of = lambda reader, door, badge: type("Msg", (), {
+        "topic": f"iot/badgeuse/{reader}/events",
+        "payload": json.dumps({"badgeID": badge, "doorID": door, "timestamp": "2024-01-01T00:00:00+00:00"}).encode(),
+    })()
+
+    def run_case(messages) -> dict:
+        samples = []
+        before = sum(fake_mqtt.published.values())
+        t0 = time.perf_counter()
+        for msg in messages:
+            s = time.perf_counter()
+            bridge.on_message(bridge.client, None, msg)
+            samples.append(time.perf_counter() - s)
+        elapsed = time.perf_counter() - t0
+        for timer in list(bridge.close_timers.values()):
+            timer.cancel()
+        bridge.close_timers.clear()
+        bridge.last_trigger_ts.clear()
+        return {
+            "messages": len(messages),
+            "msgs_per_s": round(len(messages) / elapsed, 1),
+            "published": sum(fake_mqtt.published.values()) - before,
+            **_lat(samples),
+        }
+
+    n_debounced = 2_000 if quick else 20_000
+    n_open = 200 if quick else 1_000    # une porte distincte par message : un timer d'auto-close chacun
+    # quotas désactivés (défaut) : ces deux cas mesurent le décodage, l'anti-rebond et la publication
+    bridge.shedder = bridge.LoadShedder(0, 0, 0, 0)
+    out = {
+        # rafale sur 50 portes : quasiment tout est absorbé par l'anti-rebond
+        "debounced": run_case([msg_of(f"badgeuse-{i % 200:03d}", f"porte-{i % 50:03d}", f"B{i}") for i in range(n_debounced)]),
+        # chaque message ouvre une porte : commande publiée + auto-close programmé
+        "open_path": run_case([msg_of(f"badgeuse-{i:04d}", f"porte-open-{i:05d}", f"B{i}") for i in range(n_open)]),
+    }
+    # une badgeuse qui inonde, quotas de production : rejet sur le topic seul, avant décodage
+    shedder = bridge.shedder = bridge.LoadShedder(2, 10, 200, 400)
+    out["flood_shed"] = {**run_case([msg_of("badgeuse-flood", "porte-flood", f"B{i}") for i in range(n_debounced)]),
+                         "shed": shedder.counters["shed_reader"] + shedder.counters["quarantined_msgs"]}
+    return out
+
+
+# --------- simulateur ----------
+def bench_simulator(quick: bool, **_) -> dict:
+    manager_mod = load_service_module("iotsimulator", "manager", alias="manager")
+    out = {}
+    for n in ([10, 100, 1000] if quick else [10, 100, 1000, 10_000]):
+        manager = manager_mod.DeviceManager()
+        ids = [(f"badgeuse-{i:05d}", "badgeuse", f"porte-{i:05d}") if i % 2 else (f"porte-{i:05d}", "porte", None) for i in range(n)]
+        create = _timed(lambda: [manager.ensure(kind, device_id, door) for device_id, kind, door in ids])
+        again = _timed(lambda: [manager.ensure(kind, device_id, door) for device_id, kind, door in ids])
+        list_runs = 5
+        listing = _timed(lambda: [manager.list() for _ in range(list_runs)]) / list_runs
+        remove = _timed(lambda: [manager.remove(device_id) for device_id, _, _ in ids])
+        out[str(n)] = {
+            "ensure_create_us_per_device": round(create / n * 1e6, 2),
+            "ensure_existing_us_per_device": round(again / n * 1e6, 2),
+            "list_ms": round(listing * 1e3, 3),
+            "remove_us_per_device": round(remove / n * 1e6, 2),
+        }
+    return out
+
+
+# --------- plans ----------
+def _make_plan(floor: int, nodes: int) -> dict:
+    return {
+        "id": f"floor-{floor}",
+        "name": f"Étage {floor}",
+        "width": 4000,
+        "height": 3000,
+        "walls": [{"id": f"w{i}", "x1": i * 7 % 4000, "y1": i * 13 % 3000, "x2": i * 7 % 4000 + 40, "y2": i * 13 % 3000, "thick": 8} for i in range(nodes // 2)],
+        "zones": [{"id": f"z{i}", "points": [{"x": i * 40, "y": 0}, {"x": i * 40 + 30, "y": 0}, {"x": i * 40 + 30, "y": 30}]} for i in range(max(1, nodes // 50))],
+        "nodes": [
+            {"id": f"n{i}", "kind": "badgeuse" if i % 2 else "porte", "deviceId": f"dev-{floor}-{i}", "x": i * 17 % 4000, "y": i * 29 % 3000}
+            for i in range(nodes)
+        ],
+    }
+
+
+def bench_plans(quick: bool, **_) -> dict:
+    plan_store = load_service_module("common", "plan_store", alias="plan_store")
+    plan_http = load_service_module("common", "plan_http", alias="plan_http")
+    from starlette.requests import Request
+
+    def request(**headers) -> Request:
+        raw = [(k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()]
+        return Request({"type": "http", "method": "GET", "path": "/plans", "query_string": b"", "headers": raw})
+
+    out = {}
+    floors = 5
+    for nodes in ([100, 1000] if quick else [100, 1000, 10_000]):
+        data_dir = _TMP / f"plans-{nodes}"
+        data_dir.mkdir(parents=True, exist_ok=True)
+        legacy = data_dir / "plans.json"
+        legacy.write_text(json.dumps([_make_plan(f, nodes) for f in range(floors)]), encoding="utf-8")
+
+        migrate = _timed(lambda: plan_store.PlanStore(data_dir, legacy_file=legacy))
+        load = _timed(lambda: plan_store.PlanStore(data_dir))
+        store = plan_store.PlanStore(data_dir)
+        put = _timed(lambda: store.put("floor-0", _make_plan(0, nodes)))
+        patches = 50
+        samples = []
+        for i in range(patches):
+            s = time.perf_counter()
+            store.patch("floor-0", [{"op": "replace", "path": f"/nodes/n{i}/x", "value": i}], expected_version=None)
+            samples.append(time.perf_counter() - s)
+        replay = _timed(lambda: plan_store.PlanStore(data_dir))
+
+        # GET /plans : premier appel (JSON + gzip) puis corps en cache, 304 et résumé ?fields=
+        responder = plan_http.PlanResponder(store)
+        gz = request(accept_encoding="gzip")
+        cold = _timed(lambda: responder.list(gz, None))
+        runs = 200
+        cached = _timed(lambda: [responder.list(gz, None) for _ in range(runs)]) / runs
+        etag = responder.list(gz, None).headers["etag"]
+        revalidate = _timed(lambda: [responder.list(request(if_none_match=etag), None) for _ in range(runs)]) / runs
+        summary = responder.list(request(), ("id", "name", "version"))
+        out[str(nodes)] = {
+            "floors": floors,
+            "legacy_bytes": legacy.stat().st_size,
+            "migrate_ms": round(migrate * 1e3, 2),
+            "load_ms": round(load * 1e3, 2),
+            "put_floor_ms": round(put * 1e3, 2),
+            "patch": _lat(samples),
+            "load_with_log_ms": round(replay * 1e3, 2),
+            "get_plans": {
+                "identity_bytes": len(responder.list(request(), None).body),
+                "gzip_bytes": len(responder.list(gz, None).body),
+                "summary_bytes": len(summary.body),
+                "cold_ms": round(cold * 1e3, 2),
+                "cached_us": round(cached * 1e6, 1),
+                "not_modified_us": round(revalidate * 1e6, 1),
+            },
+        }
+    return out
+
+
+# --------- orchestrateur ----------
+def bench_orchestrator(quick: bool, fake_docker: FakeDocker, **_) -> dict:
+    orch = load_service_module("orchestrator")
+    orch.mqtt_connected = True   # readiness par présence : pas de ping HTTP par container
+    out = {"docker_latency_ms": fake_docker.latency_s * 1e3}
+    for n in ([10, 100] if quick else [10, 100, 1000]):
+        fake_docker.containers._by_name.clear()
+        for i in range(n):
+            kind = "badgeuse" if i % 2 else "porte"
+            device_id = f"{kind}-{i:05d}"
+            env = {"DEVICE_ID": device_id, **({"DOOR_ID": f"porte-{i - 1:05d}"} if kind == "badgeuse" else {})}
+            fake_docker.containers.run(
+                "img", name=device_id, environment=env,
+                labels={"iot": "true", "iot.kind": kind, "iot.device_id": device_id},
+            )
+            orch._presence[device_id] = True
+        runs = 5
+        calls_before = fake_docker.calls
+        elapsed = _timed(lambda: [orch.list_devices() for _ in range(runs)]) / runs
+        out[str(n)] = {
+            "list_devices_ms": round(elapsed * 1e3, 3),
+            "docker_calls_per_list": (fake_docker.calls - calls_before) / runs,
+        }
+    return out
+
+
+BENCHMARKS = {
+    "bridge": bench_bridge,
+    "simulator": bench_simulator,
+    "plans": bench_plans,
+    "orchestrator": bench_orchestrator,
+}
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def _flatten(doc, prefix="") -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for key, value in doc.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(_flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[path] = value
+    return out
+
+
+def compare(base: dict, current: dict, threshold: float) -> None:
+    old, new = _flatten(base["benchmarks"]), _flatten(current["benchmarks"])
+    print(f"\n{'mesure':<60}{base['meta']['git']:>12}{current['meta']['git']:>12}{'écart':>10}")
+    for key in sorted(set(old) & set(new)):
+        delta = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        flag = "  <--" if abs(delta) >= threshold else ""
+        print(f"{key:<60}{old[key]:>12}{new[key]:>12}{delta:>+9.1f}%{flag}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks hors-ligne des services IoT.")
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS), help="Benchmark à lancer (répétable).")
+    parser.add_argument("--quick", action="store_true", help="Tailles réduites (vérification rapide).")
+    parser.add_argument("--docker-latency-ms", type=float, default=0.5, help="Coût simulé d'un appel API Docker (défaut: %(default)s).")
+    parser.add_argument("--out", help="Fichier JSON de sortie (défaut: benchmarks/results/<date>-<commit>.json).")
+    parser.add_argument("--compare", help="Résultat précédent à comparer (JSON).")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Écart signalé par --compare, en %% (défaut: %(default)s).")
+    args = parser.parse_args()
+
+    fake_mqtt = FakeMQTT().install()
+    fake_docker = FakeDocker(latency_s=args.docker_latency_ms / 1000).install()
+    result = {
+        "meta": {
+            "git": _git_rev(),
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "quick": args.quick,
+        },
+        "benchmarks": {},
+    }
+    try:
+        for name in args.only or list(BENCHMARKS):
+            print(f"[bench] {name} …", flush=True)
+            t0 = time.perf_counter()
+            result["benchmarks"][name] = BENCHMARKS[name](args.quick, fake_mqtt=fake_mqtt, fake_docker=fake_docker)
+            print(f"[bench] {name} ok ({time.perf_counter() - t0:.1f}s)", flush=True)
+    finally:
+        shutil.rmtree(_TMP, ignore_errors=True)
+
+    out = pathlib.Path(args.out) if args.out else RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}-{result['meta']['git']}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(json.dumps(result["benchmarks"], indent=2, ensure_ascii=False))
+    print(f"\nRésultats : {out}")
+    if args.compare:
+        compare(json.loads(pathlib.Path(args.compare).read_text(encoding="utf-8")), result, args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,24 @@
 # bridge/app.py
-import os, json, logging, threading
+import os, json, logging, threading, time
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import Optional, Dict
-from fastapi import FastAPI
+from typing import Any, Optional, Dict
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
 import uvicorn
+import sys
+# modules partagés (common/) : copiés à côté du code dans l'image Docker, lus dans le dépôt en local
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from logging_setup import setup_logging
+from profiling import install_debug_routes, timed
+from load_shedding import ADMIT, QUEUED, LoadShedder
+from reconnect import ReconnectStats, install_jittered_reconnect
 
-logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s")
-log = logging.getLogger("bridge")
+log = setup_logging("bridge")
+log_events = logging.getLogger("bridge.events")   # une ligne par badgeage / commande : échantillonnable
 
 # ---------- Config ----------
 MQTT_HOST   = os.getenv("MQTT_HOST", "mosquitto")           # "host.docker.internal" si broker hors-compose
@@ -17,6 +26,8 @@ MQTT_PORT   = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_USER   = os.getenv("MQTT_USER", "")
 MQTT_PASS   = os.getenv("MQTT_PASS", "")
 CLIENT_ID   = os.getenv("CLIENT_ID", "bridge-doors")
+# Chargé par le simulateur sur son bus en mémoire : pas de connexion au broker à l'import
+BRIDGE_EMBEDDED = os.getenv("BRIDGE_EMBEDDED", "") == "1"
 # Topics
 BADGE_EVENTS_TOPIC = os.getenv("BADGE_EVENTS_TOPIC", "iot/badgeuse/+/events")  # wildcard
 DOOR_CMDS_FMT      = os.getenv("DOOR_CMDS_FMT", "iot/porte/{door_id}/commands")
@@ -24,14 +35,46 @@ DOOR_CMDS_FMT      = os.getenv("DOOR_CMDS_FMT", "iot/porte/{door_id}/commands")
 OPEN_ACTION        = os.getenv("OPEN_ACTION", "open")        # "open" | "toggle"
 AUTO_CLOSE_SEC     = int(os.getenv("AUTO_CLOSE_SEC", "5"))   # 0 pour désactiver
 DEBOUNCE_SEC       = int(os.getenv("DEBOUNCE_SEC", "2"))     # anti-spam pour une même porte
+# Délestage (topic seul, avant décodage) : quotas par badgeuse et global, 0 = désactivé (défaut).
+# À activer en production (ex. 2/s par badgeuse, 200/s global) ; jamais pendant un test de charge
+# (POST /badge/batch, lecteurs soutenus) : on mesurerait le délesteur, pas le bridge.
+READER_RATE_PER_SEC  = float(os.getenv("READER_RATE_PER_SEC", "0"))
+READER_BURST         = float(os.getenv("READER_BURST", "10"))
+GLOBAL_RATE_PER_SEC  = float(os.getenv("GLOBAL_RATE_PER_SEC", "0"))
+GLOBAL_BURST         = float(os.getenv("GLOBAL_BURST", "400"))
+SHED_POLICY          = os.getenv("SHED_POLICY", "shed")          # "shed" (jeter) | "queue" (file bornée par badgeuse)
+SHED_QUEUE_MAX       = int(os.getenv("SHED_QUEUE_MAX", "20"))
+QUARANTINE_AFTER_SEC = float(os.getenv("QUARANTINE_AFTER_SEC", "30"))  # dépassement ininterrompu avant quarantaine (0 : jamais)
+QUARANTINE_SEC       = float(os.getenv("QUARANTINE_SEC", "300"))
 
 # ---------- État ----------
 connected = False
 last_trigger_ts: Dict[str, float] = {}     # door_id -> timestamp
-close_timers: Dict[str, threading.Timer] = {}
+close_timers: Dict[str, Any] = {}          # door_id -> timer (objet avec cancel())
+shedder = LoadShedder(READER_RATE_PER_SEC, READER_BURST, GLOBAL_RATE_PER_SEC, GLOBAL_BURST,
+                      SHED_POLICY, SHED_QUEUE_MAX, QUARANTINE_AFTER_SEC, QUARANTINE_SEC)
+_handle_lock = threading.Lock()            # callback MQTT et vidage des files (timer) : debounce cohérent
+_drain_lock = threading.Lock()
+_drain_timer = None
+
+# ---------- Horloge ----------
+class _WallClock:
+    """Horloge réelle. Le simulateur peut injecter une horloge virtuelle via attach(..., clock=)."""
+    def time(self) -> float:
+        return time.time()
+
+    def now_iso(self) -> str:
+        return datetime.now(timezone.utc).isoformat()
+
+    def call_later(self, delay: float, fn):
+        timer = threading.Timer(delay, fn)
+        timer.start()
+        return timer
+
+clock = _WallClock()
 
 def now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
+    return clock.now_iso()
 
 # ---------- MQTT callbacks ----------
 def on_connect(client, userdata, flags, reason_code, properties=None):
@@ -44,11 +87,12 @@ def on_connect(client, userdata, flags, reason_code, properties=None):
     else:
         log.error(f"[MQTT] Connect failed: {reason_code}")
 
-def on_disconnect(client, userdata, reason_code, properties=None):
+def on_disconnect(client, userdata, flags, reason_code, properties=None):
     global connected
     connected = False
     log.warning(f"[MQTT] Disconnected: {reason_code}")
 
+@timed("bridge.publish_door")
 def publish_door(client: mqtt.Client, door_id: str, action: str, badge_id: Optional[str]):
     topic = DOOR_CMDS_FMT.format(door_id=door_id)
     payload = {
@@ -58,30 +102,60 @@ def publish_door(client: mqtt.Client, door_id: str, action: str, badge_id: Optio
         "timestamp": now_iso(),
     }
     client.publish(topic, json.dumps(payload), qos=1, retain=False)
-    log.info(f"[BRIDGE] -> {topic} {payload}")
+    log_events.info("[BRIDGE] -> %s %s", topic, payload)
 
 def schedule_autoclose(client: mqtt.Client, door_id: str):
     if AUTO_CLOSE_SEC <= 0:
         return
     # Annule un timer existant si on re-tire pendant l’ouverture
     t = close_timers.get(door_id)
-    if t and t.is_alive():
+    if t:
         t.cancel()
 
     def _close():
         publish_door(client, door_id, "close", badge_id=None)
-        log.info(f"[BRIDGE] (auto-close) door={door_id}")
+        log_events.info("[BRIDGE] (auto-close) door=%s", door_id)
 
-    timer = threading.Timer(AUTO_CLOSE_SEC, _close)
-    close_timers[door_id] = timer
-    timer.start()
+    close_timers[door_id] = clock.call_later(AUTO_CLOSE_SEC, _close)
 
+def _schedule_drain(delay: float):
+    global _drain_timer
+    with _drain_lock:
+        if _drain_timer is None:
+            _drain_timer = clock.call_later(delay, _drain)
+
+def _drain():
+    """Politique "queue" : traite les badgeages en file dès que les quotas le permettent."""
+    global _drain_timer
+    with _drain_lock:
+        _drain_timer = None
+    ready, next_wait = shedder.drain(clock.time())
+    for client_, msg in ready:
+        handle_event(client_, msg)
+    if next_wait is not None:
+        _schedule_drain(max(next_wait, 0.01))
+
+@timed("bridge.on_message")
 def on_message(client, userdata, msg):
+    # Quotas décidés sur le topic seul : un flood ne coûte ni décodage JSON ni passage par le debounce
+    topic_parts = msg.topic.split("/")
+    reader_id = topic_parts[2] if len(topic_parts) >= 3 else msg.topic
+    decision = shedder.offer(reader_id, (client, msg), clock.time())
+    if decision == ADMIT:
+        handle_event(client, msg)
+    elif decision == QUEUED:
+        _schedule_drain(0.0)
+
+def handle_event(client, msg):
+    with _handle_lock:
+        _handle_event(client, msg)
+
+def _handle_event(client, msg):
     # On attend l’event JSON de la badgeuse
     try:
         data = json.loads(msg.payload.decode("utf-8"))
     except Exception:
-        log.warning(f"[MQTT] Non-JSON payload on {msg.topic}")
+        log.warning("[MQTT] Non-JSON payload on %s", msg.topic)
         return
 
     if not isinstance(data, dict):
@@ -105,28 +179,41 @@ def on_message(client, userdata, msg):
         return
 
     if not success:
-        log.info(f"[BRIDGE] Badge KO ignoré ({badge_device_id}, badge={badge_id})")
+        log_events.info("[BRIDGE] Badge KO ignoré (%s, badge=%s)", badge_device_id, badge_id)
         return
 
     if not door_id:
-        log.warning(f"[BRIDGE] Pas de doorID dans l'event (badgeuse={badge_device_id}, badge={badge_id})")
+        log.warning("[BRIDGE] Pas de doorID dans l'event (badgeuse=%s, badge=%s)", badge_device_id, badge_id)
         return
 
     # Debounce par porte
-    import time
-    now = time.time()
+    now = clock.time()
     last = last_trigger_ts.get(door_id, 0)
     if now - last < DEBOUNCE_SEC:
-        log.info(f"[BRIDGE] Debounce porte={door_id} (ignoré)")
+        log_events.info("[BRIDGE] Debounce porte=%s (ignoré)", door_id)
         return
     last_trigger_ts[door_id] = now
 
     action = OPEN_ACTION
-    log.info(f"[BRIDGE] <- {msg.topic} badge_device={badge_device_id} badge={badge_id} door={door_id} action={action}")
+    log_events.info("[BRIDGE] <- %s badge_device=%s badge=%s door=%s action=%s", msg.topic, badge_device_id, badge_id, door_id, action)
     publish_door(client, door_id, action, badge_id)
     schedule_autoclose(client, door_id)
 
 # ---------- MQTT client ----------
+def attach(mqtt_client, clock_=None):
+    """Câble les callbacks du bridge sur un client (paho, ou InprocClient du simulateur).
+
+    `clock_` remplace l'horloge réelle (debounce, auto-close, horodatage) : mode événements discrets.
+    """
+    global client, clock
+    client = mqtt_client
+    if clock_ is not None:
+        clock = clock_
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    return client
+
 client = mqtt.Client(
     callback_api_version=CallbackAPIVersion.VERSION2,
     client_id=CLIENT_ID,
@@ -135,17 +222,26 @@ client = mqtt.Client(
 if MQTT_USER:
     client.username_pw_set(MQTT_USER, MQTT_PASS)
 
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_message = on_message
-client.reconnect_delay_set(min_delay=1, max_delay=5)
-
-log.info(f"[MQTT] Connecting to {MQTT_HOST}:{MQTT_PORT} …")
-client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-client.loop_start()
+attach(client)
+# client paho seulement : en mode embarqué le simulateur rattache le bridge à son bus en mémoire
+reconnect_stats = ReconnectStats()
+install_jittered_reconnect(client, reconnect_stats)
 
 # ---------- FastAPI ----------
-app = FastAPI(title="Bridge Badgeuse -> Portes")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # HTTP disponible tout de suite : connexion MQTT (et reconnexions) dans le thread réseau de paho
+    if not BRIDGE_EMBEDDED:
+        log.info(f"[MQTT] Connecting to {MQTT_HOST}:{MQTT_PORT} …")
+        client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+        client.loop_start()
+    yield
+    if not BRIDGE_EMBEDDED:
+        client.disconnect()
+        client.loop_stop()
+
+app = FastAPI(title="Bridge Badgeuse -> Portes", lifespan=lifespan)
+install_debug_routes(app)
 
 app.add_middleware(
     CORSMiddleware,
@@ -164,7 +260,25 @@ def health():
         "door_cmds_fmt": DOOR_CMDS_FMT,
         "auto_close_sec": AUTO_CLOSE_SEC,
         "debounce_sec": DEBOUNCE_SEC,
+        "shedding": shedder.snapshot(clock.time(), top=5),
+        "reconnect": reconnect_stats.snapshot(),
     }
 
+@app.get("/shedding")
+def shedding():
+    """Compteurs de délestage, badgeuses en quarantaine (secondes restantes) et plus gros émetteurs rejetés."""
+    return shedder.snapshot(clock.time(), top=50)
+
+@app.delete("/shedding/quarantine/{reader_id}")
+def release_quarantine(reader_id: str):
+    if not shedder.release(reader_id, clock.time()):
+        raise HTTPException(status_code=404, detail="Badgeuse non mise en quarantaine")
+    return {"ok": True, "reader": reader_id}
+
+@app.get("/ready")
+def ready():
+    """Readiness : 503 tant que l'abonnement aux badgeages n'est pas actif."""
+    return JSONResponse(status_code=200 if connected else 503, content={"ready": connected, "mqtt_connected": connected})
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "9010")))
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "9010")), log_config=None)
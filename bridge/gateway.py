@@ -0,0 +1,316 @@
+# bridge/gateway.py
+"""Passerelle WebSocket pour les tableaux de bord du cockpit (remplace le MonitoringHub du mock Java).
+
+Un seul abonnement MQTT (badgeages, décisions du bridge, états des portes) diffusé à N clients :
+  - chaque client a sa file bornée ; file pleine -> le plus ancien message est jeté (compté),
+    et un client qui reste en retard trop longtemps est déconnecté (1013) au lieu de ralentir les autres ;
+  - filtres côté serveur : ws://host:9500/events?door=porte-1,porte-2&floor=rdc&type=badge_event
+    (modifiables en cours de route en envoyant {"door": [...], "floor": [...], "type": [...]}) ;
+  - à la connexion, les derniers événements (tampon circulaire) sont rejoués : ?snapshot=N, ou
+    ?since=<seq> pour reprendre après une reconnexion.
+
+Chaque message MQTT est décodé et sérialisé une seule fois (thread MQTT), la diffusion se fait
+dans la boucle asyncio sans verrou.
+"""
+import asyncio, itertools, json, logging, os, threading, urllib.request
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Deque, Dict, FrozenSet, Optional, Set, Tuple
+from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+import uvicorn
+import sys
+# modules partagés (common/) : copiés à côté du code dans l'image Docker, lus dans le dépôt en local
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from logging_setup import setup_logging
+from profiling import install_debug_routes, timed
+from reconnect import ReconnectStats, install_jittered_reconnect
+
+log = setup_logging("gateway")
+log_events = logging.getLogger("gateway.events")
+
+# ---------- Config ----------
+MQTT_HOST   = os.getenv("MQTT_HOST", "mosquitto")
+MQTT_PORT   = int(os.getenv("MQTT_PORT", "1883"))
+MQTT_USER   = os.getenv("MQTT_USER", "")
+MQTT_PASS   = os.getenv("MQTT_PASS", "")
+CLIENT_ID   = os.getenv("CLIENT_ID", "cockpit-gateway")
+TOPICS = [t.strip() for t in os.getenv(
+    "GATEWAY_TOPICS", "iot/badgeuse/+/events,iot/porte/+/commands,iot/porte/+/state").split(",") if t.strip()]
+CLIENT_QUEUE_MAX      = int(os.getenv("CLIENT_QUEUE_MAX", "256"))      # messages en attente par client
+SLOW_CLIENT_MAX_DROPS = int(os.getenv("SLOW_CLIENT_MAX_DROPS", "1000"))  # pertes consécutives avant déconnexion (0 = jamais)
+SNAPSHOT_SIZE         = int(os.getenv("SNAPSHOT_SIZE", "1000"))        # taille du tampon circulaire
+SNAPSHOT_DEFAULT      = int(os.getenv("SNAPSHOT_DEFAULT", "50"))       # rejoués à la connexion sans ?snapshot
+# Plans (orchestrateur ou simulateur) pour le filtre par étage : device_id -> plan["id"]
+PLANS_URL         = os.getenv("PLANS_URL", "")
+PLANS_REFRESH_SEC = int(os.getenv("PLANS_REFRESH_SEC", "30"))
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+# ---------- Étages ----------
+floors: Dict[str, str] = {}   # device_id (porte ou badgeuse) -> étage ; remplacé en bloc
+
+def _load_floors() -> Dict[str, str]:
+    with urllib.request.urlopen(PLANS_URL, timeout=5) as resp:
+        plans = json.loads(resp.read().decode("utf-8"))
+    out: Dict[str, str] = {}
+    for plan in plans if isinstance(plans, list) else []:
+        floor_id = str(plan.get("id") or "")
+        for node in plan.get("nodes") or []:
+            device_id = node.get("deviceId") or node.get("id")
+            if floor_id and device_id and node.get("kind") in ("badgeuse", "porte"):
+                out[device_id] = floor_id
+    return out
+
+def _floors_loop(stop: threading.Event):
+    global floors
+    while True:
+        try:
+            floors = _load_floors()
+        except Exception as e:
+            log.warning(f"[floors] {PLANS_URL} indisponible: {e}")
+        if stop.wait(PLANS_REFRESH_SEC):
+            return
+
+# ---------- Normalisation ----------
+Meta = Tuple[int, str, FrozenSet[str], Optional[str]]   # (seq, type, ids porte/device, étage)
+_seq = itertools.count(1)
+
+def _normalize(topic: str, payload: bytes) -> Optional[Tuple[Meta, str]]:
+    """Message MQTT -> événement au format MonitoringEvent du front, sérialisé une fois."""
+    parts = topic.split("/")
+    if len(parts) != 4:
+        return None
+    _, kind, device_id, leaf = parts
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    ts = data.get("timestamp") or data.get("ts") or now_iso()
+    if kind == "badgeuse" and leaf == "events":
+        inner = (data.get("data") or {}) if data.get("type") == "badge_event" else data
+        door_id = inner.get("doorID") or inner.get("door_id") or ""
+        etype = "badge_event"
+        body = {
+            "badgeID": inner.get("badgeID") or inner.get("badge_id") or inner.get("tag_id") or "",
+            "doorID": door_id,
+            "success": bool(inner.get("success", True)),
+        }
+    elif kind == "porte" and leaf == "commands":
+        door_id = data.get("doorID") or data.get("door_id") or device_id
+        etype = "door_command"
+        body = {"doorID": door_id, "action": str(data.get("action") or "").lower(), "badgeID": data.get("badgeID") or ""}
+    elif kind == "porte" and leaf == "state":
+        door_id = device_id
+        inner = data.get("data") if isinstance(data.get("data"), dict) else data
+        etype = "door_state"
+        body = {"doorID": door_id, "is_open": bool(inner.get("is_open"))}
+    else:
+        return None
+    seq = next(_seq)
+    floor = floors.get(door_id) or floors.get(device_id)
+    event = {"id": str(seq), "seq": seq, "type": etype, "ts": ts, "device_id": device_id, "floor": floor, "data": body}
+    return (seq, etype, frozenset(filter(None, (door_id, device_id))), floor), json.dumps(event)
+
+# ---------- Diffusion ----------
+def _csv(value) -> Optional[Set[str]]:
+    if isinstance(value, list):
+        items = {str(v) for v in value if v}
+    else:
+        items = {v.strip() for v in str(value or "").split(",") if v.strip()}
+    return items or None
+
+class _Subscriber:
+    def __init__(self, ws: WebSocket, doors: Optional[Set[str]], floors_: Optional[Set[str]], types: Optional[Set[str]]):
+        self.ws = ws
+        self.doors, self.floors, self.types = doors, floors_, types
+        self.queue: Deque[str] = deque()
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.drop_streak = 0
+        self.sent = 0
+        self.closing = False
+
+    def accepts(self, meta: Meta) -> bool:
+        _, etype, ids, floor = meta
+        if self.types and etype not in self.types:
+            return False
+        if self.doors and self.doors.isdisjoint(ids):
+            return False
+        if self.floors and floor not in self.floors:
+            return False
+        return True
+
+    def push(self, text: str) -> bool:
+        """False si le client est en retard depuis trop longtemps (à déconnecter)."""
+        if len(self.queue) >= CLIENT_QUEUE_MAX:
+            self.queue.popleft()
+            self.dropped += 1
+            self.drop_streak += 1
+            if SLOW_CLIENT_MAX_DROPS and self.drop_streak >= SLOW_CLIENT_MAX_DROPS:
+                return False
+        self.queue.append(text)
+        self.wakeup.set()
+        return True
+
+    def set_filters(self, raw: str):
+        try:
+            spec = json.loads(raw)
+        except ValueError:
+            return
+        if isinstance(spec, dict):
+            self.doors, self.floors, self.types = _csv(spec.get("door")), _csv(spec.get("floor")), _csv(spec.get("type"))
+
+    async def pump(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.closing:
+                await self.ws.close(code=1013, reason="slow consumer")
+                return
+            while self.queue:
+                await self.ws.send_text(self.queue.popleft())
+                self.sent += 1
+            self.drop_streak = 0   # file vidée : le client a rattrapé son retard
+
+class Hub:
+    """Tout s'exécute dans la boucle asyncio : pas de verrou, ni d'envoi sous verrou."""
+
+    def __init__(self):
+        self.subscribers: Set[_Subscriber] = set()
+        self.ring: Deque[Tuple[Meta, str]] = deque(maxlen=SNAPSHOT_SIZE)
+        self.stats = {"received": 0, "delivered": 0, "dropped": 0, "slow_disconnects": 0}
+
+    def publish(self, meta: Meta, text: str):
+        self.ring.append((meta, text))
+        self.stats["received"] += 1
+        slow = []
+        for sub in self.subscribers:
+            if sub.accepts(meta):
+                before = sub.dropped
+                if not sub.push(text):
+                    slow.append(sub)
+                self.stats["delivered"] += 1
+                self.stats["dropped"] += sub.dropped - before
+        for sub in slow:
+            self.subscribers.discard(sub)
+            sub.closing = True
+            sub.wakeup.set()
+            self.stats["slow_disconnects"] += 1
+            log.warning(f"[ws] client lent déconnecté ({sub.dropped} message(s) perdu(s))")
+
+    def attach(self, sub: _Subscriber, snapshot: int, since: Optional[int]):
+        """Rejoue le tampon (filtré) puis abonne : même tour de boucle, ni trou ni doublon."""
+        if since is not None:
+            backlog = [text for meta, text in self.ring if meta[0] > since and sub.accepts(meta)]
+        else:
+            backlog = [text for meta, text in self.ring if sub.accepts(meta)][-snapshot:] if snapshot > 0 else []
+        for text in backlog[-CLIENT_QUEUE_MAX:]:
+            sub.queue.append(text)
+        if sub.queue:
+            sub.wakeup.set()
+        self.subscribers.add(sub)
+
+    def detach(self, sub: _Subscriber):
+        self.subscribers.discard(sub)
+
+hub = Hub()
+loop: Optional[asyncio.AbstractEventLoop] = None
+
+# ---------- MQTT ----------
+connected = False
+
+def on_connect(client, userdata, flags, reason_code, properties=None):
+    global connected
+    connected = (reason_code == 0)
+    if connected:
+        client.subscribe([(t, 0) for t in TOPICS])
+        log.info(f"[MQTT] Connected to {MQTT_HOST}:{MQTT_PORT}, subscribed {', '.join(TOPICS)}")
+    else:
+        log.error(f"[MQTT] Connect failed: {reason_code}")
+
+def on_disconnect(client, userdata, flags, reason_code, properties=None):
+    global connected
+    connected = False
+    log.warning(f"[MQTT] Disconnected: {reason_code}")
+
+@timed("gateway.on_message")
+def on_message(client, userdata, msg):
+    normalized = _normalize(msg.topic, msg.payload)
+    if normalized is None or loop is None:
+        return
+    log_events.debug("[gateway] <- %s", msg.topic)
+    loop.call_soon_threadsafe(hub.publish, *normalized)
+
+client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id=CLIENT_ID, protocol=mqtt.MQTTv311)
+if MQTT_USER:
+    client.username_pw_set(MQTT_USER, MQTT_PASS)
+client.on_connect = on_connect
+client.on_disconnect = on_disconnect
+client.on_message = on_message
+reconnect_stats = ReconnectStats()
+install_jittered_reconnect(client, reconnect_stats)
+
+# ---------- FastAPI ----------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global loop
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+    if PLANS_URL:
+        threading.Thread(target=_floors_loop, args=(stop,), daemon=True, name="floors").start()
+    log.info(f"[MQTT] Connecting to {MQTT_HOST}:{MQTT_PORT} …")
+    client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+    client.loop_start()
+    yield
+    stop.set()
+    client.loop_stop()
+    client.disconnect()
+
+app = FastAPI(title="Cockpit gateway (MQTT -> WebSocket)", lifespan=lifespan)
+install_debug_routes(app)
+
+@app.websocket("/events")
+async def events(
+    ws: WebSocket,
+    door: str = "",
+    floor: str = "",
+    types: str = Query("", alias="type"),
+    snapshot: int = SNAPSHOT_DEFAULT,
+    since: Optional[int] = None,
+):
+    await ws.accept()
+    sub = _Subscriber(ws, _csv(door), _csv(floor), _csv(types))
+    hub.attach(sub, snapshot, since)
+    log.info(f"[ws] client connecté ({len(hub.subscribers)} au total)")
+    sender = asyncio.create_task(sub.pump())
+    try:
+        while True:
+            sub.set_filters(await ws.receive_text())
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        hub.detach(sub)
+        sender.cancel()
+        log.info(f"[ws] client déconnecté ({len(hub.subscribers)} restant(s), {sub.dropped} perdu(s))")
+
+@app.get("/health")
+def health():
+    return {
+        "ok": True,
+        "mqtt_connected": connected,
+        "topics": TOPICS,
+        "clients": len(hub.subscribers),
+        "buffered": len(hub.ring),
+        "floors_known": len(floors),
+        "reconnect": reconnect_stats.snapshot(),
+        **hub.stats,
+    }
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "9500")), log_config=None)
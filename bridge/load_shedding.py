@@ -0,0 +1,251 @@
+"""Délestage des badgeages par badgeuse, décidé sur le topic seul (avant tout décodage du payload).
+
+Deux seaux à jetons : un par badgeuse (id extrait du topic) et un global pour le bridge.
+Un message hors quota est soit jeté (politique "shed"), soit mis dans la file bornée de sa
+badgeuse (politique "queue") ; les files sont vidées à tour de rôle (round-robin) au rythme
+des jetons, donc une badgeuse qui inonde le bridge ne passe jamais devant les autres.
+
+Une badgeuse qui dépasse son quota sans interruption pendant `quarantine_after` secondes est
+mise en quarantaine `quarantine_for` secondes : ses messages sont jetés dès la lecture du topic.
+Le temps est fourni par l'appelant (`now`) : horloge réelle ou horloge virtuelle du simulateur.
+"""
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+log = logging.getLogger("bridge")
+
+ADMIT, QUEUED, SHED, QUARANTINED = "admit", "queued", "shed", "quarantined"
+IDLE_EVICT_SEC = 300.0     # badgeuse inactive oubliée
+MAX_TRACKED = 10_000       # plafond dur de la table (ids arbitraires dans les topics) : LRU au-delà
+STREAK_GAP_SEC = 2.0       # pause entre deux refus qui remet le compteur de dépassement à zéro
+
+
+class TokenBucket:
+    """`rate` jetons/s, au plus `burst` ; rate <= 0 : illimité."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate, self.burst = rate, max(1.0, burst)
+        self.tokens = self.burst
+        self.stamp = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = max(self.stamp, now)
+
+    def take(self, now: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def give_back(self) -> None:
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def wait(self, now: float) -> float:
+        """Secondes avant le prochain jeton."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class _Reader:
+    __slots__ = ("bucket", "queue", "over_since", "over_last", "quarantined_until", "shed", "last_seen")
+
+    def __init__(self, bucket: TokenBucket, now: float):
+        self.bucket = bucket
+        self.queue: Deque[Any] = deque()
+        self.over_since: Optional[float] = None   # début du dépassement ininterrompu en cours
+        self.over_last = 0.0
+        self.quarantined_until = 0.0
+        self.shed = 0
+        self.last_seen = now
+
+
+class LoadShedder:
+    def __init__(
+        self,
+        reader_rate: float,
+        reader_burst: float,
+        global_rate: float,
+        global_burst: float,
+        policy: str = "shed",
+        queue_max: int = 20,
+        quarantine_after: float = 30.0,
+        quarantine_for: float = 300.0,
+    ):
+        if policy not in ("shed", "queue"):
+            raise ValueError(f"politique de délestage inconnue : {policy!r} (shed | queue)")
+        self.reader_rate, self.reader_burst = reader_rate, reader_burst
+        self.policy = policy
+        self.queue_max = queue_max
+        self.quarantine_after = quarantine_after
+        self.quarantine_for = quarantine_for
+        self._global = TokenBucket(global_rate, global_burst, 0.0)
+        self._readers: "OrderedDict[str, _Reader]" = OrderedDict()   # du moins au plus récemment vu
+        self._backlog: Deque[str] = deque()       # badgeuses ayant une file non vide (tour de rôle)
+        self._lock = threading.Lock()
+        self.counters = {
+            "admitted": 0, "shed_reader": 0, "shed_global": 0, "queued": 0, "dequeued": 0,
+            "queue_overflow": 0, "quarantined_msgs": 0, "quarantines": 0, "evicted_readers": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.reader_rate > 0 or self._global.rate > 0
+
+    def _reader(self, reader_id: str, now: float) -> _Reader:
+        reader = self._readers.get(reader_id)
+        if reader is None:
+            self._evict(now)
+            reader = self._readers[reader_id] = _Reader(TokenBucket(self.reader_rate, self.reader_burst, now), now)
+        else:
+            self._readers.move_to_end(reader_id)
+        reader.last_seen = now
+        return reader
+
+    def _evict(self, now: float) -> None:
+        """O(1) amorti : on ne regarde que la tête (badgeuse la moins récemment vue)."""
+        readers = self._readers
+        while readers:
+            oldest = next(iter(readers.values()))
+            if len(readers) < MAX_TRACKED and (now - oldest.last_seen <= IDLE_EVICT_SEC or oldest.queue or oldest.quarantined_until > now):
+                return
+            # plafond atteint : la plus ancienne sort, même en file ou en quarantaine (une badgeuse
+            # qui inonde le bridge reste en fin de table, elle n'est jamais la plus ancienne)
+            readers.popitem(last=False)
+            self.counters["evicted_readers"] += 1
+            if oldest.queue:
+                self.counters["queue_overflow"] += len(oldest.queue)
+
+    def _strike(self, reader_id: str, reader: _Reader, now: float) -> bool:
+        """Dépassement du quota de la badgeuse ; True si elle passe en quarantaine.
+
+        Le dépassement est « ininterrompu » tant que deux refus sont séparés de moins de
+        STREAK_GAP_SEC (ou de deux périodes de jeton si le quota est très bas).
+        """
+        gap = max(STREAK_GAP_SEC, 2 / self.reader_rate) if self.reader_rate > 0 else STREAK_GAP_SEC
+        if reader.over_since is None or now - reader.over_last > gap:
+            reader.over_since = now
+        reader.over_last = now
+        if self.quarantine_after <= 0 or now - reader.over_since < self.quarantine_after:
+            return False
+        reader.quarantined_until = now + self.quarantine_for
+        reader.over_since = None
+        self.counters["quarantines"] += 1
+        self.counters["quarantined_msgs"] += len(reader.queue)
+        reader.queue.clear()
+        log.warning("[SHED] badgeuse %s en quarantaine %.0fs (quota %.1f/s dépassé depuis %.0fs)",
+                    reader_id, self.quarantine_for, self.reader_rate, self.quarantine_after)
+        return True
+
+    def _overflow(self, reader_id: str, reader: _Reader, item: Any, counter: str) -> str:
+        if self.policy == "queue":
+            if len(reader.queue) < self.queue_max:
+                if not reader.queue:
+                    self._backlog.append(reader_id)
+                reader.queue.append(item)
+                self.counters["queued"] += 1
+                return QUEUED
+            self.counters["queue_overflow"] += 1
+        self.counters[counter] += 1
+        reader.shed += 1
+        return SHED
+
+    def offer(self, reader_id: str, item: Any, now: float) -> str:
+        """Décision pour un message reçu : ADMIT (à traiter tout de suite), QUEUED, SHED, QUARANTINED."""
+        if not self.enabled:
+            return ADMIT   # délestage désactivé : ni verrou ni suivi des badgeuses
+        with self._lock:
+            reader = self._reader(reader_id, now)
+            if reader.quarantined_until:
+                if now < reader.quarantined_until:
+                    self.counters["quarantined_msgs"] += 1
+                    return QUARANTINED
+                reader.quarantined_until = 0.0
+                reader.bucket = TokenBucket(self.reader_rate, self.reader_burst, now)
+                log.info("[SHED] badgeuse %s sortie de quarantaine", reader_id)
+            if reader.queue:
+                # FIFO par badgeuse : rien ne double les messages en attente ; pénalité seulement
+                # si c'est son propre quota qui bloque la file (pas une saturation globale)
+                own_quota = reader.bucket.wait(now) > 0
+                if own_quota and self._strike(reader_id, reader, now):
+                    self.counters["quarantined_msgs"] += 1
+                    return QUARANTINED
+                return self._overflow(reader_id, reader, item, "shed_reader" if own_quota else "shed_global")
+            if not reader.bucket.take(now):
+                if self._strike(reader_id, reader, now):
+                    self.counters["quarantined_msgs"] += 1
+                    return QUARANTINED
+                return self._overflow(reader_id, reader, item, "shed_reader")
+            if not self._global.take(now):
+                reader.bucket.give_back()   # la badgeuse n'y est pour rien : pas de pénalité
+                return self._overflow(reader_id, reader, item, "shed_global")
+            self.counters["admitted"] += 1
+            return ADMIT
+
+    def drain(self, now: float) -> Tuple[List[Any], Optional[float]]:
+        """Messages en file libérables maintenant (tour de rôle) et délai avant le prochain essai."""
+        ready: List[Any] = []
+        next_wait: Optional[float] = None
+        progress = True
+        with self._lock:
+            # une passe = au plus un message par badgeuse ; on repasse tant que des jetons restent
+            while progress and self._backlog:
+                progress, next_wait = False, None
+                for _ in range(len(self._backlog)):
+                    reader_id = self._backlog.popleft()
+                    reader = self._readers.get(reader_id)
+                    if reader is None or not reader.queue:
+                        continue
+                    wait = reader.bucket.wait(now)
+                    if wait <= 0:
+                        if self._global.take(now):
+                            reader.bucket.take(now)
+                            ready.append(reader.queue.popleft())
+                            self.counters["dequeued"] += 1
+                            progress = True
+                        else:
+                            wait = self._global.wait(now)
+                    if reader.queue:
+                        self._backlog.append(reader_id)
+                        next_wait = wait if next_wait is None else min(next_wait, wait)
+        return ready, next_wait
+
+    def release(self, reader_id: str, now: float) -> bool:
+        """Levée manuelle d'une quarantaine en cours."""
+        with self._lock:
+            reader = self._readers.get(reader_id)
+            if reader is None or reader.quarantined_until <= now:
+                return False
+            reader.quarantined_until = 0.0
+            reader.over_since = None
+            reader.bucket = TokenBucket(self.reader_rate, self.reader_burst, now)
+        log.info("[SHED] quarantaine levée manuellement : %s", reader_id)
+        return True
+
+    def snapshot(self, now: float, top: int = 10) -> Dict:
+        with self._lock:
+            quarantined = {rid: round(r.quarantined_until - now, 1) for rid, r in self._readers.items() if r.quarantined_until > now}
+            offenders = sorted(((r.shed, rid) for rid, r in self._readers.items() if r.shed), reverse=True)[:top]
+            queued = sum(len(r.queue) for r in self._readers.values())
+            return {
+                "enabled": self.enabled,
+                "policy": self.policy,
+                "reader": {"rate": self.reader_rate, "burst": self.reader_burst},
+                "global": {"rate": self._global.rate, "burst": self._global.burst},
+                **self.counters,
+                "queue_depth": queued,
+                "tracked_readers": len(self._readers),
+                "quarantined": quarantined,
+                "top_shed": [{"reader": rid, "shed": n} for n, rid in offenders],
+            }
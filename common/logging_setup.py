@@ -0,0 +1,181 @@
+"""Logging commun aux services Python : file d'attente + écrivain en arrière-plan, échantillonnage
+et limitation de débit par catégorie (préfixe de logger), sortie texte ou JSON.
+
+Variables d'environnement :
+  LOG_LEVEL       niveau racine (INFO)
+  LOG_FORMAT      "text" ou "json"
+  LOG_QUEUE_SIZE  taille de la file ; pleine -> message perdu et compté (10000)
+  LOG_RATE        messages/s par catégorie, ex. "*=200,badgeuse.mqtt=20" (0 = illimité)
+  LOG_SAMPLE      fraction conservée par catégorie, ex. "bridge.events=0.01"
+
+Les catégories sont des préfixes de noms de loggers (le plus long l'emporte). WARNING et au-delà
+ne sont jamais échantillonnés ni limités. Le formatage (%-style) se fait dans le thread écrivain :
+les appels doivent passer leurs arguments (`log.info("x=%s", x)`) plutôt qu'une f-string.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+_TEXT_FORMAT = "[%(asctime)s] %(levelname)s %(name)s: %(message)s"
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional["_DroppingQueueHandler"] = None
+_filter: Optional["_CategoryFilter"] = None
+
+
+def _parse_spec(raw: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for part in (raw or "").split(","):
+        name, sep, value = part.strip().partition("=")
+        if not sep:
+            continue
+        try:
+            out[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return out
+
+
+def _lookup(spec: Dict[str, float], name: str) -> Tuple[str, Optional[float]]:
+    """(catégorie, valeur) : le préfixe configuré le plus long qui couvre `name`, sinon "*"."""
+    best, category = spec.get("*"), "*"
+    for prefix, value in spec.items():
+        if prefix != "*" and (name == prefix or name.startswith(prefix + ".")) and len(prefix) > len(category):
+            best, category = value, prefix
+    return category, best
+
+
+class _CategoryFilter(logging.Filter):
+    """Échantillonnage déterministe (1 sur N) puis seau à jetons par catégorie."""
+
+    def __init__(self, rates: Dict[str, float], samples: Dict[str, float]):
+        super().__init__()
+        self._rates, self._samples = rates, samples
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Tuple[float, float]] = {}   # catégorie -> (jetons, dernier refill)
+        self._seen: Dict[str, int] = {}
+        self._suppressed: Dict[str, int] = {}    # écartés depuis le dernier message émis
+        self._total: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        # quotas partagés par catégorie (préfixe configuré), pas par logger : les loggers enfants
+        # d'une catégorie consomment le même seau
+        sample_cat, sample = _lookup(self._samples, record.name)
+        rate_cat, rate = _lookup(self._rates, record.name)
+        with self._lock:
+            if sample is not None and sample < 1:
+                seen = self._seen.get(sample_cat, 0)
+                self._seen[sample_cat] = seen + 1
+                if sample <= 0 or seen % max(1, round(1 / sample)):
+                    self._drop(sample_cat)
+                    return False
+            if rate:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(rate_cat, (rate, now))
+                tokens = min(rate, tokens + (now - last) * rate)
+                if tokens < 1:
+                    self._buckets[rate_cat] = (tokens, now)
+                    self._drop(rate_cat)
+                    return False
+                self._buckets[rate_cat] = (tokens - 1, now)
+            # signale au passage combien de messages de la catégorie ont été écartés depuis le dernier
+            record.suppressed = self._suppressed.pop(rate_cat, 0) + (self._suppressed.pop(sample_cat, 0) if sample_cat != rate_cat else 0)
+        return True
+
+    def _drop(self, name: str) -> None:
+        self._suppressed[name] = self._suppressed.get(name, 0) + 1
+        self._total[name] = self._total.get(name, 0) + 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._total)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler non bloquant, sans formatage dans le thread appelant."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # le formatage (msg % args, traceback) est laissé au thread écrivain
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} (+{suppressed} écartés)" if suppressed else text
+
+
+class _JsonFormatter(logging.Formatter):
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "suppressed", 0):
+            doc["suppressed"] = record.suppressed
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, ensure_ascii=False)
+
+
+def setup_logging(service: str) -> logging.Logger:
+    """Installe (une seule fois par process) le handler racine asynchrone ; renvoie le logger du service."""
+    global _listener, _handler, _filter
+    if _listener is None:
+        level = os.getenv("LOG_LEVEL", "INFO").upper()
+        q: queue.Queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+        writer = logging.StreamHandler()
+        if os.getenv("LOG_FORMAT", "text").lower() == "json":
+            writer.setFormatter(_JsonFormatter(service))
+        else:
+            writer.setFormatter(_TextFormatter(_TEXT_FORMAT))
+        _filter = _CategoryFilter(_parse_spec(os.getenv("LOG_RATE", "*=200")), _parse_spec(os.getenv("LOG_SAMPLE", "")))
+        _handler = _DroppingQueueHandler(q)
+        _handler.addFilter(_filter)
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(_handler)
+        root.setLevel(level)
+        # uvicorn passe par la même file (sinon ses handlers écrivent en synchrone)
+        for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+            logging.getLogger(name).handlers = []
+            logging.getLogger(name).propagate = True
+        _listener = logging.handlers.QueueListener(q, writer, respect_handler_level=False)
+        _listener.start()
+        atexit.register(_listener.stop)
+    return logging.getLogger(service)
+
+
+def logging_stats() -> Dict[str, object]:
+    return {
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped": _handler.dropped if _handler else 0,
+        "suppressed": _filter.stats() if _filter else {},
+    }
@@ -0,0 +1,165 @@
+"""Réponses HTTP des plans : projection de champs, ETag fort, 304 et corps compressés en cache.
+
+- `GET /plans?fields=id,name` : liste d'étages réduite aux champs demandés (sans la géométrie).
+- ETag fort dérivé des versions (un étage : sa version ; la liste : versions de tous les étages +
+  champs demandés). Une représentation compressée a son propre ETag (suffixe -gzip / -br) ;
+  If-None-Match compare la partie commune, donc un client qui change d'Accept-Encoding reçoit
+  toujours 304 tant que le plan n'a pas changé.
+- gzip (et brotli si le module est installé) au-delà de PLAN_COMPRESS_MIN_BYTES. Le JSON et
+  chaque encodage sont calculés une fois par version puis servis depuis le cache.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:   # dépendance optionnelle : gzip seul
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv("PLAN_COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 6
+LIST_CACHE_SIZE = 32       # combinaisons de `fields` gardées en cache
+
+
+def parse_fields(raw: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """"id,name" -> ("id", "name") ; None si absent. ValueError si la liste est vide."""
+    if raw is None:
+        return None
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+    if not fields:
+        raise ValueError("fields vide")
+    return fields
+
+
+def _pick_coding(accept: str) -> Optional[str]:
+    prefs: Dict[str, float] = {}
+    for part in accept.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if token:
+            prefs[token.strip().lower()] = q
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if prefs.get(coding, prefs.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+class _Body:
+    """JSON d'une version + ses encodages, calculés à la première demande."""
+
+    __slots__ = ("tag", "raw", "encoded", "_lock")
+
+    def __init__(self, tag: str, doc: Any):
+        self.tag = tag
+        self.raw = json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.encoded: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def get(self, coding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        if coding is None or len(self.raw) < COMPRESS_MIN_BYTES:
+            return self.raw, None
+        with self._lock:
+            body = self.encoded.get(coding)
+            if body is None:
+                if coding == "br":
+                    body = brotli.compress(self.raw, quality=BROTLI_QUALITY)
+                else:
+                    body = gzip.compress(self.raw, compresslevel=GZIP_LEVEL, mtime=0)
+                self.encoded[coding] = body
+        return body, coding
+
+
+def _matches(if_none_match: Optional[str], tag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        candidate = candidate.removeprefix("W/").strip('"')
+        for suffix in ("-gzip", "-br"):
+            candidate = candidate.removesuffix(suffix)
+        if candidate == tag:
+            return True
+    return False
+
+
+def _respond(request: Request, body: _Body) -> Response:
+    coding = _pick_coding(request.headers.get("accept-encoding", ""))
+    payload, applied = body.get(coding)
+    headers = {
+        "ETag": f'"{body.tag}-{applied}"' if applied else f'"{body.tag}"',
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",   # le client garde sa copie mais revalide (304) à chaque fois
+    }
+    if _matches(request.headers.get("if-none-match"), body.tag):
+        return Response(status_code=304, headers=headers)
+    if applied:
+        headers["Content-Encoding"] = applied
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class PlanResponder:
+    """Réponses de GET /plans et GET /plans/{id} pour un PlanStore."""
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._floors: Dict[str, _Body] = {}                     # floor_id -> corps de la version courante
+        self._lists: "OrderedDict[Tuple, _Body]" = OrderedDict()   # (fields, versions) -> corps
+
+    def floor(self, request: Request, floor_id: str) -> Optional[Response]:
+        """None si l'étage n'existe pas."""
+        plan = self._store.get(floor_id)
+        if plan is None:
+            return None
+        tag = f"v{int(plan.get('version', 0))}-{_digest(floor_id)}"
+        with self._lock:
+            body = self._floors.get(floor_id)
+        if body is None or body.tag != tag:
+            body = _Body(tag, plan)
+            with self._lock:
+                self._floors[floor_id] = body
+        return _respond(request, body)
+
+    def list(self, request: Request, fields: Optional[Tuple[str, ...]]) -> Response:
+        key = (fields, tuple(self._store.versions()))
+        with self._lock:
+            body = self._lists.get(key)
+            if body is not None:
+                self._lists.move_to_end(key)
+        if body is None:
+            plans: List[Dict[str, Any]] = self._store.list()
+            doc = plans if fields is None else [{f: p[f] for f in fields if f in p} for p in plans]
+            body = _Body(f"l-{_digest(repr(key))}", doc)
+            if tuple(self._store.versions()) != key[1]:
+                return _respond(request, body)   # écriture concurrente : corps servi mais pas mis en cache
+            with self._lock:
+                # une seule entrée par projection : la précédente version de la liste est périmée
+                for stale in [k for k in self._lists if k[0] == fields]:
+                    del self._lists[stale]
+                self._lists[key] = body
+                while len(self._lists) > LIST_CACHE_SIZE:
+                    self._lists.popitem(last=False)
+        return _respond(request, body)
@@ -0,0 +1,255 @@
+"""Stockage des plans d'étage : un snapshot + un journal de patchs append-only par étage."""
+import json
+import logging
+import os
+import pathlib
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+log = logging.getLogger("plan_store")
+
+COMPACT_EVERY = int(os.getenv("PLAN_LOG_COMPACT_EVERY", "100"))
+COLLECTIONS = {"walls": "walls", "zones": "zones", "nodes": "nodes", "devices": "nodes"}
+READ_ONLY_KEYS = {"id", "version"}
+
+
+class PlanConflict(Exception):
+    def __init__(self, current: int):
+        super().__init__(f"version mismatch (current={current})")
+        self.current = current
+
+
+class PlanPatchError(ValueError):
+    pass
+
+
+def _apply_op(plan: Dict[str, Any], op: Dict[str, Any]) -> None:
+    kind = op.get("op")
+    parts = [p for p in str(op.get("path", "")).split("/") if p]
+    if kind not in {"add", "replace", "remove"} or not parts:
+        raise PlanPatchError(f"opération invalide: {op!r}")
+
+    if parts[0] not in COLLECTIONS:
+        # propriété simple de l'étage (name, width, height, simPersons…)
+        if len(parts) != 1 or parts[0] in READ_ONLY_KEYS:
+            raise PlanPatchError(f"chemin non modifiable: {op['path']}")
+        if kind == "remove":
+            plan.pop(parts[0], None)
+        else:
+            plan[parts[0]] = op.get("value")
+        return
+
+    key = COLLECTIONS[parts[0]]
+    if len(parts) < 2:
+        raise PlanPatchError(f"identifiant manquant: {op['path']}")
+    item_id = parts[1]
+    items: List[Dict[str, Any]] = list(plan.get(key) or [])  # copie : les lecteurs gardent l'ancienne liste
+    idx = next((i for i, it in enumerate(items) if str(it.get("id")) == item_id), None)
+
+    if len(parts) == 2:
+        if kind == "remove":
+            if idx is None:
+                raise PlanPatchError(f"{op['path']} introuvable")
+            items.pop(idx)
+        else:
+            value = op.get("value")
+            if not isinstance(value, dict):
+                raise PlanPatchError(f"objet attendu pour {op['path']}")
+            value = {**value, "id": value.get("id", item_id)}
+            if idx is not None:
+                items[idx] = value
+            elif kind == "add":
+                items.append(value)
+            else:
+                raise PlanPatchError(f"{op['path']} introuvable")
+    elif len(parts) == 3:
+        if idx is None:
+            raise PlanPatchError(f"{op['path']} introuvable")
+        field = parts[2]
+        if field == "id":
+            raise PlanPatchError("l'id d'un élément n'est pas modifiable")
+        item = dict(items[idx])
+        if kind == "remove":
+            item.pop(field, None)
+        else:
+            item[field] = op.get("value")
+        items[idx] = item
+    else:
+        raise PlanPatchError(f"chemin trop profond: {op['path']}")
+    plan[key] = items
+
+
+def apply_patch(plan: Dict[str, Any], ops: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Applique les opérations sur une copie du plan (le plan d'origine n'est jamais modifié)."""
+    new_plan = dict(plan)
+    for op in ops:
+        _apply_op(new_plan, op)
+    return new_plan
+
+
+class PlanStore:
+    """Plans en mémoire ; sur disque `floors/<id>.json` (snapshot) + `floors/<id>.log.jsonl` (patchs)."""
+
+    def __init__(self, data_dir: pathlib.Path, legacy_file: Optional[pathlib.Path] = None,
+                 validate: Optional[Callable[[Dict[str, Any], Optional[List[Dict[str, Any]]]], None]] = None):
+        """`validate(plan, ops)` vérifie un plan avant écriture (ops=None pour un remplacement) ;
+        une ValueError refuse l'écriture avec PlanPatchError."""
+        self._dir = data_dir / "floors"
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._index_file = self._dir / "index.json"
+        self._lock = threading.Lock()
+        # pris par les écritures avant _lock et gardé pendant la notification : les listeners
+        # reçoivent les versions d'un étage dans l'ordre, sans bloquer les lectures (get/list)
+        self._notify_lock = threading.RLock()
+        self._plans: Dict[str, Dict[str, Any]] = {}
+        self._log_len: Dict[str, int] = {}
+        self._listeners: List[Any] = []
+        self._validate = validate
+        if self._index_file.exists():
+            self._load()
+        elif legacy_file and legacy_file.exists():
+            self._migrate(legacy_file)
+
+    # --- persistance -------------------------------------------------------
+    def _snapshot_path(self, floor_id: str) -> pathlib.Path:
+        return self._dir / f"{quote(floor_id, safe='')}.json"
+
+    def _log_path(self, floor_id: str) -> pathlib.Path:
+        return self._dir / f"{quote(floor_id, safe='')}.log.jsonl"
+
+    @staticmethod
+    def _write_atomic(path: pathlib.Path, text: str) -> None:
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path)
+
+    def _write_index(self) -> None:
+        self._write_atomic(self._index_file, json.dumps(list(self._plans), ensure_ascii=False))
+
+    def _write_snapshot(self, floor_id: str) -> None:
+        self._write_atomic(self._snapshot_path(floor_id), json.dumps(self._plans[floor_id], ensure_ascii=False))
+        self._log_path(floor_id).unlink(missing_ok=True)
+        self._log_len[floor_id] = 0
+
+    def _load(self) -> None:
+        for floor_id in json.loads(self._index_file.read_text(encoding="utf-8")):
+            snap = self._snapshot_path(floor_id)
+            if not snap.exists():
+                continue
+            plan = json.loads(snap.read_text(encoding="utf-8"))
+            replayed = 0
+            log_path = self._log_path(floor_id)
+            if log_path.exists():
+                raw = log_path.read_bytes()
+                good = 0   # octets du journal couverts par des lignes complètes et valides
+                for line in raw.splitlines(keepends=True):
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("ligne sans fin")
+                        entry = json.loads(line)
+                        if entry["version"] > plan.get("version", 0):
+                            plan = apply_patch(plan, entry["ops"])
+                            plan["version"] = entry["version"]
+                            replayed += 1
+                    except (ValueError, KeyError, TypeError):
+                        break
+                    good += len(line)
+                if good < len(raw):
+                    # coupe la fin illisible : sinon les patchs suivants s'ajoutent derrière (voire
+                    # dans la ligne partielle) et sont perdus au prochain rechargement
+                    log.warning("Journal %s : %d octet(s) illisible(s) tronqué(s) après la version %s",
+                                log_path, len(raw) - good, plan.get("version", 0))
+                    with log_path.open("r+b") as fh:
+                        fh.truncate(good)
+            self._plans[floor_id] = plan
+            self._log_len[floor_id] = replayed
+
+    def _migrate(self, legacy_file: pathlib.Path) -> None:
+        try:
+            plans = json.loads(legacy_file.read_text(encoding="utf-8"))
+        except Exception:
+            log.exception("Impossible de lire %s", legacy_file)
+            return
+        for plan in plans:
+            if plan.get("id"):
+                plan.setdefault("version", 1)
+                self._plans[plan["id"]] = plan
+                self._write_snapshot(plan["id"])
+        self._write_index()
+        log.info("%d plan(s) migrés depuis %s vers %s", len(self._plans), legacy_file, self._dir)
+
+    # --- API ---------------------------------------------------------------
+    def subscribe(self, callback) -> None:
+        """callback(floor_id, plan, ops) appelé après chaque écriture (ops=None pour un remplacement),
+        dans l'ordre des versions ; le callback peut relire le store."""
+        self._listeners.append(callback)
+
+    def _notify(self, floor_id: str, plan: Dict[str, Any], ops: Optional[List[Dict[str, Any]]]) -> None:
+        for callback in self._listeners:
+            try:
+                callback(floor_id, plan, ops)
+            except Exception:
+                log.exception("Listener de plan en erreur (%s)", floor_id)
+
+    def _check(self, plan: Dict[str, Any], ops: Optional[List[Dict[str, Any]]]) -> None:
+        if self._validate is None:
+            return
+        try:
+            self._validate(plan, ops)
+        except ValueError as e:
+            raise PlanPatchError(str(e)) from e
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._plans.values())
+
+    def get(self, floor_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._plans.get(floor_id)
+
+    def versions(self) -> List[Tuple[str, int]]:
+        """(floor_id, version) de chaque étage : clé de cache de la liste, sans parcourir les plans."""
+        with self._lock:
+            return [(floor_id, int(plan.get("version", 0))) for floor_id, plan in self._plans.items()]
+
+    def version(self, floor_id: str) -> int:
+        with self._lock:
+            plan = self._plans.get(floor_id)
+            return int(plan.get("version", 0)) if plan else 0
+
+    def put(self, floor_id: str, plan: Dict[str, Any]) -> int:
+        """Remplacement complet de l'étage : réécrit son seul snapshot."""
+        self._check(plan, None)
+        with self._notify_lock:
+            with self._lock:
+                current = self._plans.get(floor_id)
+                plan = {**plan, "version": int(current.get("version", 0)) + 1 if current else 1}
+                self._plans[floor_id] = plan
+                self._write_snapshot(floor_id)
+                if current is None:
+                    self._write_index()
+            self._notify(floor_id, plan, None)
+            return plan["version"]
+
+    def patch(self, floor_id: str, ops: List[Dict[str, Any]], expected_version: Optional[int]) -> int:
+        """Applique des opérations ; coût disque = une ligne de journal (compaction périodique)."""
+        with self._notify_lock:
+            with self._lock:
+                current = self._plans.get(floor_id)
+                if current is None:
+                    raise KeyError(floor_id)
+                version = int(current.get("version", 0))
+                if expected_version is not None and expected_version != version:
+                    raise PlanConflict(version)
+                plan = apply_patch(current, ops)
+                self._check(plan, ops)
+                plan["version"] = version + 1
+                with self._log_path(floor_id).open("a", encoding="utf-8") as fh:
+                    fh.write(json.dumps({"version": plan["version"], "ops": ops}, ensure_ascii=False) + "\n")
+                self._plans[floor_id] = plan
+                self._log_len[floor_id] = self._log_len.get(floor_id, 0) + 1
+                if self._log_len[floor_id] >= COMPACT_EVERY:
+                    self._write_snapshot(floor_id)
+            self._notify(floor_id, plan, ops)
+            return plan["version"]
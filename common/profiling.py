@@ -0,0 +1,240 @@
+"""Profilage à la demande des services Python : échantillonneur de piles, dump des threads et
+chronométrage des callbacks chauds. Rien n'est actif sans PROFILING=1.
+
+Variables d'environnement :
+  PROFILING            "1" pour monter /debug/* et activer les chronos (désactivé par défaut)
+  PROFILE_MAX_SECONDS  durée maximale d'une capture (60)
+  PROFILE_SLOW_MS      appel chronométré plus long -> WARNING (0 = jamais) (250)
+
+Endpoints (install_debug_routes) :
+  GET /debug/profile?seconds=N&hz=100  piles de tous les threads (boucles paho comprises), format
+                                       « collapsed » (flamegraph.pl, speedscope, inferno) ; format=json : top ;
+                                       threads=false : sans case par thread ; idle=false : sans les threads en attente
+  GET /debug/threads                   pile courante de chaque thread
+  GET /debug/timings                   latences des fonctions décorées par @timed
+
+L'échantillonneur est un thread Python qui lit sys._current_frames() : pas de dépendance ni de
+privilège (ptrace). Il mesure son propre coût et espace les échantillons pour rester sous
+~5 % d'un cœur, même avec des milliers de threads (simulateur).
+"""
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Callable, Deque, Dict
+
+PROFILING = os.getenv("PROFILING", "") == "1"
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "250"))
+_MAX_DUTY = 0.05          # part max du temps passée à échantillonner
+_DIGITS = re.compile(r"(?<![0-9A-Za-z])\d+(?![0-9A-Za-z])")   # nombre isolé : Thread-71, dev-042
+_TIMING_WINDOW = 2048     # dernières durées conservées par fonction (percentiles)
+
+log = logging.getLogger("profiling")
+_profile_lock = threading.Lock()   # une capture à la fois
+
+
+_labels: Dict[object, str] = {}   # code -> libellé (le formatage domine le coût d'un échantillon)
+# feuilles d'un thread bloqué (verrou, socket, file) : écartées avec idle=false. Profil « horloge » par
+# défaut : une attente utile (Thread.start d'un Timer, publish qui attend un ack) reste visible.
+_IDLE_LEAVES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("selectors.py", "select"),
+    ("queue.py", "get"), ("socket.py", "accept"), ("socket.py", "readinto"), ("ssl.py", "read"),
+}
+_idle_codes: Dict[object, bool] = {}
+
+
+def _frame_label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        # ligne de définition (pas la ligne courante) : une fonction = une seule case du flamegraph
+        label = _labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+def _is_idle(code) -> bool:
+    idle = _idle_codes.get(code)
+    if idle is None:
+        idle = _idle_codes[code] = (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES
+    return idle
+
+
+def _stack(frame) -> list:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _thread_group(name: str) -> str:
+    # "Thread-71 (_close)", "badgeuse-dev-042" : une case par rôle, pas par instance
+    return _DIGITS.sub("N", name)
+
+
+def sample_stacks(seconds: float, hz: float = 100.0, by_thread: bool = True, idle: bool = True) -> Dict[str, object]:
+    """Échantillonne les piles de tous les threads ; renvoie les piles « collapsed » et leur nombre."""
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    interval = 1.0 / max(1.0, min(hz, 1000.0))
+    me = threading.get_ident()
+    stacks: Counter = Counter()
+    samples = 0
+    cost = 0.0
+    deadline = time.perf_counter() + seconds
+    while True:
+        t0 = time.perf_counter()
+        if t0 >= deadline:
+            break
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (not idle and _is_idle(frame.f_code)):
+                continue
+            stack = _stack(frame)
+            if by_thread:
+                stack.insert(0, f"thread:{_thread_group(str(names.get(ident, ident)))}")
+            stacks[";".join(stack)] += 1
+        samples += 1
+        spent = time.perf_counter() - t0
+        cost += spent
+        time.sleep(max(interval - spent, spent * (1 - _MAX_DUTY) / _MAX_DUTY))
+    return {"seconds": seconds, "samples": samples, "effective_hz": round(samples / seconds, 1),
+            "sampler_cpu_s": round(cost, 3), "stacks": stacks}
+
+
+def collapsed(stacks: Counter) -> str:
+    """Format « folded » : `frame;frame;frame N` par ligne."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_functions(stacks: Counter, limit: int = 30) -> Dict[str, list]:
+    """Fonctions les plus présentes : en feuille (self) et n'importe où dans la pile (total)."""
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in stacks.items():
+        frames = [f for f in stack.split(";") if not f.startswith("thread:")]
+        if not frames:
+            continue
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    return {"self": own.most_common(limit), "total": total.most_common(limit)}
+
+
+def thread_dump() -> str:
+    names = {t.ident: t for t in threading.enumerate()}
+    out = []
+    for ident, frame in sorted(sys._current_frames().items(), key=lambda item: getattr(names.get(item[0]), "name", "")):
+        thread = names.get(ident)
+        label = f"{thread.name} (daemon={thread.daemon})" if thread else "?"
+        out.append(f'Thread {ident} "{label}"\n')
+        out.extend(traceback.format_stack(frame))
+        out.append("\n")
+    return "".join(out)
+
+
+# --------- Chronométrage des callbacks ----------
+class _Timing:
+    __slots__ = ("count", "total", "max", "slow", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.recent: Deque[float] = deque(maxlen=_TIMING_WINDOW)
+
+
+_timings: Dict[str, _Timing] = {}
+_timings_lock = threading.Lock()
+
+
+def timed(name: str) -> Callable:
+    """Décorateur de chronométrage ; sans PROFILING=1 la fonction est renvoyée telle quelle (coût nul)."""
+
+    def wrap(fn: Callable) -> Callable:
+        if not PROFILING:
+            return fn
+        with _timings_lock:
+            stats = _timings.setdefault(name, _Timing())
+
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                # compteurs approximatifs sous contention : pas de verrou sur le chemin chaud
+                stats.count += 1
+                stats.total += elapsed
+                stats.recent.append(elapsed)
+                if elapsed > stats.max:
+                    stats.max = elapsed
+                if PROFILE_SLOW_MS and elapsed * 1000 > PROFILE_SLOW_MS:
+                    stats.slow += 1
+                    log.warning("[profiling] %s lent : %.1f ms", name, elapsed * 1000)
+
+        return inner
+
+    return wrap
+
+
+def timings() -> Dict[str, Dict[str, object]]:
+    out = {}
+    with _timings_lock:
+        items = list(_timings.items())
+    for name, stats in items:
+        recent = sorted(stats.recent)
+        pick = lambda q: round(recent[min(len(recent) - 1, int(q * len(recent)))] * 1000, 3) if recent else None
+        out[name] = {
+            "count": stats.count,
+            "mean_ms": round(stats.total / stats.count * 1000, 3) if stats.count else None,
+            "p50_ms": pick(0.50),
+            "p95_ms": pick(0.95),
+            "p99_ms": pick(0.99),
+            "max_ms": round(stats.max * 1000, 3),
+            "slow": stats.slow,
+        }
+    return out
+
+
+def install_debug_routes(app) -> bool:
+    """Monte /debug/profile, /debug/threads et /debug/timings si PROFILING=1."""
+    if not PROFILING:
+        return False
+    from fastapi import HTTPException, Query
+    from fastapi.responses import PlainTextResponse
+
+    # endpoints synchrones : exécutés dans le pool de threads, la boucle asyncio reste libre
+    @app.get("/debug/profile")
+    def debug_profile(seconds: float = Query(default=10.0, gt=0), hz: float = Query(default=100.0, gt=0),
+                      format: str = Query(default="collapsed", pattern="^(collapsed|json)$"),
+                      threads: bool = True, idle: bool = True):
+        if not _profile_lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="Capture déjà en cours")
+        try:
+            result = sample_stacks(seconds, hz, by_thread=threads, idle=idle)
+        finally:
+            _profile_lock.release()
+        stacks = result.pop("stacks")
+        if format == "json":
+            return {**result, "top": top_functions(stacks), "collapsed": collapsed(stacks).splitlines()}
+        headers = {f"X-Profile-{k.replace('_', '-')}": str(v) for k, v in result.items()}
+        return PlainTextResponse(collapsed(stacks), headers=headers)
+
+    @app.get("/debug/threads")
+    def debug_threads():
+        return PlainTextResponse(thread_dump())
+
+    @app.get("/debug/timings")
+    def debug_timings():
+        return timings()
+
+    log.warning("[profiling] endpoints /debug/* actifs (PROFILING=1)")
+    return True
@@ -0,0 +1,164 @@
+"""Politique de reconnexion MQTT commune : backoff exponentiel à gigue complète, plafond global de
+tentatives simultanées et métriques de « vague » de reconnexion.
+
+Sans gigue, tous les clients coupés par un redémarrage du broker retentent aux mêmes instants
+(1 s, 2 s, 4 s…) et le broker reçoit la flotte entière d'un coup. Avec la gigue complète, le délai
+est tiré uniformément dans [0, min(cap, base * 2^n)] : les tentatives s'étalent sur toute la fenêtre.
+
+Variables d'environnement :
+  MQTT_RECONNECT_BASE_S  premier palier du backoff (1)
+  MQTT_RECONNECT_CAP_S   plafond du backoff (60)
+
+Clients paho en loop_start() (services) : install_jittered_reconnect(client, stats) impose le délai
+tiré à la boucle de reconnexion de paho (reconnect_delay_set avant chaque attente).
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+RECONNECT_BASE_S = float(os.getenv("MQTT_RECONNECT_BASE_S", "1"))
+RECONNECT_CAP_S = float(os.getenv("MQTT_RECONNECT_CAP_S", "60"))
+WAVE_WINDOW_S = 120   # historique seconde par seconde exposé dans les métriques
+
+
+class Backoff:
+    """Exponentiel à gigue complète ; reset() après une session établie."""
+
+    def __init__(self, base: float = RECONNECT_BASE_S, cap: float = RECONNECT_CAP_S, rng: Optional[random.Random] = None):
+        self.base, self.cap = base, cap
+        self.attempts = 0
+        self._rng = rng or random.Random()
+
+    def next_delay(self) -> float:
+        ceiling = min(self.cap, self.base * (2 ** min(self.attempts, 30)))
+        self.attempts += 1
+        return self._rng.uniform(0, ceiling)
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+class ConnectGate:
+    """Nombre maximal de connexions en cours (CONNECT envoyé, CONNACK pas encore reçu) dans le process."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._sem = threading.BoundedSemaphore(limit) if limit > 0 else None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_in_flight = 0
+
+    def acquire(self, stop: threading.Event, poll: float = 0.25) -> bool:
+        """False si `stop` est levé pendant l'attente."""
+        with self._lock:
+            self.waiting += 1
+        try:
+            while self._sem is not None and not self._sem.acquire(timeout=poll):
+                if stop.is_set():
+                    return False
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+        if self._sem is not None:
+            self._sem.release()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting, "peak_in_flight": self.peak_in_flight}
+
+
+class ReconnectStats:
+    """Compteurs + histogramme par seconde (tentatives, connexions, coupures) : forme de la vague."""
+
+    _KINDS = ("attempts", "connects", "failures", "disconnects")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {kind: 0 for kind in self._KINDS}
+        self._wave: Deque[List[int]] = deque()   # [seconde epoch, attempts, connects, failures, disconnects]
+        self._delays: Deque[float] = deque(maxlen=2048)
+
+    def record(self, kind: str, delay: Optional[float] = None) -> None:
+        second = int(time.time())
+        column = 1 + self._KINDS.index(kind)
+        with self._lock:
+            self.totals[kind] += 1
+            if not self._wave or self._wave[-1][0] != second:
+                self._wave.append([second, 0, 0, 0, 0])
+                while self._wave and self._wave[0][0] <= second - WAVE_WINDOW_S:
+                    self._wave.popleft()
+            self._wave[-1][column] += 1
+            if delay is not None:
+                self._delays.append(delay)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            wave = [list(row) for row in self._wave]
+            delays = sorted(self._delays)
+            totals = dict(self.totals)
+
+        def pct(p: float) -> Optional[float]:
+            return round(delays[min(len(delays) - 1, int(p * len(delays)))], 3) if delays else None
+
+        return {
+            **totals,
+            "backoff_s": {"p50": pct(0.5), "p95": pct(0.95), "max": round(delays[-1], 3) if delays else None},
+            "peak_connects_per_s": max((row[2] for row in wave), default=0),
+            "peak_attempts_per_s": max((row[1] for row in wave), default=0),
+            # une ligne par seconde active : [epoch, tentatives, connexions, échecs, coupures]
+            "wave": wave,
+        }
+
+
+def install_jittered_reconnect(client, stats: ReconnectStats, backoff: Optional[Backoff] = None) -> Backoff:
+    """Client paho en loop_start() : chaque attente de reconnexion utilise un délai à gigue complète.
+
+    À appeler après avoir posé on_connect/on_disconnect (ils sont enveloppés, pas remplacés).
+    """
+    backoff = backoff or Backoff()
+    on_connect, on_disconnect, on_connect_fail = client.on_connect, client.on_disconnect, client.on_connect_fail
+
+    def arm():
+        delay = backoff.next_delay()
+        # paho repart de min_delay après reconnect_delay_set : min = max = délai tiré
+        client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+        return delay
+
+    def _on_connect(c, userdata, flags, reason_code, properties=None):
+        stats.record("attempts")
+        if not getattr(reason_code, "is_failure", reason_code != 0):
+            backoff.reset()
+            stats.record("connects")
+        else:
+            stats.record("failures", arm())
+        if on_connect:
+            on_connect(c, userdata, flags, reason_code, properties)
+
+    def _on_disconnect(c, userdata, *args):
+        stats.record("disconnects", arm())
+        if on_disconnect:
+            on_disconnect(c, userdata, *args)
+
+    def _on_connect_fail(c, userdata):
+        stats.record("attempts")
+        stats.record("failures", arm())
+        if on_connect_fail:
+            on_connect_fail(c, userdata)
+
+    client.on_connect = _on_connect
+    client.on_disconnect = _on_disconnect
+    client.on_connect_fail = _on_connect_fail
+    arm()   # première connexion (connect_async) déjà étalée si le broker est absent au boot
+    return backoff
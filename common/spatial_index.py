@@ -0,0 +1,357 @@
+"""Index spatial (grille uniforme) des murs, zones et devices de chaque étage.
+
+Tenu à jour via PlanStore.subscribe.
+"""
+import heapq
+import math
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+CELL_SIZE = float(os.getenv("PLAN_INDEX_CELL", "64"))
+MAX_COORD = float(os.getenv("PLAN_MAX_COORD", "1e6"))              # |coordonnée| acceptée dans un plan
+MAX_ITEM_CELLS = int(os.getenv("PLAN_INDEX_MAX_ITEM_CELLS", "4096"))  # au-delà : élément hors grille
+COLLECTIONS = {"walls": "walls", "zones": "zones", "nodes": "nodes", "devices": "nodes"}
+
+BBox = Tuple[float, float, float, float]
+Key = Tuple[str, str]  # (collection, id)
+
+
+def _num(value: Any, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _bbox_of(collection: str, item: Dict[str, Any]) -> Optional[BBox]:
+    if collection == "walls":
+        half = _num(item.get("thick"), 0.0) / 2
+        x1, y1, x2, y2 = (_num(item.get(k)) for k in ("x1", "y1", "x2", "y2"))
+        bbox = min(x1, x2) - half, min(y1, y2) - half, max(x1, x2) + half, max(y1, y2) + half
+    elif collection == "zones":
+        pts = item.get("points") or []
+        if not pts:
+            return None
+        xs = [_num(p.get("x")) for p in pts]
+        ys = [_num(p.get("y")) for p in pts]
+        bbox = min(xs), min(ys), max(xs), max(ys)
+    else:
+        x, y = _num(item.get("x")), _num(item.get("y"))
+        bbox = x, y, x, y
+    # plan enregistré avant la validation (nan/inf) : élément ignoré plutôt qu'un index cassé
+    return bbox if all(math.isfinite(v) for v in bbox) else None
+
+
+def _geometry_values(collection: str, item: Dict[str, Any]) -> Iterable[Tuple[str, Any]]:
+    if collection == "walls":
+        for k in ("x1", "y1", "x2", "y2", "thick"):
+            yield k, item.get(k)
+    elif collection == "zones":
+        for i, p in enumerate(item.get("points") or []):
+            if isinstance(p, dict):
+                yield f"points/{i}/x", p.get("x")
+                yield f"points/{i}/y", p.get("y")
+    else:
+        yield "x", item.get("x")
+        yield "y", item.get("y")
+
+
+def check_geometry(plan: Dict[str, Any], ops: Optional[List[Dict[str, Any]]] = None) -> None:
+    """ValueError si une coordonnée du plan est nan/inf ou dépasse PLAN_MAX_COORD.
+
+    Avec `ops` (PATCH), seuls les éléments touchés par les opérations sont vérifiés.
+    """
+    touched: Optional[Set[Key]] = None
+    if ops is not None:
+        touched = set()
+        for op in ops:
+            parts = [p for p in str(op.get("path", "")).split("/") if p]
+            if len(parts) >= 2 and parts[0] in COLLECTIONS:
+                touched.add((COLLECTIONS[parts[0]], parts[1]))
+    for collection in ("walls", "zones", "nodes"):
+        for item in plan.get(collection) or []:
+            if not isinstance(item, dict) or (touched is not None and (collection, str(item.get("id"))) not in touched):
+                continue
+            for field, value in _geometry_values(collection, item):
+                if value is None:
+                    continue
+                try:
+                    number = float(value)
+                except (TypeError, ValueError):
+                    continue   # valeur non numérique : lue comme 0 par l'index
+                if not math.isfinite(number) or abs(number) > MAX_COORD:
+                    raise ValueError(f"{collection}/{item.get('id')}/{field}: coordonnée hors limites ({value!r})")
+
+
+def _overlaps(a: BBox, b: BBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _segment_distance(px: float, py: float, wall: Dict[str, Any]) -> float:
+    x1, y1, x2, y2 = (_num(wall.get(k)) for k in ("x1", "y1", "x2", "y2"))
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    t = 0.0 if length2 == 0 else max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / length2))
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+def _segment_hits_rect(wall: Dict[str, Any], rect: BBox) -> bool:
+    """Liang-Barsky sur le rectangle élargi de l'épaisseur du mur."""
+    half = _num(wall.get("thick"), 0.0) / 2
+    xmin, ymin, xmax, ymax = rect[0] - half, rect[1] - half, rect[2] + half, rect[3] + half
+    x1, y1, x2, y2 = (_num(wall.get(k)) for k in ("x1", "y1", "x2", "y2"))
+    dx, dy = x2 - x1, y2 - y1
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x1 - xmin), (dx, xmax - x1), (-dy, y1 - ymin), (dy, ymax - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        r = q / p
+        if p < 0:
+            t0 = max(t0, r)
+        else:
+            t1 = min(t1, r)
+        if t0 > t1:
+            return False
+    return True
+
+
+def _point_in_polygon(x: float, y: float, pts: List[Dict[str, Any]]) -> bool:
+    inside = False
+    n = len(pts)
+    for i in range(n):
+        xi, yi = _num(pts[i].get("x")), _num(pts[i].get("y"))
+        xj, yj = _num(pts[i - 1].get("x")), _num(pts[i - 1].get("y"))
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+    return inside
+
+
+def _zone_hits_rect(zone: Dict[str, Any], rect: BBox) -> bool:
+    pts = zone.get("points") or []
+    if any(rect[0] <= _num(p.get("x")) <= rect[2] and rect[1] <= _num(p.get("y")) <= rect[3] for p in pts):
+        return True
+    corners = ((rect[0], rect[1]), (rect[2], rect[1]), (rect[0], rect[3]), (rect[2], rect[3]))
+    if any(_point_in_polygon(cx, cy, pts) for cx, cy in corners):
+        return True
+    edges = ({"x1": pts[i - 1].get("x"), "y1": pts[i - 1].get("y"), "x2": p.get("x"), "y2": p.get("y")} for i, p in enumerate(pts))
+    return any(_segment_hits_rect(edge, rect) for edge in edges)
+
+
+class FloorIndex:
+    def __init__(self, plan: Dict[str, Any], cell: float = CELL_SIZE):
+        self.cell = cell
+        self._lock = threading.Lock()
+        self._cells: Dict[Tuple[int, int], Set[Key]] = {}
+        self._items: Dict[Key, Tuple[BBox, Dict[str, Any]]] = {}
+        self._large: Set[Key] = set()   # éléments couvrant plus de MAX_ITEM_CELLS cellules : hors grille
+        self._nodes = 0
+        self._extent: Optional[Tuple[int, int, int, int]] = None   # cellules occupées par les devices (cache)
+        for collection in ("walls", "zones", "nodes"):
+            for item in plan.get(collection) or []:
+                self._insert(collection, item)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _cell_count(self, bbox: BBox) -> int:
+        c = self.cell
+        return (math.floor(bbox[2] / c) - math.floor(bbox[0] / c) + 1) * (math.floor(bbox[3] / c) - math.floor(bbox[1] / c) + 1)
+
+    def _cell_range(self, bbox: BBox) -> Iterable[Tuple[int, int]]:
+        c = self.cell
+        for cx in range(math.floor(bbox[0] / c), math.floor(bbox[2] / c) + 1):
+            for cy in range(math.floor(bbox[1] / c), math.floor(bbox[3] / c) + 1):
+                yield cx, cy
+
+    def _insert(self, collection: str, item: Dict[str, Any]) -> None:
+        if item.get("id") is None:
+            return
+        bbox = _bbox_of(collection, item)
+        if bbox is None:
+            return
+        key = (collection, str(item["id"]))
+        self._remove(key)
+        self._items[key] = (bbox, item)
+        self._nodes += collection == "nodes"
+        self._extent = None
+        if self._cell_count(bbox) > MAX_ITEM_CELLS:
+            # très grand mur / zone : testé à chaque requête plutôt que recopié dans des milliers de cellules
+            self._large.add(key)
+            return
+        for cell in self._cell_range(bbox):
+            self._cells.setdefault(cell, set()).add(key)
+
+    def _remove(self, key: Key) -> None:
+        entry = self._items.pop(key, None)
+        if entry is None:
+            return
+        self._nodes -= key[0] == "nodes"
+        self._extent = None
+        if key in self._large:
+            self._large.discard(key)
+            return
+        for cell in self._cell_range(entry[0]):
+            bucket = self._cells.get(cell)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del self._cells[cell]
+
+    def update(self, plan: Dict[str, Any], ops: List[Dict[str, Any]]) -> None:
+        """Ré-indexe uniquement les éléments touchés par les opérations d'un patch."""
+        touched: Set[Key] = set()
+        for op in ops:
+            parts = [p for p in str(op.get("path", "")).split("/") if p]
+            if len(parts) >= 2 and parts[0] in COLLECTIONS:
+                touched.add((COLLECTIONS[parts[0]], parts[1]))
+        with self._lock:
+            for collection, item_id in touched:
+                self._remove((collection, item_id))
+                item = next((it for it in plan.get(collection) or [] if str(it.get("id")) == item_id), None)
+                if item is not None:
+                    self._insert(collection, item)
+
+    def _candidates(self, bbox: BBox) -> Set[Key]:
+        if self._cell_count(bbox) > len(self._cells):
+            return set(self._items)
+        out: Set[Key] = set(self._large)
+        for cell in self._cell_range(bbox):
+            out |= self._cells.get(cell, set())
+        return out
+
+    def query(self, bbox: BBox, collections: Optional[Set[str]] = None) -> Dict[str, List[Dict[str, Any]]]:
+        out: Dict[str, List[Dict[str, Any]]] = {"walls": [], "zones": [], "nodes": []}
+        with self._lock:
+            for key in self._candidates(bbox):
+                collection = key[0]
+                if collections and collection not in collections:
+                    continue
+                item_bbox, item = self._items[key]
+                if not _overlaps(item_bbox, bbox):
+                    continue
+                if collection == "walls" and not _segment_hits_rect(item, bbox):
+                    continue
+                if collection == "zones" and not _zone_hits_rect(item, bbox):
+                    continue
+                out[collection].append(item)
+        return out
+
+    def locate(self, x: float, y: float, tolerance: float = 0.0) -> Dict[str, List[Dict[str, Any]]]:
+        """Zones contenant le point et murs qu'il touche (épaisseur + tolérance)."""
+        point = (x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+        out: Dict[str, List[Dict[str, Any]]] = {"walls": [], "zones": []}
+        with self._lock:
+            for key in self._candidates(point):
+                item_bbox, item = self._items[key]
+                if not _overlaps(item_bbox, point):
+                    continue
+                if key[0] == "zones" and _point_in_polygon(x, y, item.get("points") or []):
+                    out["zones"].append(item)
+                elif key[0] == "walls" and _segment_distance(x, y, item) <= _num(item.get("thick"), 0.0) / 2 + tolerance:
+                    out["walls"].append(item)
+        return out
+
+    def _ring(self, cx: int, cy: int, ring: int) -> Iterable[Tuple[int, int]]:
+        """Cellules du pourtour de l'anneau (8 * ring cellules, pas tout le carré)."""
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
+
+    def _node_extent(self) -> Optional[Tuple[int, int, int, int]]:
+        if self._extent is None and self._nodes:
+            cells = [(math.floor(b[0] / self.cell), math.floor(b[1] / self.cell)) for key, (b, _) in self._items.items() if key[0] == "nodes"]
+            xs, ys = [c[0] for c in cells], [c[1] for c in cells]
+            self._extent = min(xs), min(ys), max(xs), max(ys)
+        return self._extent
+
+    def _nearest_scan(self, x: float, y: float, kind: Optional[str], k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        candidates = (
+            (math.hypot(_num(item.get("x")) - x, _num(item.get("y")) - y), item)
+            for key, (_, item) in self._items.items()
+            if key[0] == "nodes" and (not kind or item.get("kind") == kind)
+        )
+        return heapq.nsmallest(k, candidates, key=lambda t: t[0])
+
+    def nearest(self, x: float, y: float, kind: Optional[str] = None, k: int = 1) -> List[Dict[str, Any]]:
+        """k devices les plus proches (recherche par anneaux de cellules croissants).
+
+        Point hors de l'emprise des devices, ou anneaux plus nombreux que les cellules occupées :
+        parcours linéaire des devices (tas) plutôt que des anneaux vides.
+        """
+        cx, cy = math.floor(x / self.cell), math.floor(y / self.cell)
+        found: List[Tuple[float, Dict[str, Any]]] = []
+        seen: Set[Key] = set()
+        with self._lock:
+            extent = self._node_extent()
+            if extent is None:
+                return []
+            budget = len(self._cells)
+            visited = 0 if extent[0] <= cx <= extent[2] and extent[1] <= cy <= extent[3] else budget + 1
+            ring = 0
+            while len(seen) < self._nodes:
+                if visited > budget:
+                    found = self._nearest_scan(x, y, kind, k)
+                    break
+                for cell in self._ring(cx, cy, ring):
+                    visited += 1
+                    for key in self._cells.get(cell, ()):
+                        if key[0] != "nodes" or key in seen:
+                            continue
+                        seen.add(key)
+                        item = self._items[key][1]
+                        if kind and item.get("kind") != kind:
+                            continue
+                        found.append((math.hypot(_num(item.get("x")) - x, _num(item.get("y")) - y), item))
+                found.sort(key=lambda t: t[0])
+                # au-delà de cet anneau, tout point est à plus de ring * cell
+                if len(found) >= k and found[k - 1][0] <= ring * self.cell:
+                    break
+                ring += 1
+        return [dict(item, distance=round(d, 3)) for d, item in found[:k]]
+
+
+class SpatialIndexes:
+    """Un FloorIndex par étage, maintenu à jour par les écritures du PlanStore."""
+
+    def __init__(self, store):
+        self._lock = threading.Lock()
+        self._floors: Dict[str, FloorIndex] = {}
+        for plan in store.list():
+            if plan.get("id"):
+                self._floors[plan["id"]] = FloorIndex(plan)
+        store.subscribe(self._on_change)
+
+    def _on_change(self, floor_id: str, plan: Dict[str, Any], ops: Optional[List[Dict[str, Any]]]) -> None:
+        with self._lock:
+            index = self._floors.get(floor_id)
+        if index is not None and ops is not None:
+            index.update(plan, ops)
+            return
+        rebuilt = FloorIndex(plan)
+        with self._lock:
+            self._floors[floor_id] = rebuilt
+
+    def get(self, floor_id: str) -> Optional[FloorIndex]:
+        with self._lock:
+            return self._floors.get(floor_id)
+
+
+def is_finite_point(x: float, y: float, tolerance: float = 0.0) -> bool:
+    """Point (et sa boîte de tolérance) utilisable par la grille : math.floor refuse nan et inf."""
+    return all(math.isfinite(v) for v in (x - tolerance, y - tolerance, x + tolerance, y + tolerance))
+
+
+def parse_bbox(raw: str) -> BBox:
+    x1, y1, x2, y2 = (float(v) for v in raw.split(","))
+    if not all(math.isfinite(v) for v in (x1, y1, x2, y2)):
+        raise ValueError("bbox non finie")
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
@@ -1,11 +1,29 @@
-from typing import Literal, Optional
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Literal, Optional
 
-from fastapi import Body, FastAPI, HTTPException, Query
+from fastapi import Body, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
-from config import MQTT_HOST, MQTT_PORT, load_plans, save_plans
+from config import (
+    DATA_DIR,
+    MQTT_HOST,
+    MQTT_PORT,
+    PLANS_FILE,
+    SIMULATOR_BRIDGE_APP,
+    SIMULATOR_EMBED_BRIDGE,
+    SIMULATOR_SHARDS,
+    SIMULATOR_TRANSPORT,
+    log,
+)
+from inproc import attach_bridge, bus
 from manager import DeviceManager
+from plan_http import PlanResponder, parse_fields
+from plan_store import PlanConflict, PlanPatchError, PlanStore
+from profiling import install_debug_routes
+from sharding import ShardedDeviceManager, ShardUnavailable
+from spatial_index import SpatialIndexes, check_geometry, is_finite_point, parse_bbox
 
 
 class CreateDevice(BaseModel):
@@ -14,9 +32,38 @@ class CreateDevice(BaseModel):
     door_id: Optional[str] = None
 
 
-manager = DeviceManager()
+class PlanPatch(BaseModel):
+    version: Optional[int] = None  # version connue du client (contrôle optimiste)
+    ops: List[Dict[str, Any]]
+
+
+def _build_manager():
+    if SIMULATOR_SHARDS > 1 and SIMULATOR_TRANSPORT == "inproc":
+        log.warning("SIMULATOR_SHARDS=%d ignoré avec le transport inproc (bus propre au processus)", SIMULATOR_SHARDS)
+    elif SIMULATOR_SHARDS > 1:
+        return ShardedDeviceManager(SIMULATOR_SHARDS)
+    return DeviceManager()
+
+
+manager = _build_manager()
+plans = PlanStore(DATA_DIR, legacy_file=PLANS_FILE, validate=check_geometry)
+indexes = SpatialIndexes(plans)
+plan_responses = PlanResponder(plans)
+embedded_bridge = attach_bridge(SIMULATOR_BRIDGE_APP) if SIMULATOR_TRANSPORT == "inproc" and SIMULATOR_EMBED_BRIDGE else None
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # shards lancés au démarrage du serveur, pas à l'import (réimporté par les processus enfants)
+    if isinstance(manager, ShardedDeviceManager):
+        manager.start()
+    yield
+    manager.close()
 
-app = FastAPI(title="IoT In-Memory Simulator")
+
+app = FastAPI(title="IoT In-Memory Simulator", lifespan=lifespan)
+install_debug_routes(app)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -26,57 +73,105 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(ShardUnavailable)
+async def shard_unavailable(request, exc: ShardUnavailable):
+    # device porté par un shard mort : indisponible (pas une erreur serveur inattendue)
+    return JSONResponse(status_code=503, content={"detail": str(exc), "shard": exc.index})
+
+
 @app.get("/health")
 def health():
-    return {
-        "ok": True,
+    shards = manager.shard_stats() if isinstance(manager, ShardedDeviceManager) else None
+    degraded = bool(shards) and not all(shard["alive"] for shard in shards)
+    body = {
+        "ok": not degraded,
         "mqtt": {"host": MQTT_HOST, "port": MQTT_PORT},
+        "transport": SIMULATOR_TRANSPORT,
+        "bus": bus.stats() if SIMULATOR_TRANSPORT == "inproc" else None,
+        "embedded_bridge": embedded_bridge is not None,
         "devices": len(manager.list(None)),
+        "shards": shards,
+        "reconnect": manager.connection_stats(),
     }
+    return JSONResponse(status_code=503 if degraded else 200, content=body)
 
 
 @app.get("/plans")
-def get_plans():
-    return load_plans()
+def get_plans(request: Request, fields: Optional[str] = Query(default=None, description="ex. id,name : résumé sans géométrie")):
+    try:
+        selected = parse_fields(fields)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="fields must list at least one field")
+    return plan_responses.list(request, selected)
 
 
 @app.get("/plans/{floor_id}")
-def get_plan(floor_id: str):
-    for plan in load_plans():
-        if plan.get("id") == floor_id:
-            return plan
-    raise HTTPException(status_code=404, detail="Plan not found")
+def get_plan(request: Request, floor_id: str):
+    response = plan_responses.floor(request, floor_id)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return response
 
 
 @app.post("/plans/{floor_id}")
 def save_plan_endpoint(floor_id: str, plan: dict = Body(...)):
-    plans = load_plans()
-    for idx, existing in enumerate(plans):
-        if existing.get("id") == floor_id:
-            plans[idx] = plan
-            break
-    else:
-        plans.append(plan)
-    save_plans(plans)
-    return {"ok": True}
+    try:
+        version = plans.put(floor_id, plan)
+    except PlanPatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"ok": True, "version": version}
+
+
+@app.patch("/plans/{floor_id}")
+def patch_plan_endpoint(floor_id: str, req: PlanPatch):
+    try:
+        version = plans.patch(floor_id, req.ops, req.version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    except PlanConflict as e:
+        raise HTTPException(status_code=409, detail={"error": "version_conflict", "version": e.current})
+    except PlanPatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"ok": True, "version": version}
+
+
+def _floor_index(floor_id: str):
+    index = indexes.get(floor_id)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return index
+
+
+@app.get("/plans/{floor_id}/query")
+def query_plan(floor_id: str, bbox: str = Query(...), types: Optional[str] = Query(default=None)):
+    try:
+        rect = parse_bbox(bbox)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="bbox attendu: x1,y1,x2,y2")
+    collections = {t.strip() for t in types.split(",")} if types else None
+    return _floor_index(floor_id).query(rect, collections)
+
+
+@app.get("/plans/{floor_id}/locate")
+def locate_in_plan(
+    floor_id: str,
+    x: float,
+    y: float,
+    tolerance: float = Query(default=0.0, ge=0),
+    kind: Optional[Literal["badgeuse", "porte"]] = None,
+    k: int = Query(default=1, ge=0, le=100),
+):
+    if not is_finite_point(x, y, tolerance):
+        raise HTTPException(status_code=422, detail="x, y et tolerance doivent être finis")
+    index = _floor_index(floor_id)
+    found = index.locate(x, y, tolerance)
+    found["nearest"] = index.nearest(x, y, kind, k) if k else []
+    return found
 
 
 @app.post("/devices")
 def create_device(req: CreateDevice):
-    record = manager.ensure(req.kind, req.device_id, req.door_id)
-    ready = record.worker.wait_ready(timeout=8.0)
-    payload = {
-        "ok": True,
-        "device": {
-            "id": req.device_id,
-            "kind": record.kind,
-            "status": "running" if ready else "starting",
-            "ready": ready,
-        },
-    }
-    if record.kind == "badgeuse":
-        payload["device"]["door_id"] = record.door_id
-    return payload
+    return {"ok": True, "device": manager.create(req.kind, req.device_id, req.door_id, wait_s=8.0)}
 
 
 @app.get("/devices")
@@ -93,19 +188,18 @@ def delete_device(device_id: str, remove_image: bool = Query(default=False)):
 
 @app.get("/devices/{device_id}/health")
 def device_health(device_id: str):
-    record = manager.get(device_id)
-    if not record:
+    health = manager.health(device_id)
+    if health is None:
         raise HTTPException(status_code=404, detail="Device inconnu")
-    return record.worker.health()
+    return health
 
 
 @app.post("/door/{device_id}/{action}")
 def proxy_door(device_id: str, action: str):
-    record = manager.get(device_id)
-    if not record or record.kind != "porte":
-        raise HTTPException(status_code=404, detail="Porte inconnue")
-    if action not in {"open", "close", "toggle"}:
+    try:
+        data = manager.door_action(device_id, action)
+    except ValueError:
         raise HTTPException(status_code=400, detail="Action invalide")
-    worker = record.worker
-    worker.apply_action(action)
-    return {"status": 200, "data": worker.health()}
+    if data is None:
+        raise HTTPException(status_code=404, detail="Porte inconnue")
+    return {"status": 200, "data": data}
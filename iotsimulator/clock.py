@@ -0,0 +1,107 @@
+"""Horloge du simulateur : réelle par défaut, virtuelle (événements discrets) pour les scénarios.
+
+Interface commune, aussi attendue par le bridge (bridge.attach(client, clock=...)) :
+  time() -> epoch en secondes, now_iso() -> horodatage ISO UTC,
+  call_later(delay, fn) -> objet avec cancel().
+
+VirtualClock n'avance que par run()/run_until() : le temps saute directement à l'échéance
+suivante, et les échéances égales s'exécutent dans l'ordre de programmation (déterministe).
+"""
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+
+
+class WallClock:
+    def time(self) -> float:
+        return time.time()
+
+    def now_iso(self) -> str:
+        return datetime.now(timezone.utc).isoformat()
+
+    def call_later(self, delay: float, fn: Callable[[], None]) -> threading.Timer:
+        timer = threading.Timer(delay, fn)
+        timer.start()
+        return timer
+
+
+class _Scheduled:
+    __slots__ = ("fn", "cancelled")
+
+    def __init__(self, fn: Callable[[], None]):
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class VirtualClock:
+    def __init__(self, start: float):
+        self._now = start
+        self._lock = threading.Lock()
+        self._queue: List[Tuple[float, int, _Scheduled]] = []
+        self._seq = itertools.count()
+        self.executed = 0
+
+    def time(self) -> float:
+        return self._now
+
+    def now_iso(self) -> str:
+        return datetime.fromtimestamp(self._now, timezone.utc).isoformat()
+
+    def call_at(self, when: float, fn: Callable[[], None]) -> _Scheduled:
+        handle = _Scheduled(fn)
+        with self._lock:
+            heapq.heappush(self._queue, (max(when, self._now), next(self._seq), handle))
+        return handle
+
+    def call_later(self, delay: float, fn: Callable[[], None]) -> _Scheduled:
+        return self.call_at(self._now + delay, fn)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(1 for _, _, h in self._queue if not h.cancelled)
+
+    def run_until(self, until: float) -> int:
+        """Exécute dans l'ordre toutes les échéances <= until, puis place l'horloge à until."""
+        ran = 0
+        while True:
+            with self._lock:
+                if not self._queue or self._queue[0][0] > until:
+                    break
+                when, _, handle = heapq.heappop(self._queue)
+            if handle.cancelled:
+                continue
+            self._now = when
+            handle.fn()   # peut reprogrammer (auto-close…) : la boucle le verra
+            ran += 1
+        self._now = max(self._now, until)
+        self.executed += ran
+        return ran
+
+    def run(self) -> int:
+        """Jusqu'à épuisement des échéances."""
+        ran = 0
+        while True:
+            with self._lock:
+                if not self._queue:
+                    break
+                until = self._queue[0][0]
+            ran += self.run_until(until)
+        return ran
+
+
+_current = WallClock()
+
+
+def get_clock():
+    return _current
+
+
+def set_clock(clock) -> None:
+    global _current
+    _current = clock
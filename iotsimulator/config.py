@@ -1,12 +1,16 @@
-import json
 import logging
 import os
 import pathlib
-from datetime import datetime, timezone
-from typing import Any, List
+import sys
 
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("simulator")
+# modules partagés (common/) : copiés à côté du code dans l'image Docker, lus dans le dépôt en local
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from clock import get_clock
+from logging_setup import setup_logging
+
+log = setup_logging("simulator")
+log_events = logging.getLogger("simulator.events")  # une ligne par badgeage / action : échantillonnable
 
 MQTT_HOST = os.getenv("MQTT_HOST", "mosquitto")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
@@ -14,21 +18,23 @@ MQTT_USER = os.getenv("MQTT_USER", "")
 MQTT_PASS = os.getenv("MQTT_PASS", "")
 DATA_DIR = pathlib.Path(os.getenv("SIMULATOR_DATA_DIR", "./simulator_data"))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
-PLANS_FILE = DATA_DIR / "plans.json"
+PLANS_FILE = DATA_DIR / "plans.json"  # ancien format multi-étages, migré au premier démarrage
+# "mqtt" (broker réel) ou "inproc" (bus en mémoire, sans socket : CI / montée en charge)
+SIMULATOR_TRANSPORT = os.getenv("SIMULATOR_TRANSPORT", "mqtt").lower()
+# inproc uniquement : charge bridge/app.py sur le même bus (chemin modifiable pour une autre arborescence)
+SIMULATOR_EMBED_BRIDGE = os.getenv("SIMULATOR_EMBED_BRIDGE", "") == "1"
+SIMULATOR_BRIDGE_APP = pathlib.Path(
+    os.getenv("SIMULATOR_BRIDGE_APP", str(pathlib.Path(__file__).resolve().parent.parent / "bridge" / "app.py"))
+)
+
+# devices répartis sur N processus (hachage cohérent) ; 0/1 = mono-processus, "auto" = nombre de cœurs.
+# Ignoré avec le transport inproc : le bus en mémoire ne traverse pas les processus.
+_shards = os.getenv("SIMULATOR_SHARDS", "0").strip().lower()
+SIMULATOR_SHARDS = (os.cpu_count() or 1) if _shards == "auto" else int(_shards or "0")
+# reconnexion de la flotte (backoff à gigue : MQTT_RECONNECT_BASE_S / MQTT_RECONNECT_CAP_S, voir common/reconnect.py)
+SIMULATOR_MAX_CONNECTING = int(os.getenv("SIMULATOR_MAX_CONNECTING", "50"))  # CONNECT simultanés max (0 = illimité)
+SIMULATOR_RESUBSCRIBE_SPREAD_S = float(os.getenv("SIMULATOR_RESUBSCRIBE_SPREAD_S", "5"))  # après reconnexion
 
 
 def now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
-
-
-def load_plans() -> List[Any]:
-    if PLANS_FILE.exists():
-        try:
-            return json.loads(PLANS_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            log.exception("Impossible de lire %s", PLANS_FILE)
-    return []
-
-
-def save_plans(plans: List[Any]) -> None:
-    PLANS_FILE.write_text(json.dumps(plans, ensure_ascii=False, indent=2), encoding="utf-8")
+    return get_clock().now_iso()
@@ -0,0 +1,384 @@
+"""Transport MQTT en mémoire (SIMULATOR_TRANSPORT=inproc) : aucun socket, même API que paho.
+
+`InprocClient` reprend le sous-ensemble de `paho.mqtt.client.Client` utilisé par les workers et
+le bridge (connect/subscribe/publish/will_set/callbacks) ; les messages reçus sont de vrais
+`MQTTMessage`, donc les callbacks `_on_message` existants s'exécutent sans modification.
+
+`InprocBroker` route les publications : abonnements dans un trie de topics (`+`, `#`), messages
+retenus dans un second trie (un abonnement ne parcourt que les topics qui lui correspondent),
+QoS 1/2 acquittés dès la remise. La remise est synchrone, dans le thread qui publie : c'est un
+broker de latence nulle.
+"""
+import importlib.util
+import itertools
+import os
+import pathlib
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+from config import log
+
+
+class _Node:
+    __slots__ = ("children", "subs", "retained")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.subs: Dict["InprocClient", int] = {}   # client -> QoS d'abonnement
+        self.retained: Optional[Tuple[bytes, int, Any]] = None
+
+
+class TopicTrie:
+    """Filtres d'abonnement indexés par niveau ; match() suit les règles MQTT 3.1.1 / 5."""
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, topic_filter: str, client: "InprocClient", qos: int) -> None:
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.subs[client] = qos
+
+    def remove(self, topic_filter: str, client: "InprocClient") -> None:
+        path = [self._root]
+        for level in topic_filter.split("/"):
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].subs.pop(client, None)
+        # élague les branches devenues vides
+        levels = topic_filter.split("/")
+        for depth in range(len(levels), 0, -1):
+            node = path[depth]
+            if node.subs or node.children:
+                break
+            del path[depth - 1].children[levels[depth - 1]]
+
+    def match(self, topic: str) -> Dict["InprocClient", int]:
+        out: Dict["InprocClient", int] = {}
+        levels = topic.split("/")
+        wildcard_ok = not topic.startswith("$")   # $SYS… n'est jamais capturé par + ou # en tête
+
+        def collect(subs):
+            for client, qos in subs.items():
+                if qos > out.get(client, -1):
+                    out[client] = qos
+
+        def walk(node: _Node, i: int):
+            multi = node.children.get("#")
+            if multi is not None and (i > 0 or wildcard_ok):
+                collect(multi.subs)            # "a/#" couvre aussi "a"
+            if i == len(levels):
+                collect(node.subs)
+                return
+            exact = node.children.get(levels[i])
+            if exact is not None:
+                walk(exact, i + 1)
+            single = node.children.get("+")
+            if single is not None and (i > 0 or wildcard_ok):
+                walk(single, i + 1)
+
+        walk(self._root, 0)
+        return out
+
+
+class _RetainedStore:
+    """Messages retenus rangés par niveau de topic, parcourus avec le filtre d'abonnement."""
+
+    def __init__(self):
+        self._root = _Node()
+        self.count = 0
+
+    def set(self, topic: str, payload: bytes, qos: int, properties) -> None:
+        node = self._root
+        for level in topic.split("/"):
+            node = node.children.setdefault(level, _Node())
+        if node.retained is None and payload:
+            self.count += 1
+        elif node.retained is not None and not payload:
+            self.count -= 1
+        node.retained = (payload, qos, properties) if payload else None
+
+    def matching(self, topic_filter: str) -> List[Tuple[str, bytes, int, Any]]:
+        out: List[Tuple[str, bytes, int, Any]] = []
+        levels = topic_filter.split("/")
+
+        def subtree(node: _Node, path: List[str]):
+            if node.retained is not None:
+                out.append(("/".join(path), *node.retained))
+            for name, child in node.children.items():
+                subtree(child, path + [name])
+
+        def walk(node: _Node, i: int, path: List[str]):
+            if i == len(levels):
+                if node.retained is not None:
+                    out.append(("/".join(path), *node.retained))
+                return
+            level = levels[i]
+            if level == "#":
+                if node.retained is not None and i > 0:
+                    out.append(("/".join(path), *node.retained))
+                for name, child in node.children.items():
+                    if not (i == 0 and name.startswith("$")):
+                        subtree(child, path + [name])
+            elif level == "+":
+                for name, child in node.children.items():
+                    if not (i == 0 and name.startswith("$")):
+                        walk(child, i + 1, path + [name])
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    walk(child, i + 1, path + [level])
+
+        walk(self._root, 0, [])
+        return out
+
+
+class InprocBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs = TopicTrie()
+        self._retained = _RetainedStore()
+        self._clients: Dict[str, "InprocClient"] = {}
+        self._mid = itertools.count(1)
+        self.published = 0
+        self.delivered = 0
+
+    def next_mid(self) -> int:
+        return next(self._mid)
+
+    def connect(self, client: "InprocClient") -> None:
+        with self._lock:
+            previous = self._clients.get(client.client_id)
+            self._clients[client.client_id] = client
+        if previous is not None and previous is not client:
+            previous._taken_over()  # même client_id : le broker coupe l'ancienne session
+
+    def disconnect(self, client: "InprocClient") -> None:
+        with self._lock:
+            if self._clients.get(client.client_id) is client:
+                del self._clients[client.client_id]
+            for topic_filter in client.subscriptions:
+                self._subs.remove(topic_filter, client)
+
+    def subscribe(self, client: "InprocClient", topic_filter: str, qos: int) -> List[Tuple[str, bytes, int, Any]]:
+        with self._lock:
+            self._subs.add(topic_filter, client, qos)
+            return self._retained.matching(topic_filter)
+
+    def unsubscribe(self, client: "InprocClient", topic_filter: str) -> None:
+        with self._lock:
+            self._subs.remove(topic_filter, client)
+
+    def publish(self, topic: str, payload: bytes, qos: int, retain: bool, properties=None) -> int:
+        with self._lock:
+            if retain:
+                self._retained.set(topic, payload, qos, properties)
+            targets = self._subs.match(topic)
+            self.published += 1
+            self.delivered += len(targets)
+        for client, sub_qos in targets.items():
+            # remise "live" : le flag retain n'est positionné que pour les messages rejoués au subscribe
+            client._deliver(topic, payload, min(qos, sub_qos), False, properties)
+        return len(targets)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "retained": self._retained.count,
+                "published": self.published,
+                "delivered": self.delivered,
+            }
+
+
+bus = InprocBroker()
+
+
+class InprocClient:
+    """Client du bus en mémoire, compatible avec l'usage fait de paho (API de callbacks VERSION2)."""
+
+    def __init__(self, callback_api_version=None, client_id: str = "", protocol: int = mqtt.MQTTv311, broker: InprocBroker = bus, **_):
+        self.client_id = client_id or f"inproc-{id(self):x}"
+        self.protocol = protocol
+        self._broker = broker
+        self._userdata = None
+        self._will: Optional[Tuple[str, bytes, int, bool, Any]] = None
+        self._connected = False
+        self._callbacks: List[Tuple[str, Callable]] = []
+        self.subscriptions: Dict[str, int] = {}
+        self.on_connect: Optional[Callable] = None
+        self.on_disconnect: Optional[Callable] = None
+        self.on_message: Optional[Callable] = None
+        self.on_publish: Optional[Callable] = None
+        self.on_subscribe: Optional[Callable] = None
+        self._wake = threading.Event()
+
+    # --- configuration (sans effet réseau) -----------------------------------
+    def username_pw_set(self, username, password=None) -> None:
+        pass
+
+    def reconnect_delay_set(self, min_delay: int = 1, max_delay: int = 120) -> None:
+        pass
+
+    def max_inflight_messages_set(self, inflight: int) -> None:
+        pass
+
+    def max_queued_messages_set(self, queue_size: int) -> None:
+        pass
+
+    def user_data_set(self, userdata) -> None:
+        self._userdata = userdata
+
+    def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False, properties=None) -> None:
+        self._will = (topic, _to_bytes(payload), qos, retain, properties)
+
+    def message_callback_add(self, sub: str, callback: Callable) -> None:
+        self._callbacks.append((sub, callback))
+
+    # --- session --------------------------------------------------------------
+    def connect(self, host: str = "", port: int = 1883, keepalive: int = 60, *args, **kwargs) -> int:
+        self._broker.connect(self)
+        self._connected = True
+        if self.on_connect:
+            self.on_connect(self, self._userdata, mqtt.ConnectFlags(False), mqtt.ReasonCode(mqtt.PacketTypes.CONNACK, identifier=0), None)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    connect_async = connect
+
+    def reconnect(self) -> int:
+        self.disconnect()
+        return self.connect()
+
+    def loop_start(self) -> int:
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop(self, timeout: float = 1.0, *args) -> int:
+        """Pas de réseau : la remise est synchrone, la boucle ne fait qu'attendre (ou un wakeup())."""
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN   # comme paho sans socket : retour immédiat
+        if self._wake.wait(timeout):
+            self._wake.clear()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def wakeup(self) -> None:
+        """Interrompt l'attente de loop() (équivalent de la socketpair de réveil de paho)."""
+        self._wake.set()
+
+    def loop_stop(self, *args) -> int:
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def disconnect(self, *args, **kwargs) -> int:
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN
+        self._connected = False
+        self._broker.disconnect(self)
+        self.subscriptions.clear()
+        if self.on_disconnect:
+            self.on_disconnect(self, self._userdata, mqtt.DisconnectFlags(False), mqtt.ReasonCode(mqtt.PacketTypes.DISCONNECT, identifier=0), None)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def _taken_over(self) -> None:
+        """Session perdue sans DISCONNECT : la LWT est publiée, comme sur un vrai broker."""
+        if not self._connected:
+            return
+        self._connected = False
+        self._broker.disconnect(self)
+        self.subscriptions.clear()
+        if self._will:
+            topic, payload, qos, retain, properties = self._will
+            self._broker.publish(topic, payload, qos, retain, properties)
+
+    # --- pub/sub --------------------------------------------------------------
+    def subscribe(self, topic, qos: int = 0, options=None, properties=None) -> Tuple[int, int]:
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        filters = topic if isinstance(topic, list) else [(topic, qos)]
+        mid = self._broker.next_mid()
+        for topic_filter, sub_qos in filters:
+            self.subscriptions[topic_filter] = sub_qos
+            for r_topic, payload, r_qos, properties in self._broker.subscribe(self, topic_filter, sub_qos):
+                self._deliver(r_topic, payload, min(r_qos, sub_qos), True, properties)
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic, properties=None) -> Tuple[int, int]:
+        for topic_filter in topic if isinstance(topic, list) else [topic]:
+            self.subscriptions.pop(topic_filter, None)
+            self._broker.unsubscribe(self, topic_filter)
+        return mqtt.MQTT_ERR_SUCCESS, self._broker.next_mid()
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False, properties=None) -> mqtt.MQTTMessageInfo:
+        info = mqtt.MQTTMessageInfo(self._broker.next_mid())
+        if not self._connected:
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+            return info
+        self._broker.publish(topic, _to_bytes(payload), qos, retain, properties)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        info._set_as_published()   # QoS 1/2 : PUBACK/PUBCOMP simulés, remise déjà faite
+        if self.on_publish:
+            self.on_publish(self, self._userdata, info.mid, mqtt.ReasonCode(mqtt.PacketTypes.PUBACK, identifier=0), None)
+        return info
+
+    def _deliver(self, topic: str, payload: bytes, qos: int, retain: bool, properties) -> None:
+        msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+        msg.payload = payload
+        msg.qos = qos
+        msg.retain = retain
+        msg.properties = properties
+        matched = False
+        for sub, callback in self._callbacks:
+            if mqtt.topic_matches_sub(sub, topic):
+                matched = True
+                self._safe_call(callback, msg)
+        if not matched and self.on_message:
+            self._safe_call(self.on_message, msg)
+
+    def _safe_call(self, callback: Callable, msg: mqtt.MQTTMessage) -> None:
+        try:
+            callback(self, self._userdata, msg)
+        except Exception:
+            # paho journalise et continue : une erreur d'un abonné ne doit pas remonter chez l'émetteur
+            log.exception("[inproc] callback en erreur sur %s (%s)", msg.topic, self.client_id)
+
+
+def _to_bytes(payload) -> bytes:
+    if payload is None:
+        return b""
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, (bytearray, memoryview)):
+        return bytes(payload)
+    if isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    return str(payload).encode("utf-8")
+
+
+def attach_bridge(path: pathlib.Path, clock=None):
+    """Charge bridge/app.py et branche ses callbacks sur le bus ; None si le fichier est absent.
+
+    `clock` : horloge imposée au bridge (VirtualClock des scénarios), horloge réelle sinon.
+    """
+    if not path.exists():
+        log.warning("[inproc] bridge embarqué introuvable (%s)", path)
+        return None
+    os.environ["BRIDGE_EMBEDDED"] = "1"
+    sys.path.insert(0, str(path.parent))
+    try:
+        spec = importlib.util.spec_from_file_location("embedded_bridge", path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(path.parent))
+    client = module.attach(InprocClient(client_id=module.CLIENT_ID), clock_=clock)
+    client.connect()
+    log.info("[inproc] bridge embarqué attaché au bus (%s)", path)
+    return module
@@ -2,7 +2,7 @@ import threading
 from dataclasses import dataclass
 from typing import Dict, Literal, Optional
 
-from workers import BadgeuseWorker, DeviceWorker, DoorWorker
+from workers import BadgeuseWorker, DeviceWorker, DoorWorker, connect_gate, reconnect_stats
 
 
 @dataclass
@@ -27,8 +27,8 @@ class DeviceManager:
         to_stop: Optional[DeviceWorker] = None
         with self._lock:
             record = self._devices.get(device_id)
-            if record:
-                if record.kind != kind:
+            if not record or record.kind != kind:
+                if record:
                     to_stop = record.worker
                 new_worker = self._build_worker(kind, device_id, door_id)
                 record = DeviceRecord(kind, new_worker, door_id if kind == "badgeuse" else None)
@@ -45,11 +45,6 @@ class DeviceManager:
                 new_worker = self._build_worker(kind, device_id, record.door_id)
                 record.worker = new_worker
                 to_start = new_worker
-            else:
-                new_worker = self._build_worker(kind, device_id, door_id)
-                record = DeviceRecord(kind, new_worker, door_id if kind == "badgeuse" else None)
-                self._devices[device_id] = record
-                to_start = new_worker
         if to_stop:
             to_stop.stop()
             to_stop.join(timeout=2)
@@ -58,18 +53,57 @@ class DeviceManager:
         return record
 
     def remove(self, device_id: str) -> bool:
+        return self.remove_many([device_id]) == 1
+
+    def remove_many(self, device_ids) -> int:
+        """Arrête d'abord tous les workers, puis les attend : les arrêts se font en parallèle."""
         with self._lock:
-            record = self._devices.pop(device_id, None)
-        if not record:
-            return False
-        record.worker.stop()
-        record.worker.join(timeout=2)
-        return True
+            records = [record for record in (self._devices.pop(device_id, None) for device_id in device_ids) if record]
+        for record in records:
+            record.worker.stop()
+        for record in records:
+            record.worker.join(timeout=2)
+        return len(records)
 
     def get(self, device_id: str) -> Optional[DeviceRecord]:
         with self._lock:
             return self._devices.get(device_id)
 
+    # --- API "données seules" : même contrat que ShardedDeviceManager (sharding.py) ---
+    def create(self, kind: str, device_id: str, door_id: Optional[str], wait_s: float = 8.0) -> Dict:
+        record = self.ensure(kind, device_id, door_id)
+        ready = record.worker.wait_ready(timeout=wait_s)
+        device = {"id": device_id, "kind": record.kind, "status": "running" if ready else "starting", "ready": ready}
+        if record.kind == "badgeuse":
+            device["door_id"] = record.door_id
+        return device
+
+    def health(self, device_id: str) -> Optional[Dict]:
+        record = self.get(device_id)
+        return record.worker.health() if record else None
+
+    def door_action(self, device_id: str, action: str) -> Optional[Dict]:
+        """None si la porte est inconnue ; ValueError si l'action est invalide."""
+        record = self.get(device_id)
+        if not record or record.kind != "porte":
+            return None
+        if action not in {"open", "close", "toggle"}:
+            raise ValueError("Action invalide")
+        changed = record.worker.apply_action(action)
+        return {**record.worker.health(), "changed": changed}
+
+    def connection_stats(self) -> Dict:
+        return {"gate": connect_gate.snapshot(), **reconnect_stats.snapshot()}
+
+    def close(self) -> None:
+        with self._lock:
+            workers = [record.worker for record in self._devices.values()]
+            self._devices.clear()
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join(timeout=2)
+
     def list(self, kind: Optional[str] = None):
         with self._lock:
             items = []
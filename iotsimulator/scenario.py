@@ -0,0 +1,186 @@
+"""Journée de trafic simulée en temps virtuel (événements discrets), sans broker.
+
+Badgeuses et portes tournent sur le bus en mémoire avec le bridge embarqué ; l'horloge virtuelle
+saute d'une échéance à la suivante (badgeage, auto-close, debounce), donc 24 h de trafic d'un
+bâtiment passent en quelques secondes. Même graine => mêmes badgeages, mêmes messages (empreinte).
+
+Exemples :
+  python scenario.py --seed 42
+  python scenario.py --floors 8 --doors-per-floor 10 --people 2000 --hours 24 --json-out jour.json
+"""
+import argparse
+import os
+import sys
+
+# avant l'import de config : le scénario n'utilise que le bus en mémoire
+os.environ["SIMULATOR_TRANSPORT"] = "inproc"
+
+import hashlib
+import json
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+from clock import VirtualClock, set_clock
+from config import SIMULATOR_BRIDGE_APP, log
+from inproc import InprocClient, attach_bridge
+from manager import DeviceManager
+
+Swipe = Tuple[float, str, str]  # (secondes depuis minuit, badgeuse, badge)
+
+
+def _reader(floor: int, index: int) -> str:
+    return f"badgeuse-f{floor:02d}-{index:03d}"
+
+
+def _door(floor: int, index: int) -> str:
+    return f"porte-f{floor:02d}-{index:03d}"
+
+
+def _hour(rng: random.Random, mean: float, sigma: float, low: float, high: float) -> float:
+    return min(high, max(low, rng.gauss(mean, sigma))) * 3600
+
+
+def plan_day(args: argparse.Namespace, rng: random.Random) -> List[Swipe]:
+    """Profil d'une journée de bureau : arrivée, pause déjeuner, déplacements internes, départ.
+
+    Le rez-de-chaussée (étage 0) porte les accès extérieurs ; chaque personne a un étage de rattachement.
+    """
+    lobby = [_reader(0, i) for i in range(args.doors_per_floor)]
+    swipes: List[Swipe] = []
+    horizon = args.hours * 3600
+    for person in range(args.people):
+        badge = f"BADGE-{person:05d}"
+        floor = rng.randrange(args.floors)
+        home = [_reader(floor, i) for i in range(args.doors_per_floor)]
+        arrival = _hour(rng, 8.75, 0.75, 6.0, 11.0)
+        departure = max(arrival + 4 * 3600, _hour(rng, 17.75, 1.0, 12.0, 22.0))
+        swipes.append((arrival, rng.choice(lobby), badge))
+        swipes.append((arrival + rng.uniform(30, 300), rng.choice(home), badge))
+        if rng.random() < args.lunch_ratio:
+            out = _hour(rng, 12.25, 0.5, 11.0, 14.0)
+            if arrival < out < departure - 3600:
+                swipes.append((out, rng.choice(lobby), badge))
+                swipes.append((out + max(900.0, rng.gauss(3300, 900)), rng.choice(lobby), badge))
+        t = arrival
+        while args.moves_per_hour > 0:
+            t += rng.expovariate(args.moves_per_hour / 3600)
+            if t >= departure:
+                break
+            reader = rng.choice(home) if rng.random() < 0.7 else _reader(rng.randrange(args.floors), rng.randrange(args.doors_per_floor))
+            swipes.append((t, reader, badge))
+        swipes.append((departure, rng.choice(lobby), badge))
+    return sorted(s for s in swipes if s[0] < horizon)
+
+
+def run(args: argparse.Namespace) -> Dict:
+    rng = random.Random(args.seed)
+    start = datetime.fromisoformat(args.date).replace(tzinfo=timezone.utc).timestamp()
+    clock = VirtualClock(start)
+    set_clock(clock)
+
+    os.environ.setdefault("AUTO_CLOSE_SEC", str(args.auto_close))
+    os.environ.setdefault("DEBOUNCE_SEC", str(args.debounce))
+    bridge = attach_bridge(SIMULATOR_BRIDGE_APP, clock=clock)
+    if bridge is None:
+        raise SystemExit(f"bridge introuvable : {SIMULATOR_BRIDGE_APP}")
+
+    manager = DeviceManager()
+    workers = {}
+    devices = []
+    for floor in range(args.floors):
+        for index in range(args.doors_per_floor):
+            devices.append(manager.ensure("porte", _door(floor, index), None).worker)
+            workers[_reader(floor, index)] = manager.ensure("badgeuse", _reader(floor, index), _door(floor, index)).worker
+            devices.append(workers[_reader(floor, index)])
+    for worker in devices:
+        if not worker.wait_ready(10):
+            raise SystemExit(f"device non prêt : {worker.device_id}")
+
+    counts: Counter = Counter()
+    per_hour: Counter = Counter()
+    digest = hashlib.sha256()
+
+    def observe(client, userdata, msg):
+        kind = msg.topic.split("/")[-1]
+        counts[kind] += 1
+        if kind == "events":
+            per_hour[int((clock.time() - start) // 3600)] += 1
+        elif kind == "commands" and b'"CLOSE"' in msg.payload:
+            counts["auto_close"] += 1
+        elif kind == "state" and b'"is_open": true' in msg.payload:
+            counts["opened"] += 1
+        digest.update(f"{clock.time():.3f} {msg.topic} ".encode("utf-8") + msg.payload)
+
+    observer = InprocClient(client_id="scenario-observer")
+    observer.connect()
+    observer.subscribe([("iot/badgeuse/+/events", 1), ("iot/porte/+/commands", 1), ("iot/porte/+/state", 1)])
+    observer.on_message = observe
+    counts.clear()  # états retenus rejoués au subscribe
+
+    swipes = plan_day(args, rng)
+    for offset, reader, badge in swipes:
+        worker = workers[reader]
+        clock.call_at(start + offset, lambda w=worker, b=badge: w.swipe(b))
+
+    log.info("[scenario] %d badgeage(s) planifié(s) sur %sh, %d porte(s)", len(swipes), args.hours, len(workers))
+    t0 = time.perf_counter()
+    executed = clock.run_until(start + args.hours * 3600)
+    executed += clock.run()  # auto-close encore en attente en fin de journée
+    wall = time.perf_counter() - t0
+
+    manager.remove_many([worker.device_id for worker in devices])
+
+    simulated = clock.time() - start
+    return {
+        "seed": args.seed,
+        "date": args.date,
+        "doors": len(workers),
+        "people": args.people,
+        "swipes": len(swipes),
+        "badge_events": counts["events"],
+        "door_commands": counts["commands"],
+        "debounced": counts["events"] - (counts["commands"] - counts["auto_close"]),
+        "auto_closes": counts["auto_close"],
+        "door_opens": counts["opened"],
+        "state_messages": counts["state"],
+        "timers_executed": executed,
+        "per_hour": {f"{h:02d}h": per_hour[h] for h in sorted(per_hour)},
+        "simulated_s": round(simulated, 1),
+        "wall_s": round(wall, 3),
+        "speedup": round(simulated / wall) if wall > 0 else None,
+        "digest": digest.hexdigest()[:16],
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Journée de badgeages en temps virtuel sur le bus en mémoire.")
+    parser.add_argument("--seed", type=int, default=1, help="Graine du générateur (défaut: %(default)s).")
+    parser.add_argument("--date", default="2024-01-15", help="Jour simulé, minuit UTC (défaut: %(default)s).")
+    parser.add_argument("--hours", type=float, default=24.0, help="Durée simulée en heures (défaut: %(default)s).")
+    parser.add_argument("--floors", type=int, default=4, help="Nombre d'étages (défaut: %(default)s).")
+    parser.add_argument("--doors-per-floor", type=int, default=5, help="Portes (et badgeuses) par étage (défaut: %(default)s).")
+    parser.add_argument("--people", type=int, default=500, help="Occupants du bâtiment (défaut: %(default)s).")
+    parser.add_argument("--moves-per-hour", type=float, default=0.5, help="Déplacements internes par personne et par heure (défaut: %(default)s).")
+    parser.add_argument("--lunch-ratio", type=float, default=0.6, help="Part des occupants qui sortent déjeuner (défaut: %(default)s).")
+    parser.add_argument("--auto-close", type=int, default=5, help="AUTO_CLOSE_SEC du bridge si non défini (défaut: %(default)s).")
+    parser.add_argument("--debounce", type=int, default=2, help="DEBOUNCE_SEC du bridge si non défini (défaut: %(default)s).")
+    parser.add_argument("--json-out", help="Écrit le résumé JSON dans ce fichier.")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""Répartition des devices sur plusieurs processus (SIMULATOR_SHARDS > 1).
+
+Un processus ne dépasse pas un cœur (GIL) : décodage JSON et publications de milliers de devices se
+partagent le même interpréteur. ShardedDeviceManager lance N processus, chacun avec son propre
+DeviceManager ; un device appartient au shard désigné par hachage cohérent de son id (anneau à
+nœuds virtuels : changer le nombre de shards ne déplace qu'environ 1/N des devices).
+
+IPC : un Pipe par shard, requêtes multiplexées (identifiant de requête, réponses dans le désordre),
+donc une création qui attend la connexion MQTT ne bloque pas les autres appels du même shard.
+Le contrat (create/list/remove/remove_many/health/door_action) est celui de DeviceManager ; la liste agrégée
+conserve l'ordre de création global, comme en mono-processus.
+
+Un shard mort (crash, kill) n'est pas relancé : ses devices sont perdus, les appels qui lui sont
+destinés lèvent ShardUnavailable (503 côté API) et la liste / les stats agrégées l'ignorent. Un appel
+resté sans réponse après CALL_TIMEOUT_S est oublié et lève aussi ShardUnavailable.
+"""
+import bisect
+import hashlib
+import itertools
+import math
+import multiprocessing
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as CallTimeout
+from typing import Dict, List, Optional
+
+from config import SIMULATOR_MAX_CONNECTING, log
+
+RING_VNODES = 64
+CALL_TIMEOUT_S = 30.0
+
+
+class ShardUnavailable(RuntimeError):
+    def __init__(self, index: int, reason: str = "arrêté"):
+        super().__init__(f"shard {index} {reason}")
+        self.index = index
+
+
+class _Call(Future):
+    """Requête en attente de réponse du shard : garde son identifiant pour l'oublier à l'expiration."""
+
+    def __init__(self, req_id: int):
+        super().__init__()
+        self.req_id = req_id
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, shards: int, vnodes: int = RING_VNODES):
+        points = sorted((_point(f"shard-{s}#{v}"), s) for s in range(shards) for v in range(vnodes))
+        self._keys = [p for p, _ in points]
+        self._owners = [s for _, s in points]
+
+    def owner(self, device_id: str) -> int:
+        i = bisect.bisect(self._keys, _point(device_id)) % len(self._keys)
+        return self._owners[i]
+
+
+def _shard_main(index: int, conn, concurrency: int, max_connecting: int) -> None:
+    """Boucle du processus shard : exécute les appels sur son DeviceManager local."""
+    import workers
+    from reconnect import ConnectGate
+
+    # part du plafond global de CONNECT simultanés ; avant l'import de manager (qui importe le gate)
+    workers.connect_gate = ConnectGate(max_connecting)
+    from manager import DeviceManager
+
+    manager = DeviceManager()
+    send_lock = threading.Lock()
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"shard{index}")
+
+    def handle(req_id: int, op: str, args: tuple):
+        try:
+            reply = (req_id, True, getattr(manager, op)(*args))
+        except Exception as e:
+            reply = (req_id, False, e)
+        with send_lock:
+            conn.send(reply)
+
+    log.info("[shard %d] démarré", index)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        pool.submit(handle, *message)
+    pool.shutdown(wait=True)
+    manager.close()
+
+
+class _Shard:
+    def __init__(self, ctx, index: int, concurrency: int, max_connecting: int):
+        self.index = index
+        self._conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_shard_main, args=(index, child_conn, concurrency, max_connecting), name=f"simulator-shard-{index}", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self._send_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._dead = False
+        self._closing = False
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count(1)
+        self._reader = threading.Thread(target=self._read_loop, daemon=True, name=f"shard-{index}-reader")
+        self._reader.start()
+
+    def _read_loop(self) -> None:
+        while True:
+            try:
+                req_id, ok, value = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self._pending.pop(req_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        with self._state_lock:
+            self._dead = True
+            pending, self._pending = self._pending, {}
+        if not self._closing:
+            log.error("[shard %d] processus arrêté : ses devices sont perdus, appels en 503", self.index)
+        for future in pending.values():
+            future.set_exception(ShardUnavailable(self.index))
+
+    @property
+    def alive(self) -> bool:
+        return not self._dead and self.process.is_alive()
+
+    def submit(self, op: str, *args) -> _Call:
+        with self._state_lock:
+            if self._dead:
+                raise ShardUnavailable(self.index)
+            req_id = next(self._ids)
+            future = _Call(req_id)
+            # enregistré avant l'envoi (la réponse peut arriver avant le retour de send), retiré s'il échoue
+            self._pending[req_id] = future
+        try:
+            with self._send_lock:
+                self._conn.send((req_id, op, args))
+        except (OSError, ValueError) as e:
+            with self._state_lock:
+                self._pending.pop(req_id, None)
+            raise ShardUnavailable(self.index) from e
+        return future
+
+    def result(self, future: _Call):
+        """Résultat d'un submit() ; sans réponse après CALL_TIMEOUT_S, requête oubliée et ShardUnavailable."""
+        try:
+            return future.result(timeout=CALL_TIMEOUT_S)
+        except CallTimeout:
+            with self._state_lock:
+                self._pending.pop(future.req_id, None)
+            raise ShardUnavailable(self.index, f"sans réponse après {CALL_TIMEOUT_S:g}s") from None
+
+    def call(self, op: str, *args):
+        return self.result(self.submit(op, *args))
+
+    def close(self, timeout: float = 5.0) -> None:
+        self._closing = True
+        try:
+            with self._send_lock:
+                self._conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._conn.close()
+
+
+class ShardedDeviceManager:
+    def __init__(self, shards: int, concurrency: int = 16):
+        self.shards = shards
+        self._concurrency = concurrency
+        self._ring = HashRing(shards)
+        self._shards: List[_Shard] = []
+        self._lock = threading.Lock()
+        self._order: Dict[str, int] = {}   # device_id -> rang de première création (ordre de list())
+        self._seq = itertools.count()
+
+    def start(self) -> None:
+        # spawn : pas de fork d'un processus qui a déjà des threads (logging, MQTT)
+        ctx = multiprocessing.get_context("spawn")
+        # le plafond de CONNECT simultanés reste global : réparti entre les shards
+        max_connecting = math.ceil(SIMULATOR_MAX_CONNECTING / self.shards) if SIMULATOR_MAX_CONNECTING > 0 else 0
+        self._shards = [_Shard(ctx, i, self._concurrency, max_connecting) for i in range(self.shards)]
+        log.info("[shards] %d processus démarrés", self.shards)
+
+    def close(self) -> None:
+        for shard in self._shards:
+            shard.close()
+        self._shards = []
+
+    def _owner(self, device_id: str) -> _Shard:
+        return self._shards[self._ring.owner(device_id)]
+
+    def _gather(self, op: str, *args) -> List:
+        """Résultat de `op` sur chaque shard vivant (les shards morts sont ignorés)."""
+        calls = []
+        for shard in self._shards:
+            try:
+                calls.append((shard, shard.submit(op, *args)))
+            except ShardUnavailable:
+                continue
+        results = []
+        for shard, future in calls:
+            try:
+                results.append(shard.result(future))
+            except ShardUnavailable:
+                continue
+        return results
+
+    def create(self, kind: str, device_id: str, door_id: Optional[str], wait_s: float = 8.0) -> Dict:
+        with self._lock:
+            first = device_id not in self._order
+            if first:
+                self._order[device_id] = next(self._seq)
+        try:
+            return self._owner(device_id).call("create", kind, device_id, door_id, wait_s)
+        except Exception:
+            if first:
+                with self._lock:
+                    self._order.pop(device_id, None)
+            raise
+
+    def remove(self, device_id: str) -> bool:
+        removed = self._owner(device_id).call("remove", device_id)
+        if removed:
+            with self._lock:
+                self._order.pop(device_id, None)
+        return removed
+
+    def remove_many(self, device_ids) -> int:
+        by_shard: Dict[int, List[str]] = {}
+        for device_id in device_ids:
+            by_shard.setdefault(self._ring.owner(device_id), []).append(device_id)
+        calls = [(self._shards[index], self._shards[index].submit("remove_many", ids)) for index, ids in by_shard.items()]
+        removed = sum(shard.result(future) for shard, future in calls)
+        with self._lock:
+            for ids in by_shard.values():
+                for device_id in ids:
+                    self._order.pop(device_id, None)
+        return removed
+
+    def health(self, device_id: str) -> Optional[Dict]:
+        return self._owner(device_id).call("health", device_id)
+
+    def door_action(self, device_id: str, action: str) -> Optional[Dict]:
+        return self._owner(device_id).call("door_action", device_id, action)
+
+    def list(self, kind: Optional[str] = None) -> List[Dict]:
+        items = [item for shard_items in self._gather("list", kind) for item in shard_items]
+        with self._lock:
+            order = dict(self._order)
+        items.sort(key=lambda item: order.get(item["id"], len(order)))
+        return items
+
+    def connection_stats(self) -> Dict:
+        """Somme des shards ; la vague est refusionnée seconde par seconde."""
+        per_shard = self._gather("connection_stats")
+        kinds = ("attempts", "connects", "failures", "disconnects")
+        wave: Dict[int, List[int]] = {}
+        for stats in per_shard:
+            for row in stats["wave"]:
+                merged = wave.setdefault(row[0], [row[0], 0, 0, 0, 0])
+                for i in range(1, 5):
+                    merged[i] += row[i]
+        rows = [wave[second] for second in sorted(wave)]
+        gate = {key: sum(stats["gate"][key] for stats in per_shard) for key in ("limit", "in_flight", "waiting", "peak_in_flight")}
+        return {
+            "gate": gate,
+            **{kind: sum(stats[kind] for stats in per_shard) for kind in kinds},
+            "backoff_s": [stats["backoff_s"] for stats in per_shard],
+            "peak_connects_per_s": max((row[2] for row in rows), default=0),
+            "peak_attempts_per_s": max((row[1] for row in rows), default=0),
+            "wave": rows,
+        }
+
+    def shard_stats(self) -> List[Dict]:
+        out = []
+        for shard in self._shards:
+            try:
+                devices = len(shard.call("list", None))
+            except ShardUnavailable:
+                devices = None
+            out.append({"shard": shard.index, "pid": shard.process.pid, "alive": shard.alive, "devices": devices})
+        return out
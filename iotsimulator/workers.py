@@ -1,11 +1,46 @@
 import json
+import queue
+import random
+import select
+import socket
 import threading
+import time
 from typing import Dict, Optional
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
-from config import MQTT_HOST, MQTT_PASS, MQTT_PORT, MQTT_USER, log, now_iso
+from config import (
+    MQTT_HOST,
+    MQTT_PASS,
+    MQTT_PORT,
+    MQTT_USER,
+    SIMULATOR_MAX_CONNECTING,
+    SIMULATOR_RESUBSCRIBE_SPREAD_S,
+    SIMULATOR_TRANSPORT,
+    log,
+    log_events,
+    now_iso,
+)
+from inproc import InprocClient
+from profiling import timed
+from reconnect import Backoff, ConnectGate, ReconnectStats
+
+CONNECT_TIMEOUT_S = 10.0   # CONNACK attendu au-delà : tentative abandonnée, jeton du gate rendu
+
+# Politique partagée par tous les workers du process : un redémarrage du broker ne doit pas
+# provoquer des milliers de CONNECT simultanés.
+connect_gate = ConnectGate(SIMULATOR_MAX_CONNECTING)
+reconnect_stats = ReconnectStats()
+
+
+def new_client(client_id: str, protocol: int = mqtt.MQTTv311):
+    """Client paho, ou client du bus en mémoire si SIMULATOR_TRANSPORT=inproc (mêmes callbacks)."""
+    if SIMULATOR_TRANSPORT == "inproc":
+        return InprocClient(client_id=client_id, protocol=protocol)
+    return mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id=client_id, protocol=protocol)
 
 
 class DeviceWorker(threading.Thread):
@@ -14,11 +49,66 @@ class DeviceWorker(threading.Thread):
         self.device_id = device_id
         self.kind = kind
         self.ready = threading.Event()
-        self._stop = threading.Event()
+        self._stop_event = threading.Event()  # pas `_stop` : masquerait Thread._stop (join)
         self.connected = False
+        self.status_topic = f"iot/{kind}/{device_id}/status"
+        self._backoff = Backoff()
+        self._retry_at = 0.0
+        self._retry_pending = False
+        self._attempted = False
+        self._connecting_since: Optional[float] = None   # CONNECT envoyé, jeton du gate détenu
+        self._session_at: Optional[float] = None         # abonnements différés (reconnexion étalée)
+        self._sessions = 0
+        # publications demandées par d'autres threads (API, scénarios) : exécutées par le worker,
+        # seul thread à écrire sur la socket paho
+        self._calls: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    def _presence_payload(self, status: str) -> str:
+        return json.dumps({"device_id": self.device_id, "kind": self.kind, "status": status, "ts": now_iso()})
+
+    def _announce(self, client, status: str):
+        """Présence retenue (online/offline), la LWT couvre les coupures brutales."""
+        return client.publish(self.status_topic, self._presence_payload(status), qos=1, retain=True)
 
     def stop(self) -> None:
-        self._stop.set()
+        self._stop_event.set()
+        self._wake()
+
+    def _wake(self) -> None:
+        """Sort la boucle réseau de son select : sinon l'arrêt attend la fin du tour (≤ 0,25 s)."""
+        if isinstance(self.client, InprocClient):
+            self.client.wakeup()
+            return
+        try:
+            self._wake_w.send(b"0")
+        except OSError:
+            pass   # tampon plein (réveil déjà en attente) ou worker terminé
+
+    def _submit(self, fn, *args) -> None:
+        """Exécute fn sur le thread du worker ; appel direct depuis ce thread.
+
+        Le bus en mémoire n'a pas de socket et remet sous son propre verrou : appel direct aussi,
+        ce qui garde synchrones (et déterministes) les scénarios en temps virtuel.
+        """
+        if isinstance(self.client, InprocClient) or threading.current_thread() is self:
+            fn(*args)
+            return
+        self._calls.put((fn, args))
+        self._wake()
+
+    def _run_calls(self) -> None:
+        while True:
+            try:
+                fn, args = self._calls.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("[%s %s] appel différé en échec", self.kind, self.device_id)
 
     def wait_ready(self, timeout: float) -> bool:
         return self.ready.wait(timeout)
@@ -26,38 +116,172 @@ class DeviceWorker(threading.Thread):
     def health(self) -> Dict:
         return {"status": "ok", "device_id": self.device_id, "ready": self.ready.is_set()}
 
+    # --- session MQTT : boucle réseau pilotée par le worker (pas de thread paho en plus) -------
+    def _on_session(self, client) -> None:
+        """Abonnements + annonces de la session : rien par défaut, chaque type de device les ajoute."""
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
+        self._release_gate()
+        if getattr(reason_code, "is_failure", reason_code != 0):
+            log.error("[%s %s] connexion refusée (%s)", self.kind, self.device_id, reason_code)
+            self._schedule_retry("failures")
+            return
+        self.connected = True
+        self._backoff.reset()
+        reconnect_stats.record("connects")
+        log.info("[%s %s] connecté à %s:%s", self.kind, self.device_id, MQTT_HOST, MQTT_PORT)
+        if self._sessions == 0 or SIMULATOR_RESUBSCRIBE_SPREAD_S <= 0:
+            self._open_session(client)
+        else:
+            # reconnexion de masse : abonnements et annonces étalés, pas tous dans la même seconde
+            self._session_at = time.monotonic() + random.uniform(0, SIMULATOR_RESUBSCRIBE_SPREAD_S)
+
+    def _open_session(self, client) -> None:
+        self._session_at = None
+        self._sessions += 1
+        self._on_session(client)
+        self.ready.set()
+
+    def _on_disconnect(self, client, userdata, flags=None, reason_code=None, properties=None):
+        self._release_gate()
+        was_connected, self.connected = self.connected, False
+        self._session_at = None
+        self.ready.clear()
+        if self._stop_event.is_set():
+            return
+        log.warning("[%s %s] déconnecté (%s)", self.kind, self.device_id, reason_code)
+        self._schedule_retry("disconnects" if was_connected else "failures")
+
+    def _schedule_retry(self, kind: str) -> None:
+        if self._retry_pending:
+            return
+        delay = self._backoff.next_delay()
+        self._retry_pending = True
+        self._retry_at = time.monotonic() + delay
+        reconnect_stats.record(kind, delay)
+
+    def _release_gate(self) -> None:
+        if self._connecting_since is not None:
+            self._connecting_since = None
+            connect_gate.release()
+
+    def _try_connect(self) -> None:
+        if not connect_gate.acquire(self._stop_event):
+            return
+        self._retry_pending = False
+        self._connecting_since = time.monotonic()
+        reconnect_stats.record("attempts")
+        try:
+            if self._attempted:
+                self.client.reconnect()
+            else:
+                self._attempted = True
+                self.client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
+        except Exception as e:
+            self._release_gate()
+            log.debug("[%s %s] connexion impossible: %s", self.kind, self.device_id, e)
+            self._schedule_retry("failures")
+
+    def _network(self, timeout: float) -> int:
+        """Un tour réseau de ≤ timeout, interrompu par _wake() (équivalent de client.loop()).
+
+        API de boucle externe de paho (socket/want_write/loop_read/loop_write/loop_misc) : le
+        select couvre aussi la socketpair de réveil du worker, sans toucher à celle de paho.
+        """
+        client = self.client
+        if isinstance(client, InprocClient):
+            return client.loop(timeout=timeout)
+        sock = client.socket()
+        if sock is None:
+            return mqtt.MQTT_ERR_NO_CONN
+        try:
+            readable, writable, _ = select.select([sock, self._wake_r], [sock] if client.want_write() else [], [], timeout)
+        except (OSError, ValueError):
+            return mqtt.MQTT_ERR_CONN_LOST   # socket fermée pendant le select
+        if self._wake_r in readable:
+            try:
+                self._wake_r.recv(4096)
+            except OSError:
+                pass
+        if sock in readable:
+            rc = client.loop_read()
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                return rc
+        if sock in writable:
+            rc = client.loop_write()
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                return rc
+        return client.loop_misc()
+
+    def _pump(self) -> None:
+        """Un tour de boucle : publications en attente, (re)connexion si l'échéance est passée,
+        puis réseau pendant ≤ 0,25 s."""
+        self._run_calls()
+        now = time.monotonic()
+        if not self.connected and self._connecting_since is None:
+            if now < self._retry_at:
+                self._stop_event.wait(min(0.25, self._retry_at - now))
+                return
+            self._try_connect()
+        elif self._connecting_since is not None and now - self._connecting_since > CONNECT_TIMEOUT_S:
+            log.warning("[%s %s] CONNACK absent après %.0fs", self.kind, self.device_id, CONNECT_TIMEOUT_S)
+            self._release_gate()
+            self._schedule_retry("failures")
+            self.client.disconnect()
+            return
+        if self._session_at is not None and now >= self._session_at:
+            self._open_session(self.client)
+        if self._network(0.25) != mqtt.MQTT_ERR_SUCCESS:
+            # coupure sans on_disconnect (socket refusée pendant le CONNECT…) : même traitement
+            if self._connecting_since is not None or self.connected:
+                self._on_disconnect(self.client, None, None, "loop")
+            self._stop_event.wait(0.05)
+
+    def _flush(self, info, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while not info.is_published() and time.monotonic() < deadline:
+            if self._network(0.05) != mqtt.MQTT_ERR_SUCCESS:
+                return
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                self._pump()
+        finally:
+            try:
+                if self.connected:
+                    self._flush(self._announce(self.client, "offline"), 1.0)
+            except Exception:
+                pass
+            try:
+                self.client.disconnect()
+                self._network(0.05)
+            except Exception:
+                pass
+            self._release_gate()
+            self.ready.clear()
+            self._wake_r.close()
+            self._wake_w.close()
+
 
 class BadgeuseWorker(DeviceWorker):
     def __init__(self, device_id: str, door_id: Optional[str]):
         super().__init__(device_id, "badgeuse")
         self.door_id = door_id
-        self.client = mqtt.Client(
-            callback_api_version=CallbackAPIVersion.VERSION2,
-            client_id=f"sim-badgeuse-{device_id}",
-            protocol=mqtt.MQTTv311,
-        )
+        self.client = new_client(f"sim-badgeuse-{device_id}", mqtt.MQTTv311)
         if MQTT_USER:
             self.client.username_pw_set(MQTT_USER, MQTT_PASS)
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
+        self.client.will_set(self.status_topic, self._presence_payload("offline"), qos=1, retain=True)
         self.command_topic = f"iot/badgeuse/{device_id}/commands"
         self.command_filter = "iot/badgeuse/+/commands"
 
-    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
-        self.connected = reason_code == 0
-        if self.connected:
-            log.info("[badgeuse %s] connect  %s:%s", self.device_id, MQTT_HOST, MQTT_PORT)
-            client.subscribe(self.command_topic, qos=1)
-            client.subscribe(self.command_filter, qos=1)
-            self.ready.set()
-        else:
-            log.error("[badgeuse %s] connexion refuse (%s)", self.device_id, reason_code)
-
-    def _on_disconnect(self, client, userdata, reason_code, properties=None):
-        self.connected = False
-        self.ready.clear()
-        log.warning("[badgeuse %s] dconnecte (%s)", self.device_id, reason_code)
+    def _on_session(self, client):
+        client.subscribe(self.command_topic, qos=1)
+        client.subscribe(self.command_filter, qos=1)
+        self._announce(client, "online")
 
     def _normalize_payload(self, payload: Dict) -> tuple[str, Optional[str]]:
         badge_id = str(payload.get("badgeID") or payload.get("badge_id") or payload.get("tag_id") or "BADGE-TEST")
@@ -73,8 +297,13 @@ class BadgeuseWorker(DeviceWorker):
         }
         topic = f"iot/badgeuse/{self.device_id}/events"
         self.client.publish(topic, json.dumps(message), qos=1, retain=False)
-        log.info("[badgeuse %s] badge=%s door=%s", self.device_id, badge_id, door_id or "-")
+        log_events.info("[badgeuse %s] badge=%s door=%s", self.device_id, badge_id, door_id or "-")
+
+    def swipe(self, badge_id: str, door_id: Optional[str] = None) -> None:
+        """Badgeage local (scénarios) : publie l'event sans passer par le topic de commandes."""
+        self._submit(self._publish_badge_event, badge_id, door_id or self.door_id)
 
+    @timed("simulator.badgeuse.on_message")
     def _on_message(self, client, userdata, msg):
         try:
             payload = json.loads(msg.payload.decode("utf-8"))
@@ -89,23 +318,6 @@ class BadgeuseWorker(DeviceWorker):
             log.debug("[badgeuse %s] commande sans doorID", self.device_id)
         self._publish_badge_event(badge_id, door_id)
 
-    def run(self):
-        self.client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-        self.client.loop_start()
-        try:
-            while not self._stop.wait(0.25):
-                pass
-        finally:
-            try:
-                self.client.loop_stop()
-            except Exception:
-                pass
-            try:
-                self.client.disconnect()
-            except Exception:
-                pass
-            self.ready.clear()
-
     def health(self) -> Dict:
         base = super().health()
         base.update({"door_id": self.door_id, "mqtt_connected": self.connected})
@@ -115,35 +327,23 @@ class BadgeuseWorker(DeviceWorker):
 class DoorWorker(DeviceWorker):
     def __init__(self, device_id: str):
         super().__init__(device_id, "porte")
-        self.client = mqtt.Client(
-            callback_api_version=CallbackAPIVersion.VERSION2,
-            client_id=f"sim-porte-{device_id}",
-            protocol=mqtt.MQTTv311,
-        )
+        # MQTT v5 : ResponseTopic / CorrelationData des commandes en requête/réponse
+        self.client = new_client(f"sim-porte-{device_id}", mqtt.MQTTv5)
         if MQTT_USER:
             self.client.username_pw_set(MQTT_USER, MQTT_PASS)
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
+        self.client.will_set(self.status_topic, self._presence_payload("offline"), qos=1, retain=True)
         self.command_topic = f"iot/porte/{device_id}/commands"
         self.state_topic = f"iot/porte/{device_id}/state"
         self.state = {"is_open": False, "last_change": None}
         self._state_lock = threading.Lock()
 
-    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
-        self.connected = reason_code == 0
-        if self.connected:
-            client.subscribe(self.command_topic, qos=1)
-            self.ready.set()
-            log.info("[porte %s] connecte  %s:%s", self.device_id, MQTT_HOST, MQTT_PORT)
-            self._publish_state()
-        else:
-            log.error("[porte %s] connexion refuse (%s)", self.device_id, reason_code)
-
-    def _on_disconnect(self, client, userdata, reason_code, properties=None):
-        self.connected = False
-        self.ready.clear()
-        log.warning("[porte %s] dconnecte (%s)", self.device_id, reason_code)
+    def _on_session(self, client):
+        client.subscribe(self.command_topic, qos=1)
+        self._announce(client, "online")
+        self._publish_state()
 
     def _publish_state(self):
         payload = {
@@ -154,20 +354,34 @@ class DoorWorker(DeviceWorker):
         }
         self.client.publish(self.state_topic, json.dumps(payload), qos=1, retain=True)
 
-    def apply_action(self, action: str):
+    def apply_action(self, action: str) -> bool:
+        """open / close / toggle ; False si l'action ne change rien."""
         action = action.lower()
         if action not in {"open", "close", "toggle"}:
             raise ValueError("Action invalide")
         with self._state_lock:
-            if action == "toggle":
-                self.state["is_open"] = not self.state["is_open"]
-            else:
-                self.state["is_open"] = action == "open"
-            self.state["last_change"] = now_iso()
-        if self.connected:
-            self._publish_state()
-        log.info("[porte %s] action=%s -> is_open=%s", self.device_id, action, self.state["is_open"])
+            target = (not self.state["is_open"]) if action == "toggle" else action == "open"
+            changed = target != self.state["is_open"]
+            if changed:
+                self.state["is_open"] = target
+                self.state["last_change"] = now_iso()
+        if changed and self.connected:
+            self._submit(self._publish_state)
+        log_events.info("[porte %s] action=%s -> is_open=%s", self.device_id, action, self.state["is_open"])
+        return changed
+
+    def _reply(self, msg, body: Dict):
+        """Ack MQTT v5 sur le ResponseTopic de la requête, avec sa CorrelationData."""
+        response_topic = getattr(msg.properties, "ResponseTopic", None)
+        if not response_topic:
+            return
+        props = Properties(PacketTypes.PUBLISH)
+        correlation = getattr(msg.properties, "CorrelationData", None)
+        if correlation is not None:
+            props.CorrelationData = correlation
+        self.client.publish(response_topic, json.dumps({"device_id": self.device_id, **body}), qos=1, properties=props)
 
+    @timed("simulator.porte.on_message")
     def _on_message(self, client, userdata, msg):
         try:
             payload = json.loads(msg.payload.decode("utf-8"))
@@ -179,25 +393,12 @@ class DoorWorker(DeviceWorker):
             return
         action = str(payload.get("action") or "").lower()
         if action not in {"open", "close", "toggle"}:
+            self._reply(msg, {"ok": False, "error": f"unknown action {action!r}"})
             return
-        self.apply_action(action)
-
-    def run(self):
-        self.client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-        self.client.loop_start()
-        try:
-            while not self._stop.wait(0.25):
-                pass
-        finally:
-            try:
-                self.client.loop_stop()
-            except Exception:
-                pass
-            try:
-                self.client.disconnect()
-            except Exception:
-                pass
-            self.ready.clear()
+        changed = self.apply_action(action)
+        with self._state_lock:
+            state_snapshot = dict(self.state)
+        self._reply(msg, {"ok": True, "changed": changed, **state_snapshot})
 
     def health(self) -> Dict:
         base = super().health()
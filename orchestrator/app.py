@@ -1,12 +1,27 @@
-import os, logging, time, json, pathlib
-from typing import Literal, Optional, Dict, Tuple
-from fastapi import FastAPI, HTTPException, Body, Query
+import os, time, json, pathlib, threading, uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Literal, Optional, Dict, Tuple, List
+from fastapi import FastAPI, HTTPException, Body, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import docker, requests
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import sys
+# modules partagés (common/) : copiés à côté du code dans l'image Docker, lus dans le dépôt en local
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from logging_setup import setup_logging
+from profiling import install_debug_routes, timed
+from plan_http import PlanResponder, parse_fields
+from plan_store import PlanConflict, PlanPatchError, PlanStore
+from spatial_index import SpatialIndexes, check_geometry, is_finite_point, parse_bbox
 
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("orchestrator")
+log = setup_logging("orchestrator")
 
 # --- Config broker/images ---
 MQTT_HOST      = os.getenv("MQTT_HOST", "host.docker.internal")
@@ -14,6 +29,35 @@ MQTT_PORT      = int(os.getenv("MQTT_PORT", "1883"))
 IMAGE_BADGEUSE = os.getenv("IMAGE_BADGEUSE", "iot-badgeuse:latest")
 IMAGE_PORTE    = os.getenv("IMAGE_PORTE", "iot-porte:latest")
 DOCKER_NETWORK = os.getenv("DOCKER_NETWORK")  # ex: "badgeusedoor_iot"
+PRESENCE_TOPIC = os.getenv("PRESENCE_TOPIC", "iot/+/+/status")  # présence retenue publiée par les devices
+DOOR_ACK_TIMEOUT_SEC = float(os.getenv("DOOR_ACK_TIMEOUT_SEC", "3"))  # attente de l'ack MQTT v5 d'une porte
+# --- Provisioning asynchrone (jobs) ---
+PROVISION_CONCURRENCY  = int(os.getenv("PROVISION_CONCURRENCY", "8"))     # containers créés en parallèle
+BACKGROUND_CONCURRENCY = int(os.getenv("BACKGROUND_CONCURRENCY", "4"))    # warm pool, réconciliation, replacements (hors jobs)
+PROVISION_RETRIES      = int(os.getenv("PROVISION_RETRIES", "3"))         # tentatives supplémentaires sur erreur transitoire
+PROVISION_BACKOFF_SEC  = float(os.getenv("PROVISION_BACKOFF_SEC", "0.5")) # délai initial, doublé à chaque essai
+PROVISION_READY_SEC    = float(os.getenv("PROVISION_READY_SEC", "12"))
+JOBS_KEEP              = int(os.getenv("JOBS_KEEP", "100"))               # jobs terminés conservés en mémoire
+# --- Warm pool : containers démarrés à l'avance, identité attribuée au claim ---
+WARM_POOL_SIZE = {
+    "badgeuse": int(os.getenv("WARM_POOL_BADGEUSE", "0")),
+    "porte":    int(os.getenv("WARM_POOL_PORTE", "0")),
+}
+WARM_POOL_INTERVAL_SEC = float(os.getenv("WARM_POOL_INTERVAL_SEC", "2"))
+# --- Mode packing : plusieurs devices par container "device host" (image du simulateur) ---
+PACKING_MODE      = os.getenv("PACKING_MODE", "") == "1"
+DEVICES_PER_HOST  = int(os.getenv("DEVICES_PER_HOST", "50"))
+IMAGE_DEVICE_HOST = os.getenv("IMAGE_DEVICE_HOST", "badgeusedoor/iotbadgedoorsimulator:latest")
+DEVICE_HOST_PORT  = 9002
+# --- Réconciliation : les plans sauvegardés sont l'état désiré ---
+RECONCILE       = os.getenv("RECONCILE", "") == "1"
+RECONCILE_RATE  = float(os.getenv("RECONCILE_RATE", "5"))    # actions (create/remove) par seconde
+RECONCILE_BURST = int(os.getenv("RECONCILE_BURST", "10"))
+# --- Coût des devices : un flux `docker stats` par container, agrégé en mémoire (servi par /stats) ---
+STATS_ENABLED       = os.getenv("STATS", "1") == "1"
+STATS_INTERVAL_SEC  = float(os.getenv("STATS_INTERVAL_SEC", "5"))     # période d'agrégation (un point d'historique)
+STATS_HISTORY_SEC   = float(os.getenv("STATS_HISTORY_SEC", "600"))    # historique glissant conservé
+STATS_DISCOVERY_SEC = float(os.getenv("STATS_DISCOVERY_SEC", "15"))   # re-scan des containers à suivre
 PAYLOAD_SCHEMA = {
     "badge_events": {"badgeID": "string", "doorID": "string", "timestamp": "ISO8601"},
     "door_commands": {"doorID": "string", "badgeID": "string", "action": "OPEN|CLOSE|TOGGLE", "timestamp": "ISO8601"},
@@ -23,18 +67,34 @@ PAYLOAD_SCHEMA = {
 client = docker.from_env()
 client.ping()
 
-app = FastAPI(title="IoT Orchestrator v4")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    _presence_start()
+    if PACKING_MODE:
+        _packing_start()
+    else:
+        _warm_pool_start()
+    if RECONCILE:
+        _reconcile_start()
+    if STATS_ENABLED:
+        _stats_start()
+    yield
+    _warm_pool_stop.set()
+    _stats_stop.set()
+    mqtt_client.loop_stop()
 
-PLANS_FILE = pathlib.Path("/data/plans.json")
-PLANS_FILE.parent.mkdir(parents=True, exist_ok=True)
+app = FastAPI(title="IoT Orchestrator v4", lifespan=lifespan)
+install_debug_routes(app)
 
-def _load_plans():
-    if PLANS_FILE.exists():
-        return json.loads(PLANS_FILE.read_text(encoding="utf-8"))
-    return []
+PLANS_FILE = pathlib.Path(os.getenv("ORCHESTRATOR_DATA_DIR", "/data")) / "plans.json"
+PLANS_FILE.parent.mkdir(parents=True, exist_ok=True)
+ASSIGNMENTS_FILE = PLANS_FILE.parent / "assignments.json"
+PLACEMENTS_FILE = PLANS_FILE.parent / "placements.json"
 
-def _save_plans(plans):
-    PLANS_FILE.write_text(json.dumps(plans, ensure_ascii=False, indent=2), encoding="utf-8")
+# snapshot + journal de patchs par étage (plans.json = ancien format, migré au démarrage)
+plans = PlanStore(PLANS_FILE.parent, legacy_file=PLANS_FILE, validate=check_geometry)
+indexes = SpatialIndexes(plans)   # grille par étage, mise à jour à chaque POST/PATCH
+plan_responses = PlanResponder(plans)   # ETag + corps JSON/gzip/br en cache par version
 
 # CORS
 app.add_middleware(
@@ -51,6 +111,14 @@ class CreateDevice(BaseModel):
     device_id: str
     door_id: Optional[str] = None  # <— seulement pertinent pour badgeuse
 
+class PlanPatch(BaseModel):
+    version: Optional[int] = None           # version connue du client (contrôle optimiste)
+    ops: List[dict]
+
+class ProvisionJob(BaseModel):
+    floor_id: Optional[str] = None          # provisionne tous les devices du plan
+    devices: Optional[List[CreateDevice]] = None
+
 # --------- Helpers Docker ----------
 def _internal_port(kind: str) -> int:
     return 8000 if kind == "badgeuse" else 8001
@@ -62,15 +130,20 @@ def _service_url_for(device_id: str, kind: str) -> str:
     return f"http://{device_id}:{_internal_port(kind)}"
 
 def _wait_ready(url: str, timeout_s: float = 10.0) -> bool:
+    """Attend /ready (HTTP up *et* session MQTT établie) ; /health pour les images sans /ready."""
     deadline = time.time() + timeout_s
+    probe = "/ready"
     while time.time() < deadline:
         try:
-            r = requests.get(f"{url}/health", timeout=1.5)
+            r = requests.get(f"{url}{probe}", timeout=1.5)
             if r.ok:
                 return True
+            if r.status_code == 404 and probe == "/ready":
+                probe = "/health"
+                continue
         except Exception:
             pass
-        time.sleep(0.4)
+        time.sleep(0.2)
     return False
 
 def _env_of(container) -> Dict[str, str]:
@@ -120,6 +193,7 @@ def _run_container(kind: str, device_id: str, door_id: Optional[str]):
     c.reload()
     return c
 
+@timed("orchestrator._ensure_running")
 def _ensure_running(kind: str, device_id: str, door_id: Optional[str]) -> Tuple[object, str]:
     """
     Démarre (ou recrée si nécessaire) le container.
@@ -133,22 +207,28 @@ def _ensure_running(kind: str, device_id: str, door_id: Optional[str]) -> Tuple[
         if existing_kind != kind:
             log.info(f"[ensure] kind mismatch: have={existing_kind} want={kind} -> recreate")
             c.remove(force=True)
+            _forget_assignment(c.id)
+            _mark_offline(device_id)
             c = _run_container(kind, device_id, door_id)
         else:
             # Si badgeuse, vérifier DOOR_ID
             if kind == "badgeuse":
-                env = _env_of(c)
-                cur = env.get("DOOR_ID") or c.labels.get("iot.door_id")
+                cur = _door_id_of(c)
                 if door_id and cur != door_id:
-                    log.info(f"[ensure] badgeuse DOOR_ID change {cur!r} -> {door_id!r}, recreating container")
-                    # préserver le réseau cible
-                    c.remove(force=True)
-                    c = _run_container(kind, device_id, door_id)
+                    if c.status == "running" and _push_identity(c, _service_url_for(device_id, kind), device_id, door_id):
+                        log.info(f"[ensure] badgeuse DOOR_ID change {cur!r} -> {door_id!r} (runtime config)")
+                    else:
+                        log.info(f"[ensure] badgeuse DOOR_ID change {cur!r} -> {door_id!r}, recreating container")
+                        # préserver le réseau cible
+                        c.remove(force=True)
+                        _forget_assignment(c.id)
+                        _mark_offline(device_id)
+                        c = _run_container(kind, device_id, door_id)
             if c.status != "running":
                 c.start()
                 c.reload()
     except docker.errors.NotFound:
-        c = _run_container(kind, device_id, door_id)
+        c = _claim_warm(kind, device_id, door_id) or _run_container(kind, device_id, door_id)
 
     k = c.labels.get("iot.kind", kind)
     return c, _service_url_for(device_id, k)
@@ -159,6 +239,10 @@ def _service_url_by_id(device_id: str) -> str:
     return _service_url_for(device_id, k)
 
 def _door_id_of(container) -> Optional[str]:
+    # une identité attribuée à chaud (warm pool / rewiring) prime sur le label, immuable
+    assigned = _assignment_of(container.id)
+    if assigned is not None:
+        return assigned.get("door_id")
     # priorité au label (source de vérité posée par l'orchestrateur), fallback env
     lbl = container.labels.get("iot.door_id")
     if lbl:
@@ -166,6 +250,880 @@ def _door_id_of(container) -> Optional[str]:
     env = _env_of(container)
     return env.get("DOOR_ID")
 
+# --------- Présence MQTT ----------
+# Un seul abonnement à toutes les présences : la readiness devient événementielle,
+# plus besoin de poller /health device par device.
+mqtt_connected = False
+_presence_cond = threading.Condition()
+_presence: Dict[str, bool] = {}      # device_id -> online
+
+_mqtt_client_id = f"orchestrator-{uuid.uuid4().hex[:6]}"
+DOOR_REPLY_TOPIC = f"orchestrator/{_mqtt_client_id}/door-acks"   # ResponseTopic des commandes de porte
+
+def _on_mqtt_connect(client, userdata, flags, reason_code, properties=None):
+    global mqtt_connected
+    mqtt_connected = reason_code == 0
+    if mqtt_connected:
+        client.subscribe([(PRESENCE_TOPIC, 1), (DOOR_REPLY_TOPIC, 1)])
+        log.info(f"[presence] subscribed {PRESENCE_TOPIC} on {MQTT_HOST}:{MQTT_PORT}")
+    else:
+        log.error(f"[presence] MQTT connect failed: {reason_code}")
+
+def _on_mqtt_disconnect(client, userdata, flags, reason_code, properties=None):
+    global mqtt_connected
+    mqtt_connected = False
+    log.warning(f"[presence] MQTT disconnected: {reason_code}")
+
+def _on_presence(client, userdata, msg):
+    parts = msg.topic.split("/")   # iot/<kind>/<device_id>/status
+    if len(parts) != 4:
+        return
+    online = False
+    if msg.payload:
+        try:
+            online = json.loads(msg.payload).get("status") == "online"
+        except Exception:
+            return
+    with _presence_cond:
+        _presence[parts[2]] = online
+        _presence_cond.notify_all()
+
+# --------- Commandes de porte (requête/réponse MQTT v5) ----------
+# Un aller-retour broker au lieu de résolution docker + polling + HTTP vers le container.
+_door_waiters_lock = threading.Lock()
+_door_waiters: Dict[bytes, dict] = {}   # CorrelationData -> {"event", "reply"}
+
+def _on_door_ack(client, userdata, msg):
+    correlation = getattr(msg.properties, "CorrelationData", None)
+    with _door_waiters_lock:
+        waiter = _door_waiters.get(correlation)
+    if waiter is None:
+        return  # ack arrivé après le timeout
+    try:
+        waiter["reply"] = json.loads(msg.payload)
+    except Exception:
+        waiter["reply"] = {"ok": False, "error": "invalid ack payload"}
+    waiter["event"].set()
+
+def _door_request(device_id: str, action: str, timeout_s: float) -> Optional[dict]:
+    """Publie la commande avec ResponseTopic/CorrelationData ; None si pas d'ack dans le délai."""
+    correlation = uuid.uuid4().bytes
+    waiter = {"event": threading.Event(), "reply": None}
+    props = Properties(PacketTypes.PUBLISH)
+    props.ResponseTopic = DOOR_REPLY_TOPIC
+    props.CorrelationData = correlation
+    with _door_waiters_lock:
+        _door_waiters[correlation] = waiter
+    try:
+        payload = json.dumps({"action": action, "doorID": device_id, "source": "orchestrator", "ts": _now_iso()})
+        mqtt_client.publish(f"iot/porte/{device_id}/commands", payload, qos=1, properties=props)
+        if not waiter["event"].wait(timeout_s):
+            return None
+        return waiter["reply"]
+    finally:
+        with _door_waiters_lock:
+            _door_waiters.pop(correlation, None)
+
+mqtt_client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id=_mqtt_client_id, protocol=mqtt.MQTTv5)
+if os.getenv("MQTT_USER"):
+    mqtt_client.username_pw_set(os.getenv("MQTT_USER"), os.getenv("MQTT_PASS", ""))
+mqtt_client.on_connect = _on_mqtt_connect
+mqtt_client.on_disconnect = _on_mqtt_disconnect
+mqtt_client.on_message = _on_presence
+mqtt_client.message_callback_add(DOOR_REPLY_TOPIC, _on_door_ack)
+mqtt_client.reconnect_delay_set(min_delay=1, max_delay=10)
+
+def _presence_start():
+    mqtt_client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=30)
+    mqtt_client.loop_start()
+
+def _wait_online(device_id: str, timeout_s: float) -> bool:
+    with _presence_cond:
+        return _presence_cond.wait_for(lambda: _presence.get(device_id, False), timeout=timeout_s)
+
+def _mark_offline(device_id: str):
+    """Le container vient d'être supprimé : on n'attend pas la LWT (keepalive) pour le savoir."""
+    with _presence_cond:
+        _presence[device_id] = False
+    if mqtt_connected:
+        for kind in ("badgeuse", "porte"):
+            mqtt_client.publish(f"iot/{kind}/{device_id}/status", b"", qos=1, retain=True)
+
+def _device_ready(device_id: str, kind: str, timeout_s: float) -> bool:
+    """Readiness par présence MQTT ; repli sur le polling HTTP si le broker est injoignable."""
+    if mqtt_connected:
+        return _wait_online(device_id, timeout_s)
+    return _wait_ready(_service_url_for(device_id, kind), timeout_s)
+
+# --------- Warm pool ----------
+_pool_lock = threading.Lock()
+_warm_idle: Dict[str, deque] = {"badgeuse": deque(), "porte": deque()}   # ids de containers prêts, sans identité
+_warm_spawning: Dict[str, int] = {"badgeuse": 0, "porte": 0}
+_warm_pool_stop = threading.Event()
+
+def _load_assignments() -> Dict[str, dict]:
+    if ASSIGNMENTS_FILE.exists():
+        return json.loads(ASSIGNMENTS_FILE.read_text(encoding="utf-8"))
+    return {}
+
+_assignments: Dict[str, dict] = _load_assignments()   # container.id -> {"device_id", "door_id"}
+
+def _save_assignments():
+    with _pool_lock:
+        data = json.dumps(_assignments, ensure_ascii=False, indent=2)
+    ASSIGNMENTS_FILE.write_text(data, encoding="utf-8")
+
+def _assignment_of(container_id: str) -> Optional[dict]:
+    with _pool_lock:
+        return _assignments.get(container_id)
+
+def _forget_assignment(container_id: str):
+    with _pool_lock:
+        removed = _assignments.pop(container_id, None)
+    if removed is not None:
+        _save_assignments()
+
+def _push_identity(container, url: str, device_id: str, door_id: Optional[str]) -> bool:
+    """Attribue l'identité via le canal de config runtime du device (POST /config)."""
+    kind = container.labels.get("iot.kind")
+    body = {"device_id": device_id}
+    if kind == "badgeuse":
+        body["door_id"] = door_id or ""
+    try:
+        r = requests.post(f"{url}/config", json=body, timeout=2)
+        if not r.ok:
+            return False
+    except Exception as e:
+        log.warning(f"[pool] runtime config failed for {container.name}: {e}")
+        return False
+    with _pool_lock:
+        _assignments[container.id] = {"device_id": device_id, "door_id": door_id if kind == "badgeuse" else None}
+    _save_assignments()
+    return True
+
+def _spawn_warm(kind: str):
+    name = f"warm-{kind}-{uuid.uuid4().hex[:8]}"
+    try:
+        kwargs = {
+            "image": _image_for(kind),
+            "name": name,
+            "environment": {**_compose_env(kind, name, None), "WARM_POOL": "1"},
+            "labels": {"iot": "true", "iot.kind": kind, "iot.pool": "true"},
+            "detach": True,
+            "restart_policy": {"Name": "unless-stopped"},
+        }
+        if DOCKER_NETWORK:
+            kwargs["network"] = DOCKER_NETWORK
+        c = client.containers.run(**kwargs)
+        if _wait_ready(_service_url_for(name, kind), PROVISION_READY_SEC):
+            with _pool_lock:
+                _warm_idle[kind].append(c.id)
+        else:
+            log.warning(f"[pool] {name} not ready, discarding")
+            c.remove(force=True)
+    except Exception as e:
+        log.warning(f"[pool] unable to spawn warm {kind}: {e}")
+    finally:
+        with _pool_lock:
+            _warm_spawning[kind] -= 1
+
+def _warm_pool_refill():
+    for kind, target in WARM_POOL_SIZE.items():
+        with _pool_lock:
+            missing = target - len(_warm_idle[kind]) - _warm_spawning[kind]
+            if missing > 0:
+                _warm_spawning[kind] += missing
+        for _ in range(max(0, missing)):
+            _background_pool.submit(_spawn_warm, kind)
+
+def _warm_pool_loop():
+    while True:
+        try:
+            _warm_pool_refill()
+        except Exception:
+            log.exception("[pool] refill failed")
+        if _warm_pool_stop.wait(WARM_POOL_INTERVAL_SEC):
+            return
+
+def _warm_pool_start():
+    if not any(WARM_POOL_SIZE.values()):
+        return
+    # récupère les containers de pool encore libres d'un précédent démarrage
+    for c in client.containers.list(filters={"label": ["iot.pool=true"]}):
+        kind = c.labels.get("iot.kind")
+        if kind in _warm_idle and _assignment_of(c.id) is None:
+            _warm_idle[kind].append(c.id)
+    log.info(f"[pool] warm pool target={WARM_POOL_SIZE} idle={ {k: len(v) for k, v in _warm_idle.items()} }")
+    threading.Thread(target=_warm_pool_loop, name="warm-pool", daemon=True).start()
+
+def _claim_warm(kind: str, device_id: str, door_id: Optional[str]):
+    """Prend un container du pool, lui attribue son identité et le renomme. None si pool vide."""
+    while True:
+        with _pool_lock:
+            if not _warm_idle.get(kind):
+                return None
+            cid = _warm_idle[kind].popleft()
+        try:
+            c = client.containers.get(cid)
+            if c.status != "running" or not _push_identity(c, _service_url_for(c.name, kind), device_id, door_id):
+                raise RuntimeError(f"warm container {c.name} unusable")
+            c.rename(device_id)
+            c.reload()
+            log.info(f"[pool] claimed {cid[:12]} as {kind} {device_id} door_id={door_id!r}")
+            return c
+        except Exception as e:
+            log.warning(f"[pool] claim of {cid[:12]} failed: {e}")
+            try:
+                client.containers.get(cid).remove(force=True)
+            except Exception:
+                pass
+            _forget_assignment(cid)
+
+# --------- Mode packing (device hosts) ----------
+_packing_lock = threading.Lock()
+_hosts: Dict[str, dict] = {}        # nom du host -> {"count": n, "ready": Event, "ok": bool}
+
+def _load_placements() -> Dict[str, dict]:
+    if PLACEMENTS_FILE.exists():
+        return json.loads(PLACEMENTS_FILE.read_text(encoding="utf-8"))
+    return {}
+
+_placements: Dict[str, dict] = _load_placements()   # device_id -> {"host", "kind", "door_id"}
+
+def _save_placements():
+    with _packing_lock:
+        data = json.dumps(_placements, ensure_ascii=False, indent=2)
+    PLACEMENTS_FILE.write_text(data, encoding="utf-8")
+
+def _host_url(host: str) -> str:
+    return f"http://{host}:{DEVICE_HOST_PORT}"
+
+def _start_host(name: str):
+    kwargs = {
+        "image": IMAGE_DEVICE_HOST,
+        "name": name,
+        "environment": {
+            "MQTT_HOST": MQTT_HOST,
+            "MQTT_PORT": str(MQTT_PORT),
+            "MQTT_USER": os.getenv("MQTT_USER", ""),
+            "MQTT_PASS": os.getenv("MQTT_PASS", ""),
+        },
+        "labels": {"iot.host": "true"},
+        "detach": True,
+        "restart_policy": {"Name": "unless-stopped"},
+    }
+    if DOCKER_NETWORK:
+        kwargs["network"] = DOCKER_NETWORK
+    try:
+        client.containers.run(**kwargs)
+        ok = _wait_ready(_host_url(name), PROVISION_READY_SEC)
+    except Exception as e:
+        log.warning(f"[packing] unable to start host {name}: {e}")
+        ok = False
+    with _packing_lock:
+        host = _hosts[name]
+        host["ok"] = ok
+        if not ok:
+            _hosts.pop(name, None)
+    host["ready"].set()
+    log.info(f"[packing] host {name} started ok={ok}")
+
+def _reserve_slot(device_id: str) -> str:
+    """Best-fit : le host le plus rempli qui a encore de la place, sinon un nouveau host."""
+    new_host = None
+    with _packing_lock:
+        placed = _placements.get(device_id)
+        if placed and placed["host"] in _hosts:
+            return placed["host"]
+        candidates = [(h["count"], name) for name, h in _hosts.items() if h["count"] < DEVICES_PER_HOST]
+        if candidates:
+            _, name = max(candidates)
+        else:
+            name = new_host = f"devhost-{uuid.uuid4().hex[:8]}"
+            _hosts[name] = {"count": 0, "ready": threading.Event(), "ok": False}
+        _hosts[name]["count"] += 1
+    if new_host:
+        _start_host(new_host)
+    return name
+
+def _release_slot(host: str):
+    with _packing_lock:
+        h = _hosts.get(host)
+        if not h:
+            return
+        h["count"] -= 1
+        empty = h["count"] <= 0 and h["ready"].is_set()
+        if empty:
+            _hosts.pop(host, None)
+    if empty:
+        try:
+            client.containers.get(host).remove(force=True)
+            log.info(f"[packing] host {host} empty -> removed")
+        except docker.errors.NotFound:
+            pass
+
+def _packed_ensure(kind: str, device_id: str, door_id: Optional[str]) -> dict:
+    """Place (ou met à jour) un device sur un device host. Retourne la vue /devices du device."""
+    with _packing_lock:
+        previous = _placements.get(device_id)
+    host = _reserve_slot(device_id)
+    fresh = previous is None or previous["host"] != host
+    with _packing_lock:
+        h = _hosts.get(host)
+    if h is None or not h["ready"].wait(PROVISION_READY_SEC) or not h["ok"]:
+        raise RuntimeError(f"device host {host} unavailable")
+    try:
+        r = requests.post(f"{_host_url(host)}/devices", json={"kind": kind, "device_id": device_id, "door_id": door_id}, timeout=15)
+        r.raise_for_status()
+    except Exception:
+        if fresh:
+            _release_slot(host)
+        raise
+    with _packing_lock:
+        _placements[device_id] = {"host": host, "kind": kind, "door_id": door_id if kind == "badgeuse" else None}
+    _save_placements()
+    return r.json()["device"]
+
+def _packed_remove(device_id: str) -> bool:
+    with _packing_lock:
+        placed = _placements.pop(device_id, None)
+    if not placed:
+        return False
+    _save_placements()
+    try:
+        requests.delete(f"{_host_url(placed['host'])}/devices/{device_id}", timeout=5)
+    except Exception as e:
+        log.warning(f"[packing] remove {device_id} on {placed['host']} failed: {e}")
+    _release_slot(placed["host"])
+    return True
+
+def _packed_host_of(device_id: str) -> str:
+    with _packing_lock:
+        placed = _placements.get(device_id)
+    if not placed:
+        raise HTTPException(status_code=404, detail="Device inconnu")
+    return placed["host"]
+
+def _packed_list(kind: Optional[str]) -> List[dict]:
+    with _packing_lock:
+        by_host: Dict[str, List[str]] = {}
+        for device_id, placed in _placements.items():
+            if kind in (None, placed["kind"]):
+                by_host.setdefault(placed["host"], []).append(device_id)
+        placements = dict(_placements)
+    out: List[dict] = []
+    for host, ids in by_host.items():
+        try:
+            params = {"kind": kind} if kind else None
+            listed = {d["id"]: d for d in requests.get(f"{_host_url(host)}/devices", params=params, timeout=3).json()}
+        except Exception as e:
+            log.warning(f"[packing] list on {host} failed: {e}")
+            listed = {}
+        for device_id in ids:
+            item = listed.get(device_id)
+            if item is None:
+                placed = placements[device_id]
+                item = {"id": device_id, "kind": placed["kind"], "status": "unknown", "ready": False}
+                if placed["kind"] == "badgeuse":
+                    item["door_id"] = placed["door_id"]
+            out.append(item)
+    return out
+
+def _probe_host(name: str):
+    ok = _wait_ready(_host_url(name), PROVISION_READY_SEC)
+    with _packing_lock:
+        host = _hosts.get(name)
+        if host is not None:
+            host["ok"] = ok
+    if host is not None:
+        host["ready"].set()
+    log.info(f"[packing] host {name} recovered ok={ok}")
+
+def _packing_start():
+    """Reprend les hosts existants et y replace les devices (un host redémarré repart à vide).
+
+    Sondes et replacements en arrière-plan : le démarrage n'attend pas PROVISION_READY_SEC par host,
+    _packed_ensure attend l'Event `ready` du host sondé.
+    """
+    names = [c.name for c in client.containers.list(filters={"label": ["iot.host=true"]})]
+    with _packing_lock:
+        for name in names:
+            _hosts[name] = {"count": 0, "ready": threading.Event(), "ok": False}
+        for placed in _placements.values():
+            if placed["host"] in _hosts:
+                _hosts[placed["host"]]["count"] += 1
+        placements = dict(_placements)
+    log.info(f"[packing] {len(names)} host(s), {len(placements)} device(s), max {DEVICES_PER_HOST}/host")
+    for name in names:
+        threading.Thread(target=_probe_host, args=(name,), name=f"probe-{name}", daemon=True).start()
+    for device_id, placed in placements.items():
+        _background_pool.submit(_packed_ensure, placed["kind"], device_id, placed["door_id"])
+
+# --------- Réconciliation plans -> containers ----------
+# État désiré indexé par étage (recalculé seulement quand la version du plan change),
+# état réel maintenu par le flux d'événements Docker : chaque passe ne traite que les
+# device_id marqués "dirty", jamais un rescan complet.
+_rec_cond = threading.Condition()
+_rec_dirty: Dict[str, None] = {}                # ensemble ordonné des device_id à converger
+_rec_inflight: set = set()
+_rec_owned: set = set()                         # devices désirés au moins une fois (seuls supprimables)
+_desired_by_floor: Dict[str, Dict[str, dict]] = {}
+_floor_versions: Dict[str, int] = {}
+_desired: Dict[str, dict] = {}                  # device_id -> {"kind", "door_id"}
+_actual: Dict[str, dict] = {}                   # device_id -> {"kind", "door_id", "running"}
+_rec_stats = {"actions": 0, "ensured": 0, "removed": 0, "failed": 0}
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate, self.burst = rate, burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def take(self):
+        """Bloque jusqu'à disponibilité d'un jeton."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+def _rec_mark(device_ids):
+    with _rec_cond:
+        for device_id in device_ids:
+            _rec_dirty[device_id] = None
+        _rec_cond.notify()
+
+def _rec_plan_changed(floor_id: str, plan: Optional[dict]):
+    version = int(plan.get("version", 0)) if plan else -1
+    with _rec_cond:
+        if _floor_versions.get(floor_id) == version:
+            return
+        new = {d.device_id: {"kind": d.kind, "door_id": d.door_id} for d in _devices_of_plan(plan)} if plan else {}
+        old = _desired_by_floor.get(floor_id, {})
+        changed = [i for i in new.keys() | old.keys() if new.get(i) != old.get(i)]
+        _desired_by_floor[floor_id] = new
+        _floor_versions[floor_id] = version
+        for device_id in changed:
+            spec = next((f[device_id] for f in _desired_by_floor.values() if device_id in f), None)
+            if spec:
+                _desired[device_id] = spec
+                _rec_owned.add(device_id)
+            else:
+                _desired.pop(device_id, None)
+    if changed:
+        log.info(f"[reconcile] floor={floor_id} v{version}: {len(changed)} device(s) to converge")
+        _rec_mark(changed)
+
+def _device_id_of(container) -> Optional[str]:
+    if container.labels.get("iot.pool") == "true" and _assignment_of(container.id) is None:
+        return None
+    return container.labels.get("iot.device_id") or container.name
+
+def _actual_of(container) -> dict:
+    kind = container.labels.get("iot.kind")
+    return {"kind": kind, "door_id": _door_id_of(container) if kind == "badgeuse" else None,
+            "running": container.status == "running"}
+
+def _rec_resync_actual():
+    """Photo complète de l'état réel : au démarrage et après une coupure du flux d'événements."""
+    if PACKING_MODE:
+        with _packing_lock:
+            actual = {i: {"kind": p["kind"], "door_id": p["door_id"], "running": True} for i, p in _placements.items()}
+    else:
+        actual = {}
+        for c in client.containers.list(all=True, filters={"label": ["iot=true"]}):
+            device_id = _device_id_of(c)
+            if device_id:
+                actual[device_id] = _actual_of(c)
+    with _rec_cond:
+        drift = [i for i in actual.keys() | _actual.keys() if actual.get(i) != _actual.get(i)]
+        _actual.clear()
+        _actual.update(actual)
+    _rec_mark(i for i in drift if i in _desired or i in _rec_owned)
+
+def _rec_on_event(ev: dict):
+    attrs = (ev.get("Actor") or {}).get("Attributes") or {}
+    action = ev.get("Action") or ev.get("status") or ""
+    if action not in ("start", "die", "destroy", "rename"):
+        return
+    name = attrs.get("name", "")
+    device_id = attrs.get("iot.device_id") or name
+    if action == "destroy":
+        with _rec_cond:
+            _actual.pop(device_id, None)
+    else:
+        try:
+            c = client.containers.get(ev.get("id") or name)
+        except docker.errors.NotFound:
+            return
+        device_id = _device_id_of(c)
+        if not device_id:
+            return
+        with _rec_cond:
+            _actual[device_id] = _actual_of(c)
+    if device_id in _desired or device_id in _rec_owned:
+        _rec_mark([device_id])
+
+def _docker_events_loop():
+    while True:
+        try:
+            for ev in client.events(decode=True, filters={"type": "container", "label": "iot=true"}):
+                _rec_on_event(ev)
+        except Exception as e:
+            log.warning(f"[reconcile] docker event stream lost: {e}")
+        time.sleep(2)
+        _rec_resync_actual()
+
+def _rec_converge(device_id: str):
+    with _rec_cond:
+        want = _desired.get(device_id)
+        have = _actual.get(device_id)
+        owned = device_id in _rec_owned
+    try:
+        if want:
+            same_door = want["kind"] != "badgeuse" or not want["door_id"] or (have or {}).get("door_id") == want["door_id"]
+            if have and have["kind"] == want["kind"] and have["running"] and same_door:
+                return
+            if PACKING_MODE:
+                _packed_ensure(want["kind"], device_id, want["door_id"])
+                now = {"kind": want["kind"], "door_id": want["door_id"] if want["kind"] == "badgeuse" else None, "running": True}
+            else:
+                c, _ = _ensure_running(want["kind"], device_id, want["door_id"])
+                now = _actual_of(c)
+            with _rec_cond:
+                _actual[device_id] = now
+                _rec_stats["ensured"] += 1
+        elif have and owned:
+            if PACKING_MODE:
+                _packed_remove(device_id)
+            else:
+                c = client.containers.get(device_id)
+                c.remove(force=True)
+                _forget_assignment(c.id)
+                _mark_offline(device_id)
+            with _rec_cond:
+                _actual.pop(device_id, None)
+                _rec_owned.discard(device_id)
+                _rec_stats["removed"] += 1
+        else:
+            return
+        with _rec_cond:
+            _rec_stats["actions"] += 1
+        log.info(f"[reconcile] converged {device_id} want={want} had={have}")
+    except Exception as e:
+        with _rec_cond:
+            _rec_stats["failed"] += 1
+        log.warning(f"[reconcile] {device_id} failed: {e}")
+    finally:
+        with _rec_cond:
+            _rec_inflight.discard(device_id)
+            _rec_cond.notify()
+
+def _reconcile_loop():
+    bucket = _TokenBucket(RECONCILE_RATE, RECONCILE_BURST)
+    while True:
+        with _rec_cond:
+            # un device déjà en cours de convergence reste dans la file jusqu'à la fin de l'action
+            _rec_cond.wait_for(lambda: any(i not in _rec_inflight for i in _rec_dirty))
+            device_id = next(i for i in _rec_dirty if i not in _rec_inflight)
+            del _rec_dirty[device_id]
+            _rec_inflight.add(device_id)
+        bucket.take()
+        _background_pool.submit(_rec_converge, device_id)
+
+def _reconcile_start():
+    _rec_resync_actual()
+    for plan in plans.list():
+        if plan.get("id"):
+            _rec_plan_changed(plan["id"], plan)
+    plans.subscribe(lambda floor_id, plan, ops: _rec_plan_changed(floor_id, plan))
+    threading.Thread(target=_reconcile_loop, name="reconcile", daemon=True).start()
+    if not PACKING_MODE:
+        threading.Thread(target=_docker_events_loop, name="docker-events", daemon=True).start()
+    log.info(f"[reconcile] started: {len(_desired)} desired, {len(_actual)} actual, rate={RECONCILE_RATE}/s")
+
+# --------- Stats ressources (docker stats) ----------
+# Un thread par container suit son flux `docker stats` (un échantillon par seconde côté daemon) ;
+# un thread d'agrégation produit toutes les STATS_INTERVAL_SEC le snapshot servi par /stats,
+# sans aucun appel au daemon pendant la requête. Les device hosts (mode packing) sont répartis
+# à parts égales entre les devices qu'ils portent ; les containers sans device (warm pool libre,
+# host vide) sont rapportés dans `idle` et n'entrent ni dans les totaux ni dans per_device.
+_stats_lock = threading.Lock()
+_stats_stop = threading.Event()
+_stats_streams: Dict[str, dict] = {}            # container.id -> {"name", "labels", "sample"}
+_stats_floor_of: Dict[str, str] = {}            # device_id -> étage (depuis les plans)
+_stats_floor_devices: Dict[str, set] = {}       # étage -> device_ids du plan courant
+_stats_history: deque = deque(maxlen=max(1, int(STATS_HISTORY_SEC / STATS_INTERVAL_SEC)))
+_stats_snapshot: dict = {}
+_STATS_METRICS = ("cpu_pct", "mem_bytes", "rx_bps", "tx_bps")
+
+def _stats_sample(raw: dict, prev: Optional[dict]) -> dict:
+    """Échantillon brut de l'API stats -> CPU %, mémoire utile, débits réseau (calcul de `docker stats`)."""
+    cpu, pre = raw.get("cpu_stats") or {}, raw.get("precpu_stats") or {}
+    cpu_delta = (cpu.get("cpu_usage") or {}).get("total_usage", 0) - (pre.get("cpu_usage") or {}).get("total_usage", 0)
+    system_delta = cpu.get("system_cpu_usage", 0) - pre.get("system_cpu_usage", 0)
+    online = cpu.get("online_cpus") or len((cpu.get("cpu_usage") or {}).get("percpu_usage") or []) or 1
+    mem = raw.get("memory_stats") or {}
+    mem_detail = mem.get("stats") or {}
+    # pages de cache récupérables exclues : inactive_file (cgroup v2), cache (cgroup v1)
+    mem_used = mem.get("usage", 0) - mem_detail.get("inactive_file", mem_detail.get("cache", 0))
+    networks = (raw.get("networks") or {}).values()
+    rx = sum(n.get("rx_bytes", 0) for n in networks)
+    tx = sum(n.get("tx_bytes", 0) for n in networks)
+    now = time.monotonic()
+    sample = {
+        "ts": now,
+        # premier échantillon du flux : precpu vide, pas de delta exploitable
+        "cpu_pct": cpu_delta / system_delta * online * 100 if pre.get("system_cpu_usage") and system_delta > 0 else 0.0,
+        "mem_bytes": max(0, mem_used),
+        "mem_limit": mem.get("limit", 0),
+        "rx_bytes": rx,
+        "tx_bytes": tx,
+        "rx_bps": 0.0,
+        "tx_bps": 0.0,
+    }
+    if prev and now > prev["ts"]:
+        elapsed = now - prev["ts"]
+        sample["rx_bps"] = max(0.0, (rx - prev["rx_bytes"]) / elapsed)
+        sample["tx_bps"] = max(0.0, (tx - prev["tx_bytes"]) / elapsed)
+    return sample
+
+def _stats_stream(container):
+    prev = None
+    try:
+        for raw in container.stats(stream=True, decode=True):
+            if _stats_stop.is_set():
+                break
+            prev = _stats_sample(raw, prev)
+            with _stats_lock:
+                entry = _stats_streams.get(container.id)
+                if entry is None:
+                    break
+                entry["sample"] = prev
+    except Exception as e:
+        log.debug(f"[stats] stream {container.name} ended: {e}")
+    finally:
+        # container arrêté ou flux coupé : la prochaine découverte relance le flux s'il tourne encore
+        with _stats_lock:
+            _stats_streams.pop(container.id, None)
+
+def _stats_discover():
+    running = client.containers.list(filters={"label": ["iot=true"]}) + client.containers.list(filters={"label": ["iot.host=true"]})
+    started = 0
+    for c in running:
+        with _stats_lock:
+            if c.id in _stats_streams:
+                _stats_streams[c.id]["name"] = c.name   # renommage au claim du warm pool
+                continue
+            _stats_streams[c.id] = {"name": c.name, "labels": dict(c.labels or {}), "sample": None}
+        threading.Thread(target=_stats_stream, args=(c,), name=f"stats-{c.name}", daemon=True).start()
+        started += 1
+    if started:
+        log.info(f"[stats] {started} new stream(s), {len(_stats_streams)} followed")
+
+def _stats_plan_changed(floor_id: str, plan: Optional[dict]):
+    devices = {d.device_id for d in _devices_of_plan(plan)} if plan else set()
+    with _stats_lock:
+        for device_id in _stats_floor_devices.pop(floor_id, set()) - devices:
+            if _stats_floor_of.get(device_id) == floor_id:
+                _stats_floor_of.pop(device_id, None)
+        for device_id in devices:
+            _stats_floor_of[device_id] = floor_id
+        _stats_floor_devices[floor_id] = devices
+
+def _stats_owners(cid: str, entry: dict, by_host: Dict[str, List[Tuple[str, str]]]) -> List[Tuple[str, Optional[str], float]]:
+    """(kind, device_id, part) : à qui imputer la consommation du container."""
+    labels = entry["labels"]
+    if labels.get("iot.host") == "true":
+        placed = by_host.get(entry["name"])
+        if not placed:
+            return [("host", None, 1.0)]
+        return [(kind, device_id, 1.0 / len(placed)) for device_id, kind in placed]
+    device_id = labels.get("iot.device_id") or (_assignment_of(cid) or {}).get("device_id")
+    return [(labels.get("iot.kind") or "unknown", device_id, 1.0)]
+
+def _stats_row() -> dict:
+    return {"devices": 0.0, **{m: 0.0 for m in _STATS_METRICS}}
+
+def _stats_finish(row: dict) -> dict:
+    n = row["devices"]
+    out = {"devices": round(n, 2), "cpu_pct": round(row["cpu_pct"], 2), "mem_bytes": int(row["mem_bytes"]),
+           "rx_bps": round(row["rx_bps"], 1), "tx_bps": round(row["tx_bps"], 1)}
+    if n:
+        # ce que coûte un device en moyenne : la base du dimensionnement des hosts
+        out["per_device"] = {"cpu_pct": round(row["cpu_pct"] / n, 3), "mem_bytes": int(row["mem_bytes"] / n)}
+    return out
+
+def _stats_aggregate() -> dict:
+    stale_after = max(3 * STATS_INTERVAL_SEC, 10.0)
+    now = time.monotonic()
+    with _packing_lock:
+        by_host: Dict[str, List[Tuple[str, str]]] = {}
+        for device_id, placed in _placements.items():
+            by_host.setdefault(placed["host"], []).append((device_id, placed["kind"]))
+    with _stats_lock:
+        entries = [(cid, dict(e)) for cid, e in _stats_streams.items()]
+        floor_of = dict(_stats_floor_of)
+    totals, by_kind, by_floor, idle, containers = _stats_row(), {}, {}, {}, []
+    waiting = stale = 0
+    for cid, entry in entries:
+        sample = entry["sample"]
+        if sample is None:
+            waiting += 1
+            continue
+        if now - sample["ts"] > stale_after:
+            stale += 1
+            continue
+        owners = _stats_owners(cid, entry, by_host)
+        for kind, device_id, part in owners:
+            if not device_id:
+                # warm pool pas encore réclamé, host vide : aucun device à qui imputer, compté à part
+                row = idle.setdefault(kind, {"containers": 0, **{m: 0.0 for m in _STATS_METRICS}})
+                row["containers"] += 1
+                for m in _STATS_METRICS:
+                    row[m] += sample[m] * part
+                continue
+            floor = floor_of.get(device_id, "-")
+            for row in (totals, by_kind.setdefault(kind, _stats_row()), by_floor.setdefault(floor, _stats_row())):
+                row["devices"] += part
+                for m in _STATS_METRICS:
+                    row[m] += sample[m] * part
+        labels = entry["labels"]
+        containers.append({"container": entry["name"],
+                           "kind": "host" if labels.get("iot.host") == "true" else labels.get("iot.kind") or "unknown",
+                           "devices": sum(1 for _, device_id, _ in owners if device_id),
+                           **{m: round(sample[m], 2) for m in _STATS_METRICS}, "mem_limit": sample["mem_limit"]})
+    return {
+        "ts": _now_iso(),
+        "streams": len(entries),
+        "waiting_first_sample": waiting,
+        "stale": stale,
+        "totals": _stats_finish(totals),
+        "by_kind": {k: _stats_finish(v) for k, v in sorted(by_kind.items())},
+        "by_floor": {k: _stats_finish(v) for k, v in sorted(by_floor.items())},
+        "idle": {k: {"containers": v["containers"], "cpu_pct": round(v["cpu_pct"], 2), "mem_bytes": int(v["mem_bytes"]),
+                     "rx_bps": round(v["rx_bps"], 1), "tx_bps": round(v["tx_bps"], 1)} for k, v in sorted(idle.items())},
+        "containers": sorted(containers, key=lambda c: -c["cpu_pct"]),
+    }
+
+def _stats_loop():
+    next_discovery = 0.0
+    while not _stats_stop.is_set():
+        if time.monotonic() >= next_discovery:
+            try:
+                _stats_discover()
+            except Exception as e:
+                log.warning(f"[stats] discovery failed: {e}")
+            next_discovery = time.monotonic() + STATS_DISCOVERY_SEC
+        snapshot = _stats_aggregate()
+        with _stats_lock:
+            _stats_snapshot.clear()
+            _stats_snapshot.update(snapshot)
+            _stats_history.append({k: snapshot[k] for k in ("ts", "totals", "by_kind", "by_floor", "idle")})
+        _stats_stop.wait(STATS_INTERVAL_SEC)
+
+def _stats_start():
+    for plan in plans.list():
+        if plan.get("id"):
+            _stats_plan_changed(plan["id"], plan)
+    plans.subscribe(lambda floor_id, plan, ops: _stats_plan_changed(floor_id, plan))
+    threading.Thread(target=_stats_loop, name="stats", daemon=True).start()
+    log.info(f"[stats] collector started: interval={STATS_INTERVAL_SEC}s history={STATS_HISTORY_SEC}s")
+
+# --------- Jobs de provisioning ----------
+_jobs_lock = threading.Lock()
+_jobs: Dict[str, dict] = {}
+_provision_pool = ThreadPoolExecutor(max_workers=max(1, PROVISION_CONCURRENCY), thread_name_prefix="provision")
+# travail de fond (warm pool, réconciliation, replacements packing) : ne retarde pas les jobs des clients
+_background_pool = ThreadPoolExecutor(max_workers=max(1, BACKGROUND_CONCURRENCY), thread_name_prefix="background")
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def _devices_of_plan(plan: dict) -> List[CreateDevice]:
+    """Extrait les devices (portes + badgeuses) d'un plan du front."""
+    out: List[CreateDevice] = []
+    for node in plan.get("nodes") or []:
+        kind = node.get("kind")
+        device_id = node.get("deviceId") or node.get("id")
+        if kind not in ("badgeuse", "porte") or not device_id:
+            continue
+        door_id = node.get("targetDoorId") if kind == "badgeuse" else None
+        out.append(CreateDevice(kind=kind, device_id=device_id, door_id=door_id or None))
+    return out
+
+def _is_transient(exc: Exception) -> bool:
+    """Erreurs Docker qui valent un nouvel essai (daemon surchargé, conflit de nom, réseau)."""
+    if isinstance(exc, (docker.errors.ImageNotFound, docker.errors.NotFound)):
+        return False
+    if isinstance(exc, docker.errors.APIError):
+        code = exc.status_code or 0
+        return code >= 500 or code in (408, 409, 429)
+    if isinstance(exc, requests.exceptions.HTTPError):
+        return exc.response is not None and exc.response.status_code >= 500
+    return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def _job_update(job_id: str, device_id: str, **fields):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job["devices"][device_id].update(fields)
+        job["updated_at"] = _now_iso()
+
+def _provision_one(job_id: str, dev: CreateDevice):
+    attempt = 0
+    while True:
+        attempt += 1
+        _job_update(job_id, dev.device_id, status="starting", attempts=attempt)
+        try:
+            if PACKING_MODE:
+                ready = _packed_ensure(dev.kind, dev.device_id, dev.door_id)["ready"]
+            else:
+                c, _ = _ensure_running(dev.kind, dev.device_id, dev.door_id)
+                ready = _device_ready(dev.device_id, c.labels.get("iot.kind", dev.kind), PROVISION_READY_SEC)
+            _job_update(job_id, dev.device_id, status="ready" if ready else "running", ready=ready, error=None)
+            return
+        except Exception as e:
+            if attempt <= PROVISION_RETRIES and _is_transient(e):
+                delay = PROVISION_BACKOFF_SEC * (2 ** (attempt - 1))
+                log.warning(f"[job {job_id}] {dev.device_id} transient error (attempt {attempt}): {e} -> retry in {delay:.1f}s")
+                _job_update(job_id, dev.device_id, status="retrying", error=str(e))
+                time.sleep(delay)
+                continue
+            log.error(f"[job {job_id}] {dev.device_id} failed after {attempt} attempt(s): {e}")
+            _job_update(job_id, dev.device_id, status="failed", error=str(e))
+            return
+
+def _finish_job(job_id: str):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job["pending"] -= 1
+        if job["pending"] > 0:
+            return
+        failed = sum(1 for d in job["devices"].values() if d["status"] == "failed")
+        job["status"] = "failed" if failed == len(job["devices"]) else ("partial" if failed else "done")
+        job["finished_at"] = _now_iso()
+        # on ne garde que les JOBS_KEEP derniers jobs terminés, et toujours celui-ci (son client le consulte)
+        done = sorted((j for j in _jobs.values() if j.get("finished_at")), key=lambda j: j["finished_at"])
+        for old in done[:max(0, len(done) - max(1, JOBS_KEEP))]:
+            _jobs.pop(old["id"], None)
+    log.info(f"[job {job_id}] finished status={job['status']}")
+
+def _run_job_device(job_id: str, dev: CreateDevice):
+    try:
+        _provision_one(job_id, dev)
+    finally:
+        _finish_job(job_id)
+
+def _job_view(job: dict) -> dict:
+    devices = [dict(d) for d in job["devices"].values()]
+    counts: Dict[str, int] = {}
+    for d in devices:
+        counts[d["status"]] = counts.get(d["status"], 0) + 1
+    return {**{k: v for k, v in job.items() if k not in ("devices", "pending")}, "counts": counts, "devices": devices}
+
 # ----------------- routes -----------------
 @app.get("/health")
 def health():
@@ -174,42 +1132,160 @@ def health():
         return {
             "ok": True,
             "docker": "up",
-            "mqtt": {"host": MQTT_HOST, "port": MQTT_PORT},
+            "mqtt": {"host": MQTT_HOST, "port": MQTT_PORT, "connected": mqtt_connected, "presence_topic": PRESENCE_TOPIC},
             "network": DOCKER_NETWORK,
             "payload_schema": PAYLOAD_SCHEMA,
+            "packing": {"enabled": PACKING_MODE, "max_per_host": DEVICES_PER_HOST,
+                        "hosts": {name: h["count"] for name, h in list(_hosts.items())}},
+            "warm_pool": {
+                "target": WARM_POOL_SIZE,
+                "idle": {k: len(v) for k, v in _warm_idle.items()},
+                "spawning": dict(_warm_spawning),
+            },
         }
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
+@app.get("/stats")
+def get_stats(history: bool = Query(default=False), containers: bool = Query(default=False)):
+    """Coût CPU / mémoire / réseau des devices par kind et par étage (dernier agrégat, pas d'appel au daemon)."""
+    if not STATS_ENABLED:
+        raise HTTPException(status_code=404, detail="Stats collector disabled (STATS=0)")
+    with _stats_lock:
+        snapshot = dict(_stats_snapshot)
+        points = list(_stats_history) if history else None
+    if not snapshot:
+        return {"ready": False, "interval_sec": STATS_INTERVAL_SEC}
+    if not containers:
+        snapshot.pop("containers", None)
+    out = {"ready": True, "interval_sec": STATS_INTERVAL_SEC, **snapshot}
+    if points is not None:
+        out["history"] = points
+    return out
+
 @app.get("/plans")
-def get_plans():
-    return _load_plans()
+def get_plans(request: Request, fields: Optional[str] = Query(default=None, description="ex. id,name : résumé sans géométrie")):
+    try:
+        selected = parse_fields(fields)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="fields must list at least one field")
+    return plan_responses.list(request, selected)
 
 @app.get("/plans/{floor_id}")
-def get_plan(floor_id: str):
-    plans = _load_plans()
-    for p in plans:
-        if p.get("id") == floor_id:
-            return p
-    raise HTTPException(status_code=404, detail="Plan not found")
+def get_plan(request: Request, floor_id: str):
+    response = plan_responses.floor(request, floor_id)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return response
 
 
 @app.post("/plans/{floor_id}")
 def save_plan(floor_id: str, plan: dict = Body(...)):
-    plans = _load_plans()
-    found = False
-    for i, p in enumerate(plans):
-        if p.get("id") == floor_id:
-            plans[i] = plan
-            found = True
-            break
-    if not found:
-        plans.append(plan)
-    _save_plans(plans)
-    return {"ok": True}
+    try:
+        return {"ok": True, "version": plans.put(floor_id, plan)}
+    except PlanPatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.patch("/plans/{floor_id}")
+def patch_plan(floor_id: str, req: PlanPatch):
+    try:
+        version = plans.patch(floor_id, req.ops, req.version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    except PlanConflict as e:
+        raise HTTPException(status_code=409, detail={"error": "version_conflict", "version": e.current})
+    except PlanPatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"ok": True, "version": version}
+
+def _floor_index(floor_id: str):
+    index = indexes.get(floor_id)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    return index
+
+@app.get("/plans/{floor_id}/query")
+def query_plan(floor_id: str, bbox: str = Query(...), types: Optional[str] = None):
+    try:
+        rect = parse_bbox(bbox)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="bbox attendu: x1,y1,x2,y2")
+    collections = {t.strip() for t in types.split(",")} if types else None
+    return _floor_index(floor_id).query(rect, collections)
+
+@app.get("/plans/{floor_id}/locate")
+def locate_in_plan(floor_id: str, x: float, y: float,
+                   tolerance: float = Query(default=0.0, ge=0),
+                   kind: Optional[Literal["badgeuse", "porte"]] = None,
+                   k: int = Query(default=1, ge=0, le=100)):
+    if not is_finite_point(x, y, tolerance):
+        raise HTTPException(status_code=422, detail="x, y et tolerance doivent être finis")
+    index = _floor_index(floor_id)
+    found = index.locate(x, y, tolerance)
+    found["nearest"] = index.nearest(x, y, kind, k) if k else []
+    return found
+
+@app.get("/reconcile")
+def reconcile_status():
+    with _rec_cond:
+        return {
+            "enabled": RECONCILE,
+            "floors": dict(_floor_versions),
+            "desired": len(_desired),
+            "actual": len(_actual),
+            "pending": len(_rec_dirty),
+            "in_flight": len(_rec_inflight),
+            **_rec_stats,
+        }
+
+@app.post("/jobs/provision", status_code=202)
+def provision_job(req: ProvisionJob):
+    devices: List[CreateDevice] = list(req.devices or [])
+    if req.floor_id:
+        plan = plans.get(req.floor_id)
+        if plan is None:
+            raise HTTPException(status_code=404, detail="Plan not found")
+        devices.extend(_devices_of_plan(plan))
+    # dédoublonnage par device_id (la dernière déclaration gagne)
+    unique = list({d.device_id: d for d in devices}.values())
+    if not unique:
+        raise HTTPException(status_code=400, detail="Aucun device à provisionner")
+
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        "id": job_id,
+        "floor_id": req.floor_id,
+        "status": "running",
+        "created_at": _now_iso(),
+        "updated_at": _now_iso(),
+        "finished_at": None,
+        "pending": len(unique),
+        "devices": {
+            d.device_id: {"id": d.device_id, "kind": d.kind, "door_id": d.door_id,
+                          "status": "pending", "ready": False, "attempts": 0, "error": None}
+            for d in unique
+        },
+    }
+    with _jobs_lock:
+        _jobs[job_id] = job
+    log.info(f"[job {job_id}] provisioning {len(unique)} device(s) floor={req.floor_id!r} concurrency={PROVISION_CONCURRENCY}")
+    for d in unique:
+        _provision_pool.submit(_run_job_device, job_id, d)
+    return {"ok": True, "job_id": job_id, "total": len(unique)}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return _job_view(job)
 
 @app.get("/devices/{device_id}/health")
 def dev_health(device_id: str):
+    if PACKING_MODE:
+        r = requests.get(f"{_host_url(_packed_host_of(device_id))}/devices/{device_id}/health", timeout=2)
+        return r.json()
     try:
         url = _service_url_by_id(device_id)
     except docker.errors.NotFound:
@@ -221,11 +1297,13 @@ def dev_health(device_id: str):
 def create_device(req: CreateDevice):
     try:
         log.info(f"[orchestrator] ensure device kind={req.kind} id={req.device_id} door_id={req.door_id!r}")
+        if PACKING_MODE:
+            return {"ok": True, "device": _packed_ensure(req.kind, req.device_id, req.door_id)}
         # si badgeuse et door_id manquant, on l'autorise (le front peut valider avant)
         c, _ = _ensure_running(req.kind, req.device_id, req.door_id)
         kind = c.labels.get("iot.kind", req.kind)
         url = _service_url_for(req.device_id, kind)
-        ready = _wait_ready(url, 12.0)
+        ready = _device_ready(req.device_id, kind, 12.0)
         door_id = _door_id_of(c) if kind == "badgeuse" else None
         log.info(f"[orchestrator] device={req.device_id} kind={kind} status={c.status} ready={ready} url={url} door_id={door_id!r}")
         return {"ok": True, "device": {"id": req.device_id, "kind": kind, "status": c.status, "ready": ready, "door_id": door_id}}
@@ -237,16 +1315,21 @@ def create_device(req: CreateDevice):
 
 @app.get("/devices")
 def list_devices(kind: Optional[str] = None):
+    if PACKING_MODE:
+        return _packed_list(kind if kind in ("badgeuse", "porte") else None)
     filters = {"label": ["iot=true"]}
     if kind in ("badgeuse", "porte"):
         filters["label"].append(f"iot.kind={kind}")
     out = []
-    for c in client.containers.list(all=True, filters=filters):
-        c.reload()
+    for c in client.containers.list(all=True, filters=filters):   # list() inspecte déjà chaque container : pas de reload()
+        if c.labels.get("iot.pool") == "true" and _assignment_of(c.id) is None:
+            continue  # container du warm pool encore sans identité
         id_ = c.labels.get("iot.device_id", c.name)
         k = c.labels.get("iot.kind", "unknown")
-        url = _service_url_for(id_, k)
-        ready = _wait_ready(url, 0.01)  # ping non-bloquant
+        if mqtt_connected:
+            ready = _presence.get(id_, False)
+        else:
+            ready = _wait_ready(_service_url_for(id_, k), 0.01)  # ping non-bloquant
         item = {"id": id_, "kind": k, "status": c.status, "ready": ready}
         if k == "badgeuse":
             item["door_id"] = _door_id_of(c)
@@ -255,12 +1338,18 @@ def list_devices(kind: Optional[str] = None):
 
 @app.delete("/devices/{device_id}")
 def delete_device(device_id: str, remove_image: bool = Query(default=False)):
+    if PACKING_MODE:
+        if not _packed_remove(device_id):
+            raise HTTPException(status_code=404, detail="Device not found")
+        return {"ok": True, "image_removed": False}
     try:
         c = client.containers.get(device_id)
         # Mémoriser l'image avant suppression du conteneur
         image_id = c.image.id
         image_tags = c.image.tags
         c.remove(force=True)
+        _forget_assignment(c.id)
+        _mark_offline(device_id)
 
         result = {"ok": True, "image_removed": False, "image_id": image_id, "image_tags": image_tags}
 
@@ -287,16 +1376,37 @@ def delete_device(device_id: str, remove_image: bool = Query(default=False)):
 def proxy_door(device_id: str, action: str):
     if action not in {"open", "close", "toggle"}:
         raise HTTPException(status_code=400, detail="Action invalide")
-    try:
-        url = _service_url_by_id(device_id)  # ex: http://porte-002:8001
-    except docker.errors.NotFound:
-        raise HTTPException(status_code=404, detail="Porte inconnue")
-    if not _wait_ready(url, 6.0):
-        raise HTTPException(status_code=503, detail="Porte non prête")
+    if not (mqtt_connected and _presence.get(device_id)):
+        # présence inconnue : on vérifie que la porte existe, puis repli HTTP si le broker est injoignable
+        if PACKING_MODE:
+            url = f"{_host_url(_packed_host_of(device_id))}/door/{device_id}"
+        else:
+            try:
+                url = _service_url_by_id(device_id)  # ex: http://porte-002:8001
+            except docker.errors.NotFound:
+                raise HTTPException(status_code=404, detail="Porte inconnue")
+            if not _device_ready(device_id, "porte", 6.0):
+                raise HTTPException(status_code=503, detail="Porte non prête")
+        if not mqtt_connected:
+            return _proxy_door_http(url, action)
+        if PACKING_MODE and not _wait_online(device_id, 6.0):
+            raise HTTPException(status_code=503, detail="Porte non prête")
+    reply = _door_request(device_id, action, DOOR_ACK_TIMEOUT_SEC)
+    if reply is None:
+        raise HTTPException(status_code=504, detail="Porte sans réponse")
+    if not reply.get("ok"):
+        raise HTTPException(status_code=400, detail=reply.get("error") or "Commande refusée")
+    return {"status": 200, "data": reply}
+
+def _proxy_door_http(url: str, action: str):
     try:
         r = requests.post(f"{url}/{action}", timeout=5)
-        data = r.json() if r.content else {}
-        return {"status": r.status_code, "data": data}
     except Exception as e:
         log.exception("proxy_door failed")
         raise HTTPException(status_code=502, detail=str(e))
+    if r.status_code == 404:
+        raise HTTPException(status_code=404, detail="Porte inconnue")
+    data = r.json() if r.content else {}
+    if PACKING_MODE:
+        return data  # le device host renvoie déjà {"status", "data"}
+    return {"status": r.status_code, "data": data}
@@ -1,36 +1,164 @@
-import os, json, threading, logging
+import os, json, threading, logging, pathlib, time
 from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import uvicorn
+import sys
+# modules partagés (common/) : copiés à côté du code dans l'image Docker, lus dans le dépôt en local
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from logging_setup import setup_logging
+from profiling import install_debug_routes, timed
+from reconnect import ReconnectStats, install_jittered_reconnect
+
+log = setup_logging("porte")
+log_cmds = logging.getLogger("porte.commands")   # une ligne par commande : échantillonnable (LOG_SAMPLE)
 
 MQTT_HOST = os.getenv("MQTT_HOST", "mosquitto")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_USER = os.getenv("MQTT_USER", "")
 MQTT_PASS = os.getenv("MQTT_PASS", "")
 DEVICE_ID = os.getenv("DEVICE_ID", "porte-001")
+# Changements d'état rapprochés (toggles en rafale) fusionnés en une seule publication retenue
+STATE_COALESCE_MS = float(os.getenv("STATE_COALESCE_MS", "50"))
+# Container du warm pool : muet tant que l'orchestrateur ne lui a pas attribué d'identité
+WARM_POOL = os.getenv("WARM_POOL", "") == "1"
+APP_DIR = pathlib.Path(__file__).resolve().parent   # fichiers d'état à côté du code (WORKDIR de l'image), pas dans le cwd
+RUNTIME_CONFIG_FILE = pathlib.Path(os.getenv("RUNTIME_CONFIG_FILE") or APP_DIR / "runtime_config.json")
+
+def _load_runtime_config() -> dict:
+    if RUNTIME_CONFIG_FILE.exists():
+        try:
+            return json.loads(RUNTIME_CONFIG_FILE.read_text(encoding="utf-8"))
+        except Exception:
+            log.exception(f"[BOOT] Unable to read {RUNTIME_CONFIG_FILE}")
+    return {}
+
+_runtime = _load_runtime_config()
+DEVICE_ID = _runtime.get("device_id") or DEVICE_ID
+configured = bool(_runtime) or not WARM_POOL
 TOPIC_STATE = f"iot/porte/{DEVICE_ID}/state"
 TOPIC_CMDS  = f"iot/porte/{DEVICE_ID}/commands"
-
-state = {"is_open": False, "last_change": None}
+TOPIC_STATUS = f"iot/porte/{DEVICE_ID}/status"   # présence retenue : online / offline (LWT)
+_identity_lock = threading.Lock()
 
 def now_iso():
     return datetime.now(timezone.utc).isoformat()
 
+class DoorStateMachine:
+    """État de la porte partagé entre le thread paho et les threads FastAPI.
+
+    Transitions atomiques sous verrou ; `seq` augmente à chaque changement réel (initialisé
+    sur l'horloge en ms au boot pour rester croissant après un redémarrage) afin que les
+    consommateurs puissent ignorer une mise à jour arrivée dans le désordre.
+    """
+
+    def __init__(self, coalesce_s: float):
+        self._lock = threading.Lock()
+        # sérialise les publications d'état (timer, flush immédiat, on_connect) : le message retenu
+        # est toujours le dernier seq, pas celui d'un publieur plus lent
+        self.publish_lock = threading.Lock()
+        self.published_seq = 0
+        self._coalesce_s = coalesce_s
+        self._timer = None
+        self.is_open = False
+        self.last_change = None
+        self.seq = time.time_ns() // 1_000_000
+        self._published = None          # (is_open) de la dernière publication retenue
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"is_open": self.is_open, "last_change": self.last_change, "seq": self.seq}
+
+    def apply(self, action: str) -> bool:
+        """open / close / toggle ; False si l'action ne change rien."""
+        with self._lock:
+            target = (not self.is_open) if action == "toggle" else (action == "open")
+            if target == self.is_open:
+                return False
+            self.is_open = target
+            self.last_change = now_iso()
+            self.seq += 1
+            if self._coalesce_s <= 0:
+                flush_now = True
+            else:
+                flush_now = False
+                if self._timer is None:
+                    self._timer = threading.Timer(self._coalesce_s, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if flush_now:
+            self._flush()
+        return True
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if self._published == self.is_open:
+                return  # ex: open puis close dans la fenêtre -> rien de nouveau à retenir
+        publish_state(client)
+
+    def mark_published(self, is_open: bool, seq: int):
+        """À appeler sous publish_lock."""
+        with self._lock:
+            self._published = is_open
+        self.published_seq = seq
+
+door = DoorStateMachine(STATE_COALESCE_MS / 1000.0)
+
 def publish_state(client):
-    payload = {
-        "device_id": DEVICE_ID,
-        "type": "door_state",
-        "ts": now_iso(),
-        "data": {"is_open": state["is_open"]}
-    }
-    client.publish(TOPIC_STATE, json.dumps(payload), qos=1, retain=True)
+    if not configured:
+        return
+    with door.publish_lock:
+        snap = door.snapshot()
+        if snap["seq"] < door.published_seq:
+            return  # un état plus récent est déjà retenu par le broker
+        payload = {
+            "device_id": DEVICE_ID,
+            "type": "door_state",
+            "ts": now_iso(),
+            "seq": snap["seq"],
+            "data": {"is_open": snap["is_open"], "last_change": snap["last_change"]}
+        }
+        client.publish(TOPIC_STATE, json.dumps(payload), qos=1, retain=True)
+        door.mark_published(snap["is_open"], snap["seq"])
+
+def _presence_payload(status: str) -> str:
+    return json.dumps({"device_id": DEVICE_ID, "kind": "porte", "status": status, "ts": now_iso()})
+
+def _set_will():
+    # le broker publie "offline" (retenu) si la session tombe sans disconnect propre
+    if configured:
+        client.will_set(TOPIC_STATUS, _presence_payload("offline"), qos=1, retain=True)
+
+def publish_offline(timeout: float = 2.0):
+    if configured and client.is_connected():
+        client.publish(TOPIC_STATUS, _presence_payload("offline"), qos=1, retain=True).wait_for_publish(timeout)
+
+def _reply(client, msg, body: dict):
+    """Requête/réponse MQTT v5 : ack sur le ResponseTopic avec la CorrelationData d'origine."""
+    response_topic = getattr(msg.properties, "ResponseTopic", None)
+    if not response_topic:
+        return
+    props = Properties(PacketTypes.PUBLISH)
+    correlation = getattr(msg.properties, "CorrelationData", None)
+    if correlation is not None:
+        props.CorrelationData = correlation
+    client.publish(response_topic, json.dumps({"device_id": DEVICE_ID, **body}), qos=1, properties=props)
 
 def on_connect(client, userdata, flags, rc, properties=None):
-    client.subscribe(TOPIC_CMDS, qos=1)
-    publish_state(client)
+    with _identity_lock:
+        client.subscribe(TOPIC_CMDS, qos=1)
+        publish_state(client)
+        if configured:
+            client.publish(TOPIC_STATUS, _presence_payload("online"), qos=1, retain=True)
 
+@timed("porte.on_message")
 def on_message(client, userdata, msg):
     try:
         data = json.loads(msg.payload.decode("utf-8"))
@@ -39,61 +167,126 @@ def on_message(client, userdata, msg):
 
     action = str(data.get("action") or "").lower()
     if action not in {"open", "close", "toggle"}:
+        _reply(client, msg, {"ok": False, "error": f"unknown action {action!r}"})
         return
 
     target = str(data.get("doorID") or data.get("door_id") or "").strip()
-    if target and target not in {DEVICE_ID}:
-        log.debug(f"[MQTT] Ignored command for {target} on {DEVICE_ID}")
+    if not configured or (target and target not in {DEVICE_ID}):
+        log_cmds.debug("[MQTT] Ignored command for %s on %s", target, DEVICE_ID)
+        # réponse explicite : le demandeur n'attend pas son timeout
+        _reply(client, msg, {"ok": False, "error": "not configured" if not configured else f"wrong door {target!r}"})
         return
 
-    log.info(f"[MQTT] cmd topic={msg.topic} action={action} door={target or DEVICE_ID}")
-    if action == "toggle":
-        state["is_open"] = not state["is_open"]
-    else:
-        state["is_open"] = (action == "open")
-    state["last_change"] = now_iso()
-    publish_state(client)
+    changed = door.apply(action)
+    _reply(client, msg, {"ok": True, "changed": changed, **door.snapshot()})
+    log_cmds.info("[MQTT] cmd topic=%s action=%s door=%s changed=%s", msg.topic, action, target or DEVICE_ID, changed)
 
-client = mqtt.Client(client_id=f"porte-{DEVICE_ID}", protocol=mqtt.MQTTv311)
+# MQTT v5 : nécessaire pour ResponseTopic / CorrelationData (commandes en requête/réponse)
+client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"porte-{DEVICE_ID}", protocol=mqtt.MQTTv5)
 if MQTT_USER:
     client.username_pw_set(MQTT_USER, MQTT_PASS)
 client.on_connect = on_connect
 client.on_message = on_message
-client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-client.loop_start()
+reconnect_stats = ReconnectStats()
+install_jittered_reconnect(client, reconnect_stats)
+_set_will()
+
+_session_lock = threading.Lock()
+
+def _restart_session():
+    """DISCONNECT propre (pas de LWT), puis reconnexion faite par le thread réseau de paho.
+
+    Hors de _identity_lock : loop_stop() attend la fin du thread réseau, dont on_connect prend ce verrou.
+    """
+    with _session_lock:
+        client.disconnect()
+        client.loop_stop()
+        client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+        client.loop_start()
 
-app = FastAPI(title=f"Porte {DEVICE_ID}")
+def apply_identity(device_id: str):
+    """Attribue (ou change) l'identité de la porte à chaud, sans recréer le container."""
+    global DEVICE_ID, TOPIC_STATE, TOPIC_CMDS, TOPIC_STATUS, configured
+    restart = False
+    with _identity_lock:
+        old_state, old_status, was_configured = TOPIC_STATE, TOPIC_STATUS, configured
+        DEVICE_ID = device_id
+        TOPIC_STATE = f"iot/porte/{DEVICE_ID}/state"
+        TOPIC_CMDS  = f"iot/porte/{DEVICE_ID}/commands"
+        TOPIC_STATUS = f"iot/porte/{DEVICE_ID}/status"
+        configured = True
+        RUNTIME_CONFIG_FILE.write_text(json.dumps({"device_id": DEVICE_ID}), encoding="utf-8")
+        if old_status != TOPIC_STATUS or not was_configured:
+            if was_configured and client.is_connected():
+                # efface l'état et la présence retenus de l'ancienne identité
+                client.publish(old_state, b"", qos=1, retain=True)
+                client.publish(old_status, b"", qos=1, retain=True).wait_for_publish(2)
+            _set_will()
+            restart = client.is_connected()
+    if restart:
+        # nouvelle session : LWT à jour, abonnement, état et "online" refaits dans on_connect
+        _restart_session()
+    log.info(f"[CONFIG] DEVICE_ID={DEVICE_ID} STATE_TOPIC={TOPIC_STATE}")
+
+_boot_ts = time.monotonic()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # HTTP disponible tout de suite : connexion MQTT (et reconnexions) dans le thread réseau de paho
+    log.info(f"[MQTT] Connecting to {MQTT_HOST}:{MQTT_PORT} …")
+    client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+    client.loop_start()
+    yield
+    publish_offline()
+    client.disconnect()
+    client.loop_stop()
+
+app = FastAPI(title=f"Porte {DEVICE_ID}", lifespan=lifespan)
+install_debug_routes(app)
+
+class RuntimeConfig(BaseModel):
+    device_id: Optional[str] = None
+
+@app.get("/config")
+def get_config():
+    return {"device_id": DEVICE_ID, "configured": configured}
+
+@app.post("/config")
+def set_config(cfg: RuntimeConfig):
+    apply_identity(cfg.device_id or DEVICE_ID)
+    return {"ok": True, **get_config()}
 
 @app.get("/state")
 def get_state():
-    return {"device_id": DEVICE_ID, **state}
+    return {"device_id": DEVICE_ID, **door.snapshot()}
 
 @app.post("/open")
 def open_door():
-    state["is_open"] = True
-    state["last_change"] = now_iso()
-    publish_state(client)
-    return {"ok": True, **state}
+    changed = door.apply("open")
+    return {"ok": True, "changed": changed, **door.snapshot()}
 
 @app.post("/close")
 def close_door():
-    state["is_open"] = False
-    state["last_change"] = now_iso()
-    publish_state(client)
-    return {"ok": True, **state}
+    changed = door.apply("close")
+    return {"ok": True, "changed": changed, **door.snapshot()}
 
 @app.post("/toggle")
 def toggle_door():
-    state["is_open"] = not state["is_open"]
-    state["last_change"] = now_iso()
-    publish_state(client)
-    return {"ok": True, **state}
+    changed = door.apply("toggle")
+    return {"ok": True, "changed": changed, **door.snapshot()}
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "device_id": DEVICE_ID}
+    """Liveness : le process répond ; l'état MQTT est informatif (voir /ready)."""
+    return {"status": "ok", "device_id": DEVICE_ID, "mqtt_connected": client.is_connected(),
+            "uptime_s": round(time.monotonic() - _boot_ts, 1), "reconnect": reconnect_stats.snapshot()}
+
+@app.get("/ready")
+def ready():
+    """Readiness : 503 tant que la session MQTT n'est pas établie (commandes non reçues)."""
+    connected = client.is_connected()
+    return JSONResponse(status_code=200 if connected else 503,
+                        content={"ready": connected, "device_id": DEVICE_ID, "mqtt_connected": connected})
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT","8001")))
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("porte")
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT","8001")), log_config=None)
@@ -0,0 +1,30 @@
+"""Journal de patchs de PlanStore : reprise après une ligne tronquée (python -m pytest tests)."""
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "common"))
+
+from plan_store import PlanStore  # noqa: E402
+
+
+def _rename(name: str) -> list:
+    return [{"op": "replace", "path": "/name", "value": name}]
+
+
+def test_patch_after_torn_line_survives_reload(tmp_path):
+    store = PlanStore(tmp_path)
+    store.put("F1", {"id": "F1", "name": "v1"})
+    store.patch("F1", _rename("v2"), None)
+    log_path = tmp_path / "floors" / "F1.log.jsonl"
+    # écriture interrompue : ligne partielle sans fin de ligne
+    with log_path.open("ab") as fh:
+        fh.write(b'{"version": 3, "ops": [{"op": "repl')
+
+    reloaded = PlanStore(tmp_path)
+    assert reloaded.version("F1") == 2
+    assert reloaded.patch("F1", _rename("v3"), 2) == 3
+    assert reloaded.patch("F1", _rename("v4"), 3) == 4
+
+    again = PlanStore(tmp_path)
+    assert again.version("F1") == 4
+    assert again.get("F1")["name"] == "v4"
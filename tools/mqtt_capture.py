@@ -0,0 +1,278 @@
+"""Enregistre le trafic MQTT (iot/#) dans un fichier de capture et le rejoue contre un broker.
+
+Format de capture (binaire, écrit au fil de l'eau ; gzip si le nom finit par .gz) :
+  en-tête   b"MQTTCAP1" + u64 horodatage epoch (µs) du début
+  message   f64 décalage (s) | u16 longueur topic | u8 flags (qos | retain << 2) | u32 longueur payload
+            puis le topic (UTF-8) et le payload bruts
+
+Exemples :
+  python mqtt_capture.py record matin.cap.gz --duration 3600
+  python mqtt_capture.py info matin.cap.gz
+  python mqtt_capture.py replay matin.cap.gz --speed 10 --map-device badgeuse-001=badgeuse-101
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+from collections import Counter
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+
+
+log = logging.getLogger("mqtt-capture")
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+MAGIC = b"MQTTCAP1"
+_HEADER = struct.Struct("<8sQ")
+_RECORD = struct.Struct("<dHBI")
+# champs JSON portant un identifiant de device, réécrits par --map-device
+_ID_FIELDS = ("device_id", "doorID", "door_id")
+
+Record = Tuple[float, str, int, bool, bytes]
+
+
+def _open(path: str, mode: str) -> BinaryIO:
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+def read_capture(path: str) -> Iterator[Record]:
+    """(décalage s, topic, qos, retain, payload) dans l'ordre d'enregistrement, sans tout charger."""
+    with _open(path, "rb") as fh:
+        magic, _ = _HEADER.unpack(fh.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path}: pas un fichier de capture")
+        while True:
+            head = fh.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return  # fin de fichier (ou dernier message tronqué par un arrêt brutal)
+            offset, tlen, flags, plen = _RECORD.unpack(head)
+            body = fh.read(tlen + plen)
+            if len(body) < tlen + plen:
+                return
+            yield offset, body[:tlen].decode("utf-8"), flags & 0x3, bool(flags & 0x4), body[tlen:]
+
+
+def _client(client_id: str, host: str, port: int, timeout: float) -> Optional[mqtt.Client]:
+    ready = threading.Event()
+    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id=client_id, protocol=mqtt.MQTTv311)
+    if os.getenv("MQTT_USER", ""):
+        client.username_pw_set(os.getenv("MQTT_USER", ""), os.getenv("MQTT_PASS", ""))
+    client.on_connect = lambda c, u, f, rc, p=None: ready.set() if rc == 0 else None
+    client.connect(host, port, keepalive=30)
+    client.loop_start()
+    if not ready.wait(timeout):
+        client.loop_stop()
+        log.error("Timeout connexion MQTT %s:%s (>%ss)", host, port, timeout)
+        return None
+    return client
+
+
+# --------- record ----------
+def cmd_record(args: argparse.Namespace) -> int:
+    stop = threading.Event()
+    lock = threading.Lock()
+    start = time.time()
+    fh = _open(args.file, "wb")
+    fh.write(_HEADER.pack(MAGIC, int(start * 1_000_000)))
+    counts = {"messages": 0, "bytes": 0}
+
+    def on_message(client, userdata, msg):
+        topic = msg.topic.encode("utf-8")
+        flags = (msg.qos & 0x3) | (0x4 if msg.retain else 0)
+        with lock:
+            if fh.closed:
+                return
+            fh.write(_RECORD.pack(time.time() - start, len(topic), flags, len(msg.payload)))
+            fh.write(topic)
+            fh.write(msg.payload)
+            counts["messages"] += 1
+            counts["bytes"] += len(msg.payload)
+
+    def on_connect(client, userdata, flags, reason_code, properties=None):
+        # (re)abonnement à chaque connexion : la capture survit à une coupure du broker
+        client.subscribe([(topic, args.qos) for topic in args.topic])
+
+    client = _client(f"mqtt-capture-{os.getpid()}", args.host, args.port, args.timeout)
+    if client is None:
+        fh.close()
+        return 1
+    client.on_message = on_message
+    client.on_connect = on_connect
+    on_connect(client, None, None, 0)
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    log.info("Enregistrement de %s dans %s (Ctrl+C pour arrêter)", ", ".join(args.topic), args.file)
+
+    deadline = start + args.duration if args.duration > 0 else None
+    while not stop.wait(1.0):
+        if deadline and time.time() >= deadline:
+            break
+        with lock:
+            fh.flush()
+    client.loop_stop()
+    client.disconnect()
+    with lock:
+        fh.close()
+    log.info("%d message(s), %d octets de payload en %.1fs", counts["messages"], counts["bytes"], time.time() - start)
+    return 0
+
+
+# --------- info ----------
+def cmd_info(args: argparse.Namespace) -> int:
+    total, size, last = 0, 0, 0.0
+    by_kind: Counter = Counter()
+    for offset, topic, _, _, payload in read_capture(args.file):
+        total += 1
+        size += len(payload)
+        last = offset
+        parts = topic.split("/")
+        by_kind["/".join(parts[:2] + ["+"] + parts[3:]) if len(parts) >= 4 else topic] += 1
+    print(json.dumps({
+        "messages": total,
+        "payload_bytes": size,
+        "duration_s": round(last, 3),
+        "avg_rate_per_s": round(total / last, 1) if last > 0 else None,
+        "topics": dict(by_kind.most_common(20)),
+    }, indent=2))
+    return 0
+
+
+# --------- replay ----------
+def _parse_map(pairs) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    for pair in pairs or []:
+        old, sep, new = pair.partition("=")
+        if not sep:
+            raise SystemExit(f"mapping invalide (attendu ANCIEN=NOUVEAU): {pair}")
+        out[old] = new
+    return out
+
+
+def _remap(topic: str, payload: bytes, topic_map: Dict[str, str], device_map: Dict[str, str]) -> Tuple[str, bytes]:
+    for old, new in topic_map.items():
+        if topic.startswith(old):
+            topic = new + topic[len(old):]
+            break
+    if not device_map:
+        return topic, payload
+    topic = "/".join(device_map.get(part, part) for part in topic.split("/"))
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return topic, payload
+    if not isinstance(data, dict):
+        return topic, payload
+    changed = False
+    for obj in (data, data.get("data")):
+        if not isinstance(obj, dict):
+            continue
+        for key in _ID_FIELDS:
+            if isinstance(obj.get(key), str) and obj[key] in device_map:
+                obj[key] = device_map[obj[key]]
+                changed = True
+    return topic, json.dumps(data).encode("utf-8") if changed else payload
+
+
+def cmd_replay(args: argparse.Namespace) -> int:
+    topic_map = _parse_map(args.map_topic)
+    device_map = _parse_map(args.map_device)
+    client = _client(f"mqtt-replay-{os.getpid()}", args.host, args.port, args.timeout)
+    if client is None:
+        return 1
+    client.max_inflight_messages_set(args.inflight)
+    speed = 0.0 if args.max else args.speed
+    log.info("Rejeu de %s à %s", args.file, "vitesse max" if speed <= 0 else f"x{speed:g}")
+
+    sent, skipped, lags = 0, 0, []
+    last_info = None
+    t0 = time.monotonic()
+    base = 0.0
+    for loop in range(max(1, args.loop)):
+        offset = 0.0
+        for offset, topic, qos, retain, payload in read_capture(args.file):
+            if args.only and not any(mqtt.topic_matches_sub(f, topic) for f in args.only):
+                skipped += 1
+                continue
+            if retain and args.no_retain:
+                retain = False
+            if speed > 0:
+                due = t0 + (base + offset) / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lags.append(-delay)
+            topic, payload = _remap(topic, payload, topic_map, device_map)
+            last_info = client.publish(topic, payload, qos=qos, retain=retain)
+            sent += 1
+        base += offset
+    if last_info is not None:
+        try:
+            last_info.wait_for_publish(args.timeout)
+        except (RuntimeError, ValueError):
+            pass
+    elapsed = time.monotonic() - t0
+    client.loop_stop()
+    client.disconnect()
+
+    lags.sort()
+    result = {
+        "sent": sent,
+        "skipped": skipped,
+        "elapsed_s": round(elapsed, 3),
+        "rate_per_s": round(sent / elapsed, 1) if elapsed > 0 else None,
+        "late": len(lags),
+        "late_p99_ms": round(lags[min(len(lags) - 1, int(0.99 * len(lags)))] * 1000, 2) if lags else None,
+    }
+    print(json.dumps(result))
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Capture et rejeu du trafic MQTT iot/#.")
+    parser.add_argument("--host", default=os.getenv("MQTT_HOST", "localhost"), help="Hôte du broker (défaut: %(default)s ou MQTT_HOST).")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MQTT_PORT", "1883")), help="Port du broker (défaut: %(default)s ou MQTT_PORT).")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Timeout de connexion en secondes (défaut: %(default)s).")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="Enregistre le trafic dans un fichier de capture.")
+    rec.add_argument("file", help="Fichier de capture (.gz pour compresser).")
+    rec.add_argument("--topic", action="append", default=None, help="Filtre d'abonnement, répétable (défaut: iot/#).")
+    rec.add_argument("--qos", type=int, default=1, choices=(0, 1, 2), help="QoS d'abonnement (défaut: %(default)s).")
+    rec.add_argument("--duration", type=float, default=0.0, help="Arrêt automatique après N secondes (0 = Ctrl+C).")
+
+    info = sub.add_parser("info", help="Résumé d'un fichier de capture.")
+    info.add_argument("file")
+
+    rep = sub.add_parser("replay", help="Rejoue une capture contre un broker.")
+    rep.add_argument("file")
+    rep.add_argument("--speed", type=float, default=1.0, help="Facteur d'accélération (défaut: %(default)s).")
+    rep.add_argument("--max", action="store_true", help="Vitesse maximale, sans respecter les écarts enregistrés.")
+    rep.add_argument("--loop", type=int, default=1, help="Nombre de passes sur la capture (défaut: %(default)s).")
+    rep.add_argument("--only", action="append", help="Ne rejoue que les topics correspondant à ce filtre MQTT (répétable).")
+    rep.add_argument("--map-topic", action="append", help="Remplace un préfixe de topic : ANCIEN=NOUVEAU (répétable).")
+    rep.add_argument("--map-device", action="append", help="Renomme un device (topic et champs JSON) : ANCIEN=NOUVEAU (répétable).")
+    rep.add_argument("--no-retain", action="store_true", help="Rejoue les messages retenus sans le flag retain.")
+    rep.add_argument("--inflight", type=int, default=1000, help="Messages QoS>0 en vol (défaut: %(default)s).")
+
+    args = parser.parse_args()
+    if args.command == "record" and not args.topic:
+        args.topic = ["iot/#"]
+    return args
+
+
+def main() -> int:
+    args = parse_args()
+    return {"record": cmd_record, "info": cmd_info, "replay": cmd_replay}[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
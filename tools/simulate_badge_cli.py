@@ -1,9 +1,13 @@
 import argparse
+import itertools
 import json
 import logging
 import os
+import random
 import sys
 import threading
+import time
+from collections import deque
 from datetime import datetime, timezone
 
 import paho.mqtt.client as mqtt
@@ -15,15 +19,22 @@ logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
-        description="Simule un badgeage en publiant une commande MQTT sur une badgeuse."
+        description=(
+            "Simule un badgeage en publiant une commande MQTT sur une badgeuse. "
+            "Avec --duration : mode charge (débit cible, plusieurs lecteurs et connexions, "
+            "latence badgeage -> commande/ouverture de porte)."
+        )
     )
     parser.add_argument(
         "badgeuse_id",
-        help="Identifiant de la badgeuse cible (ex: badgeuse-001).",
+        help=(
+            "Identifiant de la badgeuse cible (ex: badgeuse-001). En mode charge : liste "
+            "séparée par des virgules, ignorée si --readers est fourni."
+        ),
     )
     parser.add_argument(
         "badge_id",
-        help="Identifiant du badge à envoyer (ex: BADGE-1234).",
+        help="Identifiant du badge à envoyer (ex: BADGE-1234). En mode charge : préfixe du pool de badges.",
     )
     parser.add_argument(
         "--host",
@@ -42,11 +53,259 @@ def parse_args() -> argparse.Namespace:
         default=5.0,
         help="Timeout (secondes) pour la connexion et la publication (défaut: %(default)s).",
     )
+    load = parser.add_argument_group("mode charge")
+    load.add_argument(
+        "--duration",
+        type=float,
+        default=0.0,
+        help="Durée du test de charge en secondes (0 = un seul badgeage, défaut).",
+    )
+    load.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="Badgeages par seconde, tous lecteurs confondus (défaut: %(default)s).",
+    )
+    load.add_argument(
+        "--readers",
+        type=int,
+        default=0,
+        help="Nombre de lecteurs générés avec --reader-format (défaut: liste badgeuse_id).",
+    )
+    load.add_argument(
+        "--reader-format",
+        default="badgeuse-{:03d}",
+        help="Format des identifiants de lecteurs générés, numérotés à partir de 1 (défaut: %(default)s).",
+    )
+    load.add_argument(
+        "--connections",
+        type=int,
+        default=4,
+        help="Connexions MQTT de publication en parallèle (défaut: %(default)s).",
+    )
+    load.add_argument(
+        "--badge-pool",
+        type=int,
+        default=1000,
+        help="Taille du pool de badges <badge_id>-NNNN tirés au hasard (défaut: %(default)s).",
+    )
+    load.add_argument(
+        "--drain",
+        type=float,
+        default=3.0,
+        help="Attente (s) des commandes/états tardifs après la fin de l'émission (défaut: %(default)s).",
+    )
+    load.add_argument(
+        "--json-out",
+        help="Écrit aussi le résumé JSON dans ce fichier (suivi de régression).",
+    )
     return parser.parse_args()
 
 
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoadTracker:
+    """Corrèle chaque badgeage avec la commande de porte (badgeID) puis l'état ouvert de la porte."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: dict[str, deque] = {}          # badge -> [t0 des badgeages sans commande]
+        self._awaiting_open: dict[str, list] = {}     # porte -> [t0 des badgeages commandés]
+        self.sent = 0
+        self.publish_failed = 0
+        self.to_command: list[float] = []
+        self.to_open: list[float] = []
+        self.unmatched_commands = 0
+
+    def swiped(self, badge_id: str, t0: float) -> None:
+        with self._lock:
+            self.sent += 1
+            self._pending.setdefault(badge_id, deque()).append(t0)
+
+    def failed(self) -> None:
+        with self._lock:
+            self.publish_failed += 1
+
+    def on_message(self, client, userdata, msg) -> None:
+        now = time.monotonic()
+        parts = msg.topic.split("/")  # iot/porte/<id>/(commands|state)
+        if len(parts) != 4:
+            return
+        try:
+            data = json.loads(msg.payload or b"{}")
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        door_id = parts[2]
+        with self._lock:
+            if parts[3] == "commands":
+                if str(data.get("action", "")).lower() not in {"open", "toggle"}:
+                    return
+                queue = self._pending.get(str(data.get("badgeID") or ""))
+                if not queue:
+                    self.unmatched_commands += 1
+                    return
+                t0 = queue.popleft()
+                self.to_command.append(now - t0)
+                self._awaiting_open.setdefault(door_id, []).append(t0)
+            elif parts[3] == "state" and (data.get("data") or {}).get("is_open"):
+                for t0 in self._awaiting_open.pop(door_id, []):
+                    self.to_open.append(now - t0)
+
+    def summary(self, elapsed: float) -> dict:
+        with self._lock:
+            lost = sum(len(q) for q in self._pending.values())
+            ms = lambda v: round(v * 1000, 2) if v is not None else None
+            lat = lambda vals: {
+                "count": len(vals),
+                "p50_ms": ms(_percentile(vals, 0.50)),
+                "p95_ms": ms(_percentile(vals, 0.95)),
+                "p99_ms": ms(_percentile(vals, 0.99)),
+                "max_ms": ms(max(vals) if vals else None),
+            }
+            return {
+                "sent": self.sent,
+                "publish_failed": self.publish_failed,
+                "throughput_per_s": round(self.sent / elapsed, 1) if elapsed > 0 else None,
+                "commanded": len(self.to_command),
+                "lost": lost,
+                "loss_pct": round(100.0 * lost / self.sent, 2) if self.sent else None,
+                "unmatched_commands": self.unmatched_commands,
+                "swipe_to_command": lat(self.to_command),
+                "swipe_to_open": lat(self.to_open),
+            }
+
+
+def _connect(client_id: str, host: str, port: int, timeout: float, on_message=None) -> mqtt.Client | None:
+    ready = threading.Event()
+    client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311)
+    if os.getenv("MQTT_USER", ""):
+        client.username_pw_set(os.getenv("MQTT_USER", ""), os.getenv("MQTT_PASS", ""))
+    client.on_connect = lambda c, u, f, rc, p=None: ready.set() if rc == 0 else None
+    if on_message is not None:
+        client.on_message = on_message
+    client.max_inflight_messages_set(100)
+    client.connect(host, port, keepalive=30)
+    client.loop_start()
+    if not ready.wait(timeout):
+        client.loop_stop()
+        return None
+    return client
+
+
+def _print_table(summary: dict, params: dict) -> None:
+    print()
+    print(f"Charge : {params['rate']}/s pendant {params['duration']}s, {params['readers']} lecteur(s), "
+          f"{params['connections']} connexion(s), pool de {params['badge_pool']} badges")
+    print(f"  envoyés           {summary['sent']:>10}   ({summary['throughput_per_s']}/s, échecs publish: {summary['publish_failed']})")
+    print(f"  commandes porte   {summary['commanded']:>10}")
+    print(f"  perdus            {summary['lost']:>10}   ({summary['loss_pct']} %)  -- inclut l'anti-rebond du bridge")
+    print()
+    print(f"  {'latence (ms)':<20}{'n':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for label, key in (("badge -> commande", "swipe_to_command"), ("badge -> ouverture", "swipe_to_open")):
+        row = summary[key]
+        cells = "".join(f"{'-' if row[k] is None else row[k]:>10}" for k in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))
+        print(f"  {label:<20}{row['count']:>8}{cells}")
+    print()
+
+
+def run_load(args: argparse.Namespace) -> int:
+    if args.readers > 0:
+        readers = [args.reader_format.format(i) for i in range(1, args.readers + 1)]
+    else:
+        readers = [r.strip() for r in args.badgeuse_id.split(",") if r.strip()]
+    badges = [f"{args.badge_id.strip()}-{i:04d}" for i in range(max(1, args.badge_pool))]
+    if not readers or args.rate <= 0:
+        log.error("Aucun lecteur ou débit nul")
+        return 1
+
+    tracker = LoadTracker()
+    suffix = f"{os.getpid()}"
+    observer = _connect(f"badge-cli-observer-{suffix}", args.host, args.port, args.timeout, tracker.on_message)
+    if observer is None:
+        log.error("Timeout connexion MQTT (>%ss)", args.timeout)
+        return 1
+    observer.subscribe([("iot/porte/+/commands", 1), ("iot/porte/+/state", 1)])
+
+    publishers = []
+    for i in range(max(1, args.connections)):
+        client = _connect(f"badge-cli-load-{suffix}-{i}", args.host, args.port, args.timeout)
+        if client is None:
+            log.error("Connexion de publication %d impossible", i)
+            return 1
+        publishers.append(client)
+
+    log.info(
+        "Charge %.1f badgeages/s pendant %.0fs sur %d lecteur(s), %d connexion(s)",
+        args.rate, args.duration, len(readers), len(publishers),
+    )
+    reader_cycle = itertools.cycle(readers)
+    cycle_lock = threading.Lock()
+    start = time.monotonic()
+    end = start + args.duration
+    interval = len(publishers) / args.rate     # chaque connexion émet rate / connexions
+
+    def pump(idx: int, client: mqtt.Client) -> None:
+        rng = random.Random(idx)
+        next_at = start + idx * interval / len(publishers)
+        while next_at < end:
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with cycle_lock:
+                reader = next(reader_cycle)
+            badge_id = rng.choice(badges)
+            payload = {
+                "action": "simulate_badge",
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "badgeID": badge_id,
+            }
+            t0 = time.monotonic()
+            tracker.swiped(badge_id, t0)
+            info = client.publish(f"iot/badgeuse/{reader}/commands", json.dumps(payload), qos=1)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                tracker.failed()
+            next_at += interval    # horaire absolu : pas de dérive si un envoi prend du retard
+
+    threads = [threading.Thread(target=pump, args=(i, c), daemon=True) for i, c in enumerate(publishers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    time.sleep(max(0.0, args.drain))
+
+    summary = tracker.summary(elapsed)
+    params = {
+        "rate": args.rate,
+        "duration": args.duration,
+        "readers": len(readers),
+        "connections": len(publishers),
+        "badge_pool": len(badges),
+    }
+    for client in publishers + [observer]:
+        client.loop_stop()
+        client.disconnect()
+
+    _print_table(summary, params)
+    result = {"ts": datetime.now(timezone.utc).isoformat(), "params": params, "results": summary}
+    print(json.dumps(result))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+    return 0
+
+
 def main() -> int:
     args = parse_args()
+    if args.duration > 0:
+        return run_load(args)
 
     badgeuse_id = args.badgeuse_id.strip()
     badge_id = args.badge_id.strip()